@@ -1,65 +1,101 @@
-import matplotlib
-matplotlib.use('Agg')
-import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, session
-import matplotlib.pyplot as plt
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, abort, send_file, Response
 import io
 import base64
-import sqlite3
+import logging
 import os
+import charts
+import db
+import export
+import metrics
+import question_bank
+import reports
+import results_summary
+import retention
+import scoring
+import search
+import session_store
+import snapshot
+import storage
+import write_behind
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
+# Session data is kept server side; the cookie only holds a random session id
+app.session_interface = session_store.ServerSideSessionInterface(session_store.create_store())
+# Per-route latency histograms; SQLite statements are timed by db.Cursor
+metrics.init_app(app)
+metrics.gauge('write_behind_queue_depth', 'Journaled records not yet applied to SQLite',
+              lambda: write_behind.stats()['depth'])
+metrics.gauge('write_behind_lag_seconds', 'Age of the oldest journaled record not yet applied',
+              lambda: write_behind.stats()['lag_seconds'])
+metrics.gauge('question_bank_cohorts_loaded', 'Cohort question banks held in the LRU', question_bank.loaded_cohorts)
+metrics.gauge('snapshot_age_seconds', 'Age of the snapshot admin pages and exports read',
+              lambda: (snapshot.freshness() or {'age_seconds': 0})['age_seconds'])
+if storage.STORAGE_BACKEND == 'postgres':
+    metrics.gauge('storage_pool_connections_open', 'PostgreSQL connections this worker holds open',
+                  lambda: storage.get_storage().pool.stats()['open'])
 
-DB_FILE = 'responses.db'
+DB_FILE = db.DB_FILE
+# 'png' links the results chart as a cacheable image; 'svg' inlines it in the page
+RESULTS_CHART = os.environ.get('RESULTS_CHART', 'png')
 
 def init_db():
-    if not os.path.exists(DB_FILE):
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.executescript(open('init_db.sql').read())
+    storage.get_storage().setup()
+    # Apply whatever a previous run journaled but did not get to write
+    replayed = write_behind.recover()
+    if replayed:
+        print(f"Write-behind recovery: replayed {replayed} journaled records")
+    session_store.start_sweeper(app.session_interface.store)
+    if snapshot.enabled():
+        snapshot.start_refresher()
+    # Summary dedupe, incremental vacuum and, with RETENTION_DAYS, archiving old sessions
+    if storage.STORAGE_BACKEND == 'sqlite' and retention.RETENTION_INTERVAL > 0:
+        retention.start()
 
 init_db()
 
-def load_questions():
+def new_question_seed():
     import random
-    df = pd.read_excel('https://raw.githubusercontent.com/campojo/Leadership-Assessment/main/Questions%202.0%20(5).xlsx', sheet_name=None, engine='openpyxl')
-    assessment_df = df['Questions']
-    survey_df = df['SurveyQuestions']
-    # Group questions by style and select 5 random questions from each
-    styles = assessment_df['Style_Num'].unique()
-    selected_questions = []
-    for style in styles:
-        style_questions = assessment_df[assessment_df['Style_Num'] == style]['Question'].tolist()
-        selected_questions.extend(random.sample(style_questions, 5))
-    # Shuffle the selected questions
-    random.shuffle(selected_questions)
-    return selected_questions, survey_df['Question'].tolist()
-
-assessment_questions, survey_questions = load_questions()
+    return random.SystemRandom().getrandbits(63)
 
-def build_question_style_map():
-    df = pd.read_excel('https://raw.githubusercontent.com/campojo/Leadership-Assessment/main/Questions%202.0%20(5).xlsx', sheet_name='Questions', engine='openpyxl')
-    style_num_to_name = {
-        1: 'Transformational',
-        2: 'Democratic',
-        3: 'Charismatic',
-        4: 'Autocratic',
-        5: 'Laissez-Faire',
-        6: 'Situational',
-        7: 'Transactional',
-        8: 'Servant'
-    }
-    return {q: style_num_to_name.get(s, s) for q, s in zip(df['Question'], df['Style_Num'])}
+def session_bank():
+    # The question bank of the cohort the participant entered on index()
+    return question_bank.get_bank(session.get('cohort', ''))
 
-question_to_style = build_question_style_map()
+def session_questions():
+    # Each participant gets their own 5-per-style sample, reproducible from the seed. Only
+    # the seed lives in the session, with the version of the bank it was drawn from: a
+    # reloaded workbook draws a different sample from the same seed.
+    # -> (questions, survey questions, whether the bank changed since the last draw)
+    bank = session_bank()
+    if 'question_seed' not in session:
+        session['question_seed'] = new_question_seed()
+    changed = False
+    if session.get('question_bank_version') != bank.version:
+        # Sessions from before versions were kept have none to compare
+        changed = 'question_bank_version' in session
+        session['question_bank_version'] = bank.version
+    return bank.question_texts(bank.draw_question_set(session['question_seed'])), list(bank.survey_questions), changed
+
+def build_question_style_map():
+    return session_bank().question_to_style
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         name = request.form.get('name')
         identifier = request.form.get('identifier')
+        # Loads the cohort's question bank now, so a mistyped code is caught here
+        try:
+            cohort = question_bank.normalize_cohort(request.form.get('cohort'))
+            question_bank.get_bank(cohort)
+        except question_bank.UnknownCohort:
+            return render_template('index.html', error="Unknown cohort code. Please check the code you were given."), 400
+        session['cohort'] = cohort
         session['name'] = name
         session['email'] = identifier
+        session.pop('question_seed', None)
+        session.pop('question_bank_version', None)
         return redirect(url_for('instructions'))
     return render_template('index.html')
 
@@ -75,17 +111,24 @@ def assessment():
     if 'email' not in session or not session['email']:
         return redirect(url_for('index'))
     try:
+        # Spans split the route's time into its phases on /metrics (see metrics.span)
+        with metrics.span('assessment.questions'):
+            assessment_questions, _, bank_changed = session_questions()
         if request.method == 'GET':
-            return render_template('assessment.html', assessment_questions=assessment_questions)
+            with metrics.span('assessment.render'):
+                return render_template('assessment.html', assessment_questions=assessment_questions)
+        if bank_changed:
+            # The answers are to questions this bank no longer draws for the seed
+            logging.warning(f"Question bank changed during the assessment for email {session.get('email','')}; questions redrawn.")
+            return render_template('assessment.html', assessment_questions=assessment_questions,
+                                   error="The questions were updated while you were answering. Please answer this new set.")
         # POST: Collect responses
-        import logging
         responses = {}
         for question in assessment_questions:
             answer = request.form.get(question)
             if answer is not None:
                 responses[question] = answer
         # Logging: how many answers received
-        logging.basicConfig(filename='assessment_debug.log', level=logging.INFO)
         logging.info(f"Assessment submitted: {len(responses)} answers received for email {session.get('email','')}.")
         if len(responses) != len(assessment_questions):
             logging.warning(f"Incomplete submission: {len(responses)} of {len(assessment_questions)} answers received for email {session.get('email','')}.")
@@ -93,167 +136,103 @@ def assessment():
         if len(responses) != len(assessment_questions):
             return render_template('assessment.html', assessment_questions=assessment_questions, error="Please answer all questions before submitting.")
         
-        session['responses'] = responses
         # Save assessment results to DB
         import datetime
         email = session.get('email', '')
         now = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
-        with sqlite3.connect(DB_FILE) as conn:
-            for question, answer in responses.items():
-                style = question_to_style.get(question, '')
-                try:
-                    conn.execute(
-                        'INSERT INTO assessment_results (email, timestamp, style, question, answer) VALUES (?, ?, ?, ?, ?)',
-                        (email, now, style, question, answer)
-                    )
-                except Exception as e:
-                    logging.error(f"DB insert error for {question}: {e}")
-            conn.commit()
+        question_to_style = build_question_style_map()
+        try:
+            # Journaled and written by the write-behind thread in one transaction, so a
+            # submission is stored whole or not at all
+            with metrics.span('assessment.journal'):
+                write_behind.submit_assessment(email, now, [(question_to_style.get(question, ''), question, answer)
+                                                            for question, answer in responses.items()],
+                                               session.get('cohort', ''))
+        except Exception as e:
+            logging.error(f"Journal error for assessment from {email}: {e}")
+            raise
+        # results() and survey() load the stored assessment by (email, timestamp)
+        session['submission'] = [email, now]
+        session.pop('assessment_id', None)
+        # results() records summary_results once per submission, not on every refresh
+        session['summary_pending'] = True
         return redirect(url_for('results'))
     except Exception as e:
-        print(f"Error in assessment route: {str(e)}")
+        logging.exception("Error in assessment route")
         return f"An error occurred: {str(e)}", 500
 
 @app.route('/results')
 def results():
     try:
-        responses = session.get('responses', {})
-        if not responses:
+        assessment_id = session.get('assessment_id')
+        if assessment_id is None:
+            if 'submission' not in session:
+                return redirect(url_for('assessment'))
+            # The submission may still be in the write-behind queue
+            with metrics.span('results.wait_for_write'):
+                assessment_id = write_behind.wait_for_assessment(*session['submission'])
+            if assessment_id is None:
+                return "Your answers are still being saved. Please refresh this page in a moment.", 503
+            session['assessment_id'] = assessment_id
+        # Scores were materialized in session_summary when the answers were stored
+        with metrics.span('results.scores'):
+            scores = storage.get_storage().session_scores(assessment_id)
+        if scores is None:
             return redirect(url_for('assessment'))
-        # Load questions and style mappings
-        excel_data = pd.read_excel('https://raw.githubusercontent.com/campojo/Leadership-Assessment/main/Questions%202.0%20(5).xlsx', sheet_name=['Questions', 'ScoreBasedResponse'], engine='openpyxl')
-        df = excel_data['Questions']
-        response_df = excel_data['ScoreBasedResponse']
-        styles = ['Transformational', 'Democratic', 'Charismatic', 'Autocratic',
-                 'Laissez-Faire', 'Situational', 'Transactional', 'Servant']
-        value_map = {'1': -2, '2': -1, '3': 0, '4': 1, '5': 2}
-        # Map Style_Num to style name (as in app.py)
-        style_num_to_name = {
-            1: 'Transformational',
-            2: 'Democratic',
-            3: 'Charismatic',
-            4: 'Autocratic',
-            5: 'Laissez-Faire',
-            6: 'Situational',
-            7: 'Transactional',
-            8: 'Servant'
-        }
-        # Map questions to style names
-        question_style_map = {q: style_num_to_name.get(s, str(s)) for q, s in zip(df['Question'], df['Style_Num'])}
-        style_scores = {style: [] for style in styles}
-        for question, answer in responses.items():
-            style = question_style_map.get(question)
-            if style and answer:
-                mapped = value_map.get(str(answer), 0)
-                style_scores[style].append(mapped)
-        # Sum scores for each style
-        results_dict = {style: sum(scores) for style, scores in style_scores.items()}
-        # Chart
-        x = range(len(styles))
+        results_dict, _ = scores
+        # Question bank is parsed once per process and shared across requests
+        bank = session_bank()
+        styles = question_bank.STYLES
+        # Chart: the page links to /chart/<key>.png, or inlines SVG when RESULTS_CHART=svg
         scores = [results_dict[style] for style in styles]
-        plt.figure(figsize=(10, 5))
-        plt.bar(x, scores, align='center', color='skyblue')
-        plt.title('Leadership Style Assessment Results', pad=20)
-        plt.ylabel('Tendency Level')
-        plt.xticks(x, styles, rotation=45, ha='right')
-        plt.yticks([-10, 0, 10], ['Low Tendency', 'Moderate', 'High Tendency'])
-        plt.grid(True, axis='y', linestyle='--', alpha=0.7)
-        plt.axhline(y=0, color='gray', linestyle='-', alpha=0.3)
-        plt.tight_layout()
-        img = io.BytesIO()
-        plt.savefig(img, format='png', bbox_inches='tight')
-        img.seek(0)
-        chart_data = base64.b64encode(img.getvalue()).decode()
-        plt.close()
-        # Summary logic (sum-based, with thresholds)
-        intro_paragraph = (
-            "It's important to remember that there is no right or wrong score in this assessment; rather, the "
-            "goal is to develop self-awareness as a leader. Each leadership style has its strengths and "
-            "challenges, and understanding your tendencies allows you to recognize how your approach "
-            "impacts others. By becoming more aware of your natural leadership style, you can adapt and "
-            "refine your methods to better meet the needs of your team and organization. Self-awareness "
-            "empowers you to make conscious decisions about when to lean into certain behaviors and "
-            "when to adjust your approach, ensuring you lead in a way that fosters growth, collaboration, "
-            "and positive outcomes."
-        )
-        tendency_explanations = {
-            'High': (
-                "High Tendency: "
-                "If a person scores high in this assessment area, it suggests that they strongly exhibit behaviors "
-                "aligned with specific leadership styles. For example, a high score in democratic leadership "
-                "indicates a tendency to prioritize collaboration and actively involve team members in decision-"
-                "making. A high score in transformational leadership suggests a natural ability to inspire and "
-                "motivate others toward long-term goals and personal growth. These tendencies reflect an "
-                "individual who is skilled in creating an inclusive and visionary environment, fostering "
-                "engagement and innovation within their team."
-            ),
-            'Moderate': (
-                "Moderate Tendency: "
-                "If a person scores moderately in this assessment area, it indicates that they exhibit a balanced "
-                "approach to the behaviors associated with that leadership trait. They may demonstrate some "
-                "strength in the area, but also show room for improvement. For example, a moderate score in "
-                "decision-making suggests they are capable of making decisions, but may occasionally hesitate "
-                "or seek more input from others. Similarly, a moderate score in communication might indicate "
-                "that they communicate effectively at times, but could benefit from refining their clarity or "
-                "engagement with different audiences. Overall, they are likely adaptable, but may need to "
-                "develop more consistency in their approach to fully leverage their leadership potential."
-            ),
-            'Low': (
-                "Low Tendency: "
-                "If a person scores low in this assessment area, it suggests that they may find certain behaviors "
-                "associated with that leadership trait more challenging. For example, a low score in democratic "
-                "leadership might indicate a preference for making decisions independently, rather than "
-                "involving others in the decision-making process. A low score in servant leadership might suggest "
-                "a tendency to prioritize tasks over the well-being and development of team members. These "
-                "tendencies reflect areas where the individual may benefit from additional development or "
-                "practice to enhance their effectiveness in specific situations."
-            )
-        }
-        style_summaries = []
-        for style in styles:
-            score = results_dict[style]
-            if 5 <= score <= 10:
-                tendency = 'High'
-            elif 0 <= score <= 4:
-                tendency = 'Moderate'
-            else:
-                tendency = 'Low'
-            desc_row = response_df[(response_df['Leadership Style'] == style) & (response_df['Tendency'] == tendency)]
-            if not desc_row.empty:
-                description = desc_row['Description'].values[0]
+        with metrics.span('results.chart'):
+            if RESULTS_CHART == 'svg':
+                chart_svg = charts.inline_svg(scores)
+                chart_url = None
             else:
-                description = f"No description found for {style} ({tendency})"
-            style_summaries.append({'style': style, 'tendency': tendency, 'description': description})
-        summary = {
-            'intro_paragraph': intro_paragraph,
-            'tendency_explanations': tendency_explanations,
-            'style_summaries': style_summaries
-        }
+                chart_svg = None
+                chart_url = url_for('chart_image', key=charts.chart_key(scores), fmt='png')
+        with metrics.span('results.summary'):
+            summary = results_summary.build_summary(bank, results_dict)
         # Save all-time summary results to DB
-        email = session.get('email', '')
-        import datetime
-        timestamp = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
-        with sqlite3.connect(DB_FILE) as conn:
-            for s in style_summaries:
-                conn.execute(
-                    'INSERT INTO summary_results (email, timestamp, style, score, tendency, description) VALUES (?, ?, ?, ?, ?, ?)',
-                    (email, timestamp, s['style'], results_dict[s['style']], s['tendency'], s['description'])
-                )
-            conn.commit()
-        return render_template('results.html', chart_data=chart_data, summary=summary)
+        if session.pop('summary_pending', False):
+            email = session.get('email', '')
+            import datetime
+            timestamp = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+            with metrics.span('results.journal'):
+                write_behind.submit_summary(email, timestamp, [(s['style'], results_dict[s['style']], s['tendency'], s['description'])
+                                                               for s in summary['style_summaries']])
+        with metrics.span('results.render'):
+            return render_template('results.html', chart_url=chart_url, chart_svg=chart_svg, summary=summary)
     except Exception as e:
-        print(f"Error in results route: {str(e)}")
+        logging.exception("Error in results route")
         return f"An error occurred: {str(e)}", 500
 
+@app.route('/chart/<key>.<fmt>')
+def chart_image(key, fmt):
+    # The key encodes the scores, so the image never changes for a given URL. Keys that no
+    # answer set can produce are a 404 before anything is rendered.
+    scores = charts.scores_from_key(key)
+    if scores is None or fmt not in ('png', 'svg'):
+        abort(404)
+    response = send_file(io.BytesIO(charts.get_chart(scores, fmt)), mimetype='image/png' if fmt == 'png' else 'image/svg+xml',
+                         etag=key, max_age=365 * 24 * 3600, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/survey', methods=['GET', 'POST'])
 def survey():
     if 'email' not in session or not session['email']:
         return redirect(url_for('index'))
-    if 'responses' not in session:
+    if 'submission' not in session:
         return redirect(url_for('assessment'))
     
+    with metrics.span('survey.questions'):
+        survey_questions = session_bank().survey_questions
     if request.method == 'GET':
-        return render_template('survey.html', survey_questions=survey_questions)
+        with metrics.span('survey.render'):
+            return render_template('survey.html', survey_questions=survey_questions)
     
     # POST: Save survey responses
     survey_responses = {}
@@ -264,15 +243,12 @@ def survey():
     
     # Save to database
     email = session.get('email', '')
-    with sqlite3.connect(DB_FILE) as conn:
-        for question, answer in survey_responses.items():
-            conn.execute('INSERT INTO survey_results (email, question, answer) VALUES (?, ?, ?)', (email, question, answer))
-        conn.commit()
+    with metrics.span('survey.journal'):
+        write_behind.submit_survey(email, survey_responses.items())
     
     return redirect(url_for('index'))
 
 import functools
-from flask import flash, send_file
 
 # --- Admin authentication helpers ---
 def admin_required(view_func):
@@ -283,6 +259,27 @@ def admin_required(view_func):
         return view_func(*args, **kwargs)
     return wrapped_view
 
+def sqlite_only(view_func):
+    # Search, analytics and exports read SQLite-specific tables (FTS5 indexes, daily
+    # aggregates) that the PostgreSQL backend does not maintain
+    @functools.wraps(view_func)
+    def wrapped_view(*args, **kwargs):
+        if storage.STORAGE_BACKEND != 'sqlite':
+            return f"Not available with STORAGE_BACKEND={storage.STORAGE_BACKEND}", 501
+        return view_func(*args, **kwargs)
+    return wrapped_view
+
+def admin_storage():
+    # Dashboards read the snapshot when there is one (see snapshot.py)
+    return snapshot.reader if snapshot.enabled() else storage.get_storage()
+
+def snapshot_headers(response):
+    # Tells export clients how current the data is; absent when read from the live database
+    freshness = snapshot.freshness()
+    if freshness:
+        response.headers['X-Snapshot-Taken-At'] = freshness['taken_at']
+    return response
+
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     error = None
@@ -290,6 +287,7 @@ def admin_login():
         password = request.form.get('password')
         admin_pw = os.environ.get('ADMIN_PASSWORD', 'admin123')
         if password == admin_pw:
+            session.regenerate()
             session['admin_logged_in'] = True
             return redirect(url_for('admin_results'))
         else:
@@ -298,138 +296,268 @@ def admin_login():
 
 @app.route('/admin/logout', methods=['POST'])
 def admin_logout():
+    session.regenerate()
     session.pop('admin_logged_in', None)
     return redirect(url_for('admin_login'))
 
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', '50'))
+# Days of per style means shown on /admin/analytics
+ANALYTICS_DAYS = int(os.environ.get('ANALYTICS_DAYS', '30'))
+
+def cohort_filter(value):
+    # Admin views show every cohort unless one is named; a malformed code matches nothing
+    return (value or '').strip().lower() or None
+
+def cohort_arg(value):
+    # cohort_filter() for views that put the code in a download's file name, where a
+    # malformed code is a 400 instead
+    cohort = cohort_filter(value)
+    if cohort is not None and not question_bank.COHORT_CODE_PATTERN.fullmatch(cohort):
+        abort(400)
+    return cohort
+
+def date_filters(start, end):
+    # Inclusive YYYY-MM-DD dates -> (start, end) timestamp bounds, either None when not
+    # given; the end bound is the start of the following day. ValueError if malformed.
+    import datetime
+    if start:
+        start = datetime.date.fromisoformat(start).isoformat()
+    if end:
+        end = (datetime.date.fromisoformat(end) + datetime.timedelta(days=1)).isoformat()
+    return start or None, end or None
+
+def encode_cursor(session):
+    return base64.urlsafe_b64encode(f"{session['timestamp']}|{session['id']}".encode()).decode()
+
+def decode_cursor(value):
+    # Opaque (timestamp, id) keyset cursor; anything malformed just means the first page
+    if not value:
+        return None
+    try:
+        timestamp, session_id = base64.urlsafe_b64decode(value.encode()).decode().rsplit('|', 1)
+        return timestamp, int(session_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
 @app.route('/admin/results')
 @admin_required
 def admin_results():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            
-            # Get all unique assessment sessions (by email and timestamp)
-            assessment_sessions = conn.execute('''
-                SELECT DISTINCT email, timestamp, MIN(id) as min_id
-                FROM assessment_results 
-                WHERE timestamp IS NOT NULL 
-                GROUP BY email, timestamp 
-                ORDER BY timestamp DESC
-            ''').fetchall()
-            
-            assessments = []
-            value_map = {'1': -2, '2': -1, '3': 0, '4': 1, '5': 2}
-            
-            for session in assessment_sessions:
-                email = session['email']
-                timestamp = session['timestamp']
-                
-                # Get name from session data or use email prefix
-                name = email.split('@')[0].replace('.', ' ').title()
-                
-                # Get all assessment responses for this session
-                question_responses = conn.execute('''
-                    SELECT question, style, answer 
-                    FROM assessment_results 
-                    WHERE email = ? AND timestamp = ?
-                    ORDER BY id
-                ''', (email, timestamp)).fetchall()
-                
-                # Get UNIQUE survey responses for this email (avoid duplicates)
-                survey_responses = conn.execute('''
-                    SELECT DISTINCT question, answer 
-                    FROM survey_results 
-                    WHERE email = ?
-                    GROUP BY question
-                    ORDER BY MIN(id)
-                ''', (email,)).fetchall()
-                
-                # Calculate style summary
-                style_scores = {
-                    'Transformational': 0, 'Democratic': 0, 'Charismatic': 0, 'Autocratic': 0,
-                    'Laissez-Faire': 0, 'Situational': 0, 'Transactional': 0, 'Servant': 0
-                }
-                
-                # Process responses and calculate scores
-                processed_responses = []
-                for response in question_responses:
-                    style = response['style'] if response['style'] else 'Unknown'
-                    answer = response['answer']
-                    mapped_score = value_map.get(str(answer), 0)
-                    
-                    if style in style_scores:
-                        style_scores[style] += mapped_score
-                    
-                    processed_responses.append({
-                        'question': response['question'],
-                        'style': style,
-                        'answer': answer,
-                        'mapped_score': mapped_score
-                    })
-                
-                # Create style summary with tendencies
-                style_summary = []
-                for style, score in style_scores.items():
-                    if 5 <= score <= 10:
-                        tendency = 'High'
-                    elif 0 <= score <= 4:
-                        tendency = 'Moderate'
-                    else:
-                        tendency = 'Low'
-                    
-                    style_summary.append({
-                        'style': style,
-                        'score': score,
-                        'tendency': tendency
-                    })
-                
-                # Format timestamp for display
-                try:
-                    from datetime import datetime
-                    dt = datetime.fromisoformat(timestamp.replace(' ', 'T'))
-                    formatted_timestamp = dt.strftime('%m-%d-%Y %I:%M%p')
-                except:
-                    formatted_timestamp = timestamp or 'Unknown'
-                
-                assessments.append({
-                    'name': name,
-                    'email': email,
-                    'timestamp': formatted_timestamp,
-                    'question_responses': processed_responses,
-                    'survey_responses': [{'question': s['question'], 'answer': s['answer']} for s in survey_responses],
-                    'style_summary': style_summary
-                })
-            
-            # Calculate stats
-            total_assessments = len(assessments)
-            total_surveys = len([a for a in assessments if a['survey_responses']])
-            unique_users = len(set(a['email'] for a in assessments))
-            
-            return render_template('admin_results.html', 
-                                 assessments=assessments,
-                                 total_assessments=total_assessments,
-                                 total_surveys=total_surveys,
-                                 unique_users=unique_users)
-                                 
+        filters = {
+            'email': request.args.get('email', '').strip(),
+            'cohort': request.args.get('cohort', '').strip(),
+            'start': request.args.get('start', '').strip(),
+            'end': request.args.get('end', '').strip()
+        }
+        try:
+            start, end = date_filters(filters['start'], filters['end'])
+        except ValueError:
+            start = end = None
+        before = decode_cursor(request.args.get('before'))
+        after = None if before else decode_cursor(request.args.get('after'))
+
+        store = admin_storage()
+        # Only one page of sessions is scored and rendered; question and survey
+        # details are fetched from admin_session_details() when a row is expanded
+        with metrics.span('admin_results.session_page'):
+            assessment_sessions, has_more = store.session_page(ADMIN_PAGE_SIZE, email=filters['email'],
+                                                               start=start, end=end, before=before, after=after,
+                                                               cohort=cohort_filter(filters['cohort']))
+        with metrics.span('admin_results.dashboard_stats'):
+            stats = store.dashboard_stats()
+
+        assessments = []
+        for row in assessment_sessions:
+            email = row['email']
+
+            # Get name from session data or use email prefix
+            name = export.participant_name(email)
+
+            # Scores and tendencies come precomputed from session_summary
+            style_summary = [{'style': style, 'score': row['scores'][style], 'tendency': row['tendencies'][style]}
+                             for style in question_bank.STYLES]
+
+            assessments.append({
+                'id': row['id'],
+                'name': name,
+                'email': email,
+                'cohort': row['cohort'],
+                'timestamp': export.format_timestamp(row['timestamp']),
+                'style_summary': style_summary
+            })
+
+        # Older pages follow the last row, newer pages precede the first one
+        has_older = has_more if not after else True
+        has_newer = has_more if after else before is not None
+        page_filters = {k: v for k, v in filters.items() if v}
+        older_url = url_for('admin_results', before=encode_cursor(assessment_sessions[-1]), **page_filters) if has_older and assessment_sessions else None
+        newer_url = url_for('admin_results', after=encode_cursor(assessment_sessions[0]), **page_filters) if has_newer and assessment_sessions else None
+
+        with metrics.span('admin_results.render'):
+            return render_template('admin_results.html',
+                                   assessments=assessments,
+                                   total_assessments=stats['total_assessments'],
+                                   total_surveys=stats['total_surveys'],
+                                   unique_users=stats['unique_users'],
+                                   # Archived sessions leave the totals (see db.DASHBOARD_COUNTERS)
+                                   archived_months=len(retention.months()),
+                                   filters=filters,
+                                   older_url=older_url,
+                                   newer_url=newer_url,
+                                   freshness=snapshot.freshness())
+
     except Exception as e:
+        logging.exception("Error in admin results route")
         return f"Admin results error: {str(e)}", 500
 
+@app.route('/admin/results/<int:session_id>')
+@admin_required
+def admin_session_details(session_id):
+    assessment_session, answers, surveys = admin_storage().session_details(session_id)
+    if assessment_session is None:
+        return jsonify({'error': 'Assessment not found'}), 404
+    return jsonify({
+        'question_responses': [{
+            'question': row['question'],
+            'style': row['style'] or 'Unknown',
+            'answer': row['answer'],
+            'mapped_score': scoring.answer_score(row['answer'])
+        } for row in answers],
+        'survey_responses': [{'question': row['question'], 'answer': row['answer']} for row in surveys]
+    })
+
+@app.route('/admin/search')
+@admin_required
+@sqlite_only
+def admin_search():
+    import itertools
+    filters = {
+        'q': request.args.get('q', '').strip(),
+        'cohort': request.args.get('cohort', '').strip(),
+        'start': request.args.get('start', '').strip(),
+        'end': request.args.get('end', '').strip(),
+        'style': request.args.get('style', '').strip(),
+        'tendency': request.args.get('tendency', '').strip()
+    }
+    try:
+        start, end = date_filters(filters['start'], filters['end'])
+    except ValueError:
+        start = end = None
+    before = decode_cursor(request.args.get('before'))
+    results, has_more = [], False
+    if any(filters.values()):
+        # Sessions past the retention age are searched in their monthly archives once the
+        # live database has no more matches
+        sources = itertools.chain([('', snapshot.get_connection())],
+                                  retention.archive_connections(start=start, end=end, before=before))
+        results, has_more = search.search_sources(sources, text=filters['q'], start=start, end=end, style=filters['style'],
+                                                  tendency=filters['tendency'], before=before,
+                                                  cohort=cohort_filter(filters['cohort']))
+    page_filters = {k: v for k, v in filters.items() if v}
+    older_url = url_for('admin_search', before=encode_cursor(results[-1]), **page_filters) if has_more else None
+    for result in results:
+        result['name'] = export.participant_name(result['email'])
+        result['timestamp'] = export.format_timestamp(result['timestamp'])
+        result['style_summary'] = [{'style': style, 'score': result['scores'][style], 'tendency': result['tendencies'][style]}
+                                   for style in question_bank.STYLES]
+    return render_template('admin_search.html',
+                           results=results,
+                           filters=filters,
+                           styles=question_bank.STYLES,
+                           tendencies=question_bank.TENDENCIES,
+                           older_url=older_url,
+                           searched=any(filters.values()),
+                           freshness=snapshot.freshness())
+
+@app.route('/admin/analytics')
+@admin_required
+@sqlite_only
+def admin_analytics():
+    filters = {
+        'cohort': request.args.get('cohort', '').strip(),
+        'start': request.args.get('start', '').strip(),
+        'end': request.args.get('end', '').strip()
+    }
+    try:
+        start, end = date_filters(filters['start'], filters['end'])
+    except ValueError:
+        start = end = None
+    # Read from the per style per day aggregates maintained on submit, so this does not
+    # scan assessments however many there are
+    with snapshot.get_connection() as conn:
+        statistics = db.cohort_statistics(conn, start=start, end=end, cohort=cohort_filter(filters['cohort']))
+        daily = db.daily_means(conn, ANALYTICS_DAYS, cohort=cohort_filter(filters['cohort']))
+    for row in statistics:
+        peak = max(row['histogram'].values(), default=0)
+        row['bars'] = [(score, count, round(100 * count / peak) if peak else 0)
+                       for score, count in row['histogram'].items()]
+    return render_template('admin_analytics.html',
+                           statistics=statistics,
+                           sessions=max((row['count'] for row in statistics), default=0),
+                           daily=daily,
+                           styles=question_bank.STYLES,
+                           filters=filters,
+                           freshness=snapshot.freshness())
+
+@app.route('/admin/snapshot/refresh', methods=['POST'])
+@admin_required
+def admin_snapshot_refresh():
+    # Takes a new snapshot now unless another worker is already taking one
+    if snapshot.enabled():
+        snapshot.refresh_if_stale(0)
+    return redirect(request.referrer or url_for('admin_results'))
+
+@app.route('/admin/write-behind')
+@admin_required
+def admin_write_behind():
+    # Queue depth and lag of this worker's write-behind journal
+    return jsonify(write_behind.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.authorized(request):
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+@admin_required
+def admin_profiler():
+    # POST action=start|stop|reset; GET returns this worker's samples as collapsed stacks
+    if request.method == 'POST':
+        action = request.form.get('action')
+        if action == 'start':
+            metrics.profiler.start()
+        elif action == 'stop':
+            metrics.profiler.stop()
+        elif action == 'reset':
+            metrics.profiler.reset()
+        else:
+            return f"Unknown profiler action: {action}", 400
+    response = Response(metrics.profiler.collapsed(), mimetype='text/plain')
+    response.headers['X-Profiler-Running'] = 'yes' if metrics.profiler.running else 'no'
+    response.headers['X-Profiler-Samples'] = str(metrics.profiler.samples)
+    return response
+
 @app.route('/admin/details')
 @admin_required
 def admin_details():
     email = request.args.get('email')
     if not email:
         return redirect(url_for('admin_results'))
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        summary = conn.execute('SELECT * FROM summary_results WHERE email = ? ORDER BY style', (email,)).fetchall()
-        assessment = conn.execute('SELECT * FROM assessment_results WHERE email = ? ORDER BY question', (email,)).fetchall()
-        survey = conn.execute('SELECT * FROM survey_results WHERE email = ? ORDER BY question', (email,)).fetchall()
-    return render_template('admin_details.html', email=email, summary=summary, assessment=assessment, survey=survey)
-
-import csv
-import io
-from flask import send_file
+    # Search results from an archived month link here with ?month=YYYY-MM
+    month = request.args.get('month')
+    if month:
+        if month not in retention.months():
+            abort(404)
+        conn = retention.open_archive(month)
+        try:
+            summary, assessment, survey = db.participant_details(conn, email)
+        finally:
+            conn.close()
+    else:
+        summary, assessment, survey = admin_storage().participant_details(email)
+    return render_template('admin_details.html', email=email, summary=summary, assessment=assessment, survey=survey,
+                           month=month)
 
 # TEMPORARY: Secure route to download DB for backup. Remove after use!
 @app.route('/download-db')
@@ -443,114 +571,125 @@ def download_db():
 
 @app.route('/admin/export')
 @admin_required
+@sqlite_only
 def admin_export():
+    import itertools
+    cohort = cohort_arg(request.args.get('cohort'))
+    # A dedicated connection holds the read cursor for as long as the download streams
+    conn = snapshot.open_reader()
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            
-            # Get all assessment data with comprehensive details
-            assessment_sessions = conn.execute('''
-                SELECT DISTINCT email, timestamp
-                FROM assessment_results 
-                WHERE timestamp IS NOT NULL 
-                ORDER BY timestamp DESC
-            ''').fetchall()
-            
-            # Create comprehensive export data
-            export_data = []
-            value_map = {'1': -2, '2': -1, '3': 0, '4': 1, '5': 2}
-            
-            for session in assessment_sessions:
-                email = session['email']
-                timestamp = session['timestamp']
-                name = email.split('@')[0].replace('.', ' ').title()
-                
-                # Get all responses for this session
-                responses = conn.execute('''
-                    SELECT question, style, answer 
-                    FROM assessment_results 
-                    WHERE email = ? AND timestamp = ?
-                    ORDER BY id
-                ''', (email, timestamp)).fetchall()
-                
-                # Get UNIQUE survey responses (avoid duplicates)
-                survey_responses = conn.execute('''
-                    SELECT DISTINCT question, answer 
-                    FROM survey_results 
-                    WHERE email = ?
-                    GROUP BY question
-                    ORDER BY MIN(id)
-                ''', (email,)).fetchall()
-                
-                # Calculate style scores
-                style_scores = {
-                    'Transformational': 0, 'Democratic': 0, 'Charismatic': 0, 'Autocratic': 0,
-                    'Laissez-Faire': 0, 'Situational': 0, 'Transactional': 0, 'Servant': 0
-                }
-                
-                # Process each question response
-                for i, response in enumerate(responses, 1):
-                    style = response['style'] if response['style'] else 'Unknown'
-                    answer = response['answer']
-                    mapped_score = value_map.get(str(answer), 0)
-                    
-                    if style in style_scores:
-                        style_scores[style] += mapped_score
-                    
-                    # Format timestamp
-                    try:
-                        from datetime import datetime
-                        dt = datetime.fromisoformat(timestamp.replace(' ', 'T'))
-                        formatted_timestamp = dt.strftime('%m-%d-%Y %I:%M%p')
-                    except:
-                        formatted_timestamp = timestamp
-                    
-                    export_data.append({
-                        'Name': name,
-                        'Email': email,
-                        'Assessment_Timestamp': formatted_timestamp,
-                        'Question_Number': i,
-                        'Question_Text': response['question'],
-                        'Leadership_Style': style,
-                        'User_Answer': answer,
-                        'Calculated_Score': mapped_score,
-                        'Survey_Completed': 'Yes' if survey_responses else 'No'
-                    })
-                
-                # Add survey data as separate rows (only unique responses)
-                for i, survey in enumerate(survey_responses, 1):
-                    export_data.append({
-                        'Name': name,
-                        'Email': email,
-                        'Assessment_Timestamp': formatted_timestamp,
-                        'Question_Number': f'SURVEY-{i}',
-                        'Question_Text': survey['question'],
-                        'Leadership_Style': 'Survey',
-                        'User_Answer': survey['answer'],
-                        'Calculated_Score': 'N/A',
-                        'Survey_Completed': 'Yes'
-                    })
-            
-            # Write to CSV
-            output = io.StringIO()
-            if export_data:
-                writer = csv.DictWriter(output, fieldnames=export_data[0].keys())
-                writer.writeheader()
-                writer.writerows(export_data)
-            else:
-                writer = csv.writer(output)
-                writer.writerow(['No data available'])
-            
-            output.seek(0)
-            return send_file(
-                io.BytesIO(output.read().encode('utf-8')), 
-                mimetype='text/csv', 
-                as_attachment=True, 
-                download_name='comprehensive_assessment_data.csv'
-            )
-            
+        # Archived months follow, newest first, so rows stay in timestamp order
+        chunks = export.iter_csv(conn, cohort=cohort, archives=(archive for _, archive in retention.archive_connections()))
+        # Run the query before answering so failures still produce an error page
+        with metrics.span('admin_export.first_chunk'):
+            first_chunk = next(chunks)
     except Exception as e:
+        logging.exception("Error in admin export route")
+        conn.close()
         return f"Export error: {str(e)}", 500
 
+    def generate():
+        # The rest of the download streams after the route returns, so it has a span of its own
+        try:
+            with metrics.span('admin_export.stream'):
+                yield from itertools.chain([first_chunk], chunks)
+        finally:
+            conn.close()
+
+    response = Response(
+        generate(),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f"attachment; filename=comprehensive_assessment_data{'_' + cohort if cohort else ''}.csv"}
+    )
+    return snapshot_headers(response)
+
+@app.route('/admin/export/<fmt>')
+@admin_required
+@sqlite_only
+def admin_export_columnar(fmt):
+    import shutil
+    import tempfile
+    import zipfile
+    if fmt not in export.COLUMNAR_FORMATS:
+        return f"Unknown export format: {fmt}", 404
+    # after_session_id is what earlier releases handed out; it is still a valid revision
+    after_revision = request.args.get('after_revision', request.args.get('after_session_id', 0, type=int), type=int)
+    after_survey_id = request.args.get('after_survey_id', 0, type=int)
+    cohort = cohort_arg(request.args.get('cohort'))
+    # ?month=YYYY-MM exports one archived month instead of the live data
+    month = request.args.get('month')
+    if month and month not in retention.months():
+        abort(404)
+    directory = tempfile.mkdtemp(prefix='export-')
+    conn = retention.open_archive(month) if month else snapshot.open_reader()
+    try:
+        manifest = export.write_columnar(conn, fmt, directory, after_revision, after_survey_id, cohort=cohort)
+        # Bundle the table files and manifest; the zip is spooled to disk, not memory
+        archive = tempfile.TemporaryFile()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+            for filename in manifest['files']:
+                zf.write(os.path.join(directory, filename), filename)
+        archive.seek(0)
+    except Exception as e:
+        return f"Export error: {str(e)}", 500
+    finally:
+        conn.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    response = send_file(archive, mimetype='application/zip', as_attachment=True,
+                         download_name=f"assessment_data{'_' + month if month else ''}{'_' + cohort if cohort else ''}_{fmt}.zip")
+    # Pass these back as after_revision/after_survey_id for the next incremental pull
+    response.headers['X-Export-Next-Revision'] = str(manifest['next']['after_revision'])
+    response.headers['X-Export-Next-Survey-Id'] = str(manifest['next']['after_survey_id'])
+    return snapshot_headers(response)
+
+@app.route('/admin/reports', methods=['POST'])
+@admin_required
+def admin_reports():
+    # Starts a batch of printable reports for the dashboard's current filters and sends
+    # the admin to a page that polls its progress
+    filters = {
+        'email': request.form.get('email', '').strip() or None,
+        'cohort': cohort_arg(request.form.get('cohort'))
+    }
+    try:
+        filters['start'], filters['end'] = date_filters(request.form.get('start'), request.form.get('end'))
+    except ValueError:
+        return "Invalid date", 400
+    fmt = request.form.get('format', 'html')
+    if fmt not in reports.REPORT_FORMATS:
+        return f"Unknown report format: {fmt}", 400
+    job_id = reports.start_job(admin_storage(), filters, fmt)
+    return redirect(url_for('admin_report_job', job_id=job_id))
+
+@app.route('/admin/reports/<job_id>')
+@admin_required
+def admin_report_job(job_id):
+    job = reports.status(job_id)
+    if job is None:
+        abort(404)
+    return render_template('admin_report_job.html', job=job)
+
+@app.route('/admin/reports/<job_id>/status')
+@admin_required
+def admin_report_status(job_id):
+    job = reports.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Report job not found'}), 404
+    return jsonify(job)
+
+@app.route('/admin/reports/<job_id>/download')
+@admin_required
+def admin_report_download(job_id):
+    job = reports.status(job_id)
+    if job is None or job['state'] != 'done':
+        abort(404)
+    cohort = cohort_arg(job['filters']['cohort'])
+    return send_file(os.path.abspath(reports.zip_path(job_id)), mimetype='application/zip', as_attachment=True,
+                     download_name=f"reports_{job['format']}{'_' + cohort if cohort else ''}.zip")
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Logging is set up by whatever runs the app: here for the development server, with
+    # --log-config under gunicorn. Importing app (tests, bulk_import, report workers)
+    # leaves it alone.
+    logging.basicConfig(filename='assessment_debug.log', level=logging.INFO)
+    app.run(debug=True)
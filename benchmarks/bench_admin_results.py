@@ -0,0 +1,75 @@
+# /admin/results latency against synthetic databases. "N+1" replays the old
+# per-session query loop that built every session up front; the page columns time
+# the paginated route on its first page and on the oldest page (reached through a
+# keyset cursor), plus the JSON details request made when a row is expanded.
+#
+#   python benchmarks/bench_admin_results.py [--sessions 100 1000 10000]
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def n_plus_one(conn):
+    # The queries and scoring loop admin_results() used to run
+    value_map = {'1': -2, '2': -1, '3': 0, '4': 1, '5': 2}
+    sessions = conn.execute('SELECT id, email, timestamp FROM assessment_sessions ORDER BY timestamp DESC').fetchall()
+    for session in sessions:
+        responses = conn.execute('SELECT question, style, answer FROM session_answers WHERE session_id = ? ORDER BY position',
+                                 (session['id'],)).fetchall()
+        conn.execute('SELECT DISTINCT question, answer FROM survey_results WHERE email = ? GROUP BY question ORDER BY MIN(id)',
+                     (session['email'],)).fetchall()
+        scores = {}
+        for response in responses:
+            scores[response['style']] = scores.get(response['style'], 0) + value_map.get(str(response['answer']), 0)
+    return len(sessions)
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Must be set before db.py is first imported, or the app would open ./responses.db
+        os.environ['DB_FILE'] = os.path.join(tmp, 'empty.db')
+        # Read each seeded database directly, not a snapshot of the empty one
+        os.environ['SNAPSHOT_INTERVAL'] = '0'
+        from seed import seed_database, use_database
+        import app
+        import db
+        client = app.app.test_client()
+        with client.session_transaction() as session:
+            session['admin_logged_in'] = True
+        print(f"{'sessions':>9}{'N+1 ms':>10}{'first page ms':>15}{'oldest page ms':>16}{'details ms':>12}{'page KB':>9}")
+        for sessions in args.sessions:
+            path = os.path.join(tmp, f"bench_{sessions}.db")
+            seed_database(path, sessions)
+            use_database(path)
+            conn = db.get_connection()
+            old = timed(lambda: n_plus_one(conn), args.repeat)
+            first = timed(lambda: client.get('/admin/results'), args.repeat)
+            size = len(client.get('/admin/results').data) / 1024
+            oldest = conn.execute('SELECT timestamp, id FROM assessment_sessions ORDER BY timestamp, id LIMIT 1 OFFSET 5').fetchone()
+            cursor = app.encode_cursor({'timestamp': oldest['timestamp'], 'id': oldest['id']})
+            last = timed(lambda: client.get(f'/admin/results?before={cursor}'), args.repeat)
+            session_id = int(re.search(rb'toggleDetails\((\d+)\)', client.get('/admin/results').data).group(1))
+            details = timed(lambda: client.get(f'/admin/results/{session_id}'), args.repeat)
+            print(f"{sessions:>9}{old:>10.1f}{first:>15.1f}{last:>16.1f}{details:>12.1f}{size:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
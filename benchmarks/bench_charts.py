@@ -0,0 +1,75 @@
+# Compares rendering the results chart with pyplot (what results() used to do) against
+# the Figure/Agg renderer in charts.py, cold and from its LRU cache.
+#
+#   python benchmarks/bench_charts.py [--renders 30]
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import charts
+from question_bank import STYLES
+
+
+def render_pyplot(scores):
+    x = range(len(STYLES))
+    plt.figure(figsize=(10, 5))
+    plt.bar(x, scores, align='center', color='skyblue')
+    plt.title('Leadership Style Assessment Results', pad=20)
+    plt.ylabel('Tendency Level')
+    plt.xticks(x, STYLES, rotation=45, ha='right')
+    plt.yticks([-10, 0, 10], ['Low Tendency', 'Moderate', 'High Tendency'])
+    plt.grid(True, axis='y', linestyle='--', alpha=0.7)
+    plt.axhline(y=0, color='gray', linestyle='-', alpha=0.3)
+    plt.tight_layout()
+    img = io.BytesIO()
+    plt.savefig(img, format='png', bbox_inches='tight')
+    plt.close()
+    return img.getvalue()
+
+
+def timed(fn, vectors):
+    times = []
+    for scores in vectors:
+        t = time.perf_counter()
+        data = fn(scores)
+        times.append(time.perf_counter() - t)
+    return times, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--renders', type=int, default=30)
+    args = parser.parse_args()
+    rng = random.Random(1)
+    vectors = [tuple(rng.randint(-10, 10) for _ in STYLES) for _ in range(args.renders)]
+    # Warm up font and glyph caches so neither side pays them in the measurements
+    render_pyplot(vectors[0])
+    charts.render_chart(vectors[0])
+    rows = [
+        ('pyplot png', timed(render_pyplot, vectors)),
+        ('Figure/Agg png', timed(charts.render_chart, vectors)),
+        ('Figure/Agg svg', timed(lambda s: charts.render_chart(s, 'svg'), vectors)),
+    ]
+    for scores in vectors:
+        charts.get_chart(scores)
+    rows.append(('cached png', timed(charts.get_chart, vectors)))
+    print(f"{'renderer':<16} {'median ms':>10} {'p95 ms':>10} {'bytes':>8}")
+    for name, (times, size) in rows:
+        times.sort()
+        p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+        print(f"{name:<16} {statistics.median(times) * 1000:>10.2f} {p95 * 1000:>10.2f} {size:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Cost of serving many cohorts from one process. For N cohorts, half sharing the bundled
+# workbook and half with their own edited copy, reports the first-request load time (a
+# workbook parse, or a snapshot load once one was written), the steady-state lookup
+# time, and the memory the loaded banks hold, measured with tracemalloc. With more
+# cohorts than --cache-size, round-robin lookups evict and reload from snapshots.
+#
+#   python benchmarks/bench_cohorts.py [--cohorts 4 16 64] [--cache-size 32]
+import argparse
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def write_cohort_workbooks(directory, count, source):
+    # Even cohorts reuse the bundled workbook byte for byte; odd ones reword a question
+    from openpyxl import load_workbook
+    for i in range(count):
+        path = os.path.join(directory, f'c{i}.xlsx')
+        if i % 2 == 0:
+            shutil.copy(source, path)
+            continue
+        workbook = load_workbook(source)
+        sheet = workbook['Questions']
+        column = [cell.value for cell in sheet[1]].index('Question') + 1
+        sheet.cell(2, column).value = f'{sheet.cell(2, column).value} (cohort {i})'
+        workbook.save(path)
+
+
+def load_all(question_bank, count):
+    start = time.perf_counter()
+    banks = [question_bank.get_bank(f'c{i}') for i in range(count)]
+    return banks, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cohorts', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--cache-size', type=int, default=32)
+    args = parser.parse_args()
+    print(f"{'cohorts':>8}{'banks':>7}{'parse ms':>10}{'snapshot ms':>13}{'lookup us':>11}{'held KB':>9}")
+    for count in args.cohorts:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ['COHORT_SOURCE'] = os.path.join(tmp, '{code}.xlsx')
+            os.environ['COHORT_CACHE_SIZE'] = str(args.cache_size)
+            os.environ['QUESTION_BANK_SNAPSHOT'] = os.path.join(tmp, 'question_bank.snapshot')
+            for name in [m for m in sys.modules if m in ('question_bank', 'metrics')]:
+                del sys.modules[name]
+            import question_bank
+            write_cohort_workbooks(tmp, count, question_bank.BUNDLED_WORKBOOK)
+            # Keep the parser's own import out of the measured memory
+            importlib.import_module('pandas')
+            tracemalloc.start()
+            banks, parse = load_all(question_bank, count)
+            held = tracemalloc.get_traced_memory()[0] / 1024
+            tracemalloc.stop()
+            distinct = len({id(bank) for bank in banks})
+            start = time.perf_counter()
+            for _ in range(100):
+                for i in range(count):
+                    question_bank.get_bank(f'c{i}')
+            lookup = (time.perf_counter() - start) / (100 * count) * 1e6
+            # A fresh process finds the snapshots the first load wrote
+            del banks
+            question_bank._cohort_loaders.clear()
+            _, snapshot = load_all(question_bank, count)
+            print(f"{count:>8}{distinct:>7}{parse:>10.0f}{snapshot:>13.0f}{lookup:>11.2f}{held:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
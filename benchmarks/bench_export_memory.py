@@ -0,0 +1,83 @@
+# Peak Python heap of /admin/export's old build-everything approach versus the
+# streamed CSV, on a database of 25,000 sessions (1M answer rows) by default.
+#
+#   python benchmarks/bench_export_memory.py [--sessions 25000]
+import argparse
+import csv
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def old_export(conn):
+    # What admin_export() used to do: per-session queries into a list of dicts, then
+    # a StringIO copy and an encoded BytesIO copy of the whole file
+    from export import participant_name, format_timestamp
+    value_map = {'1': -2, '2': -1, '3': 0, '4': 1, '5': 2}
+    export_data = []
+    for session in conn.execute('SELECT id, email, timestamp FROM assessment_sessions ORDER BY timestamp DESC').fetchall():
+        email, timestamp = session['email'], session['timestamp']
+        responses = conn.execute('SELECT question, style, answer FROM session_answers WHERE session_id = ? ORDER BY position',
+                                 (session['id'],)).fetchall()
+        surveys = conn.execute('SELECT DISTINCT question, answer FROM survey_results WHERE email = ? GROUP BY question ORDER BY MIN(id)',
+                               (email,)).fetchall()
+        for i, response in enumerate(responses, 1):
+            export_data.append({'Name': participant_name(email), 'Email': email,
+                                'Assessment_Timestamp': format_timestamp(timestamp), 'Question_Number': i,
+                                'Question_Text': response['question'], 'Leadership_Style': response['style'],
+                                'User_Answer': response['answer'],
+                                'Calculated_Score': value_map.get(str(response['answer']), 0),
+                                'Survey_Completed': 'Yes' if surveys else 'No'})
+        for i, survey in enumerate(surveys, 1):
+            export_data.append({'Name': participant_name(email), 'Email': email,
+                                'Assessment_Timestamp': format_timestamp(timestamp), 'Question_Number': f'SURVEY-{i}',
+                                'Question_Text': survey['question'], 'Leadership_Style': 'Survey',
+                                'User_Answer': survey['answer'], 'Calculated_Score': 'N/A', 'Survey_Completed': 'Yes'})
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=export_data[0].keys())
+    writer.writeheader()
+    writer.writerows(export_data)
+    output.seek(0)
+    return len(io.BytesIO(output.read().encode('utf-8')).getvalue())
+
+
+def streamed_export(conn):
+    import export
+    return sum(len(chunk.encode('utf-8')) for chunk in export.iter_csv(conn))
+
+
+def measure(func, conn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = func(conn)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=25000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        os.environ['DB_FILE'] = path
+        from seed import seed_database
+        import db
+        print(f"seeding {args.sessions} sessions ({args.sessions * 40} answers)...")
+        seed_database(path, args.sessions)
+        conn = db.connect(path)
+        print(f"{'export':<10}{'CSV MB':>9}{'seconds':>9}{'peak heap MB':>14}")
+        for name, func in (('old', old_export), ('streamed', streamed_export)):
+            size, elapsed, peak = measure(func, conn)
+            print(f"{name:<10}{size / 2 ** 20:>9.1f}{elapsed:>9.1f}{peak / 2 ** 20:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# Bulk import throughput. Seeds a source database of N sessions (40 answers and 8 summary
+# rows each, 11 survey answers for half of them) plus its CSV export, then loads them
+# into an empty database: one submission at a time as the web form does ("per session"),
+# with bulk_import.py keeping every index up to date ("bulk, indexes kept"), with its
+# indexes and search triggers deferred ("bulk, deferred"), from the CSV, and then the
+# same database and its CSV export a second time, when every session is a duplicate.
+# Exits non-zero if a second load adds any sessions.
+#
+#   python benchmarks/bench_import.py [--sessions 20000] [--batch-rows 50000]
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def per_session(source, target):
+    # Same rows through the storage calls a submission makes, one transaction each
+    import bulk_import
+    import db
+    import migrate
+    conn = db.connect(target)
+    migrate.upgrade(conn, verbose=False)
+    sessions = rows = 0
+    for record in bulk_import.read_database(source):
+        rows += len(record[-1])
+        with db.transaction(conn):
+            if record[0] == 'session':
+                db.insert_assessment(conn, record[1], record[2], record[4], record[3])
+                sessions += 1
+            elif record[0] == 'summary':
+                conn.executemany(db.INSERT_SUMMARY, [(record[1], record[2], *row) for row in record[3]])
+            else:
+                conn.executemany(db.INSERT_SURVEY, [(record[1], *row) for row in record[2]])
+    conn.close()
+    return sessions, rows
+
+
+def bulk(source, target, batch_rows, defer, archive_dir):
+    import bulk_import
+    import contextlib
+    import db
+    import migrate
+    conn = db.connect(target)
+    conn.execute(f'PRAGMA cache_size=-{bulk_import.IMPORT_CACHE_MB * 1024}')
+    migrate.upgrade(conn, verbose=False)
+    importer = bulk_import.Importer(conn, archive_dir=archive_dir, batch_rows=batch_rows)
+    with bulk_import.deferred(conn, target) if defer else contextlib.nullcontext():
+        importer.load(bulk_import.read_source(source))
+    importer.close()
+    conn.close()
+    return importer.stats['sessions'], importer.stats['rows']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20000)
+    parser.add_argument('--batch-rows', type=int, default=50000)
+    args = parser.parse_args()
+    from seed import seed_database
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source.db')
+        csv_source = os.path.join(tmp, 'source.csv')
+        archive_dir = os.path.join(tmp, 'archive')
+        seed_database(source, args.sessions)
+        import db
+        import export
+        conn = db.connect(source)
+        with open(csv_source, 'w', newline='') as f:
+            for chunk in export.iter_csv(conn):
+                f.write(chunk)
+        conn.close()
+
+        runs = [
+            ('per session', lambda target: per_session(source, target), 'a'),
+            ('bulk, indexes kept', lambda target: bulk(source, target, args.batch_rows, False, archive_dir), 'b'),
+            ('bulk, deferred', lambda target: bulk(source, target, args.batch_rows, True, archive_dir), 'c'),
+            ('bulk from CSV', lambda target: bulk(csv_source, target, args.batch_rows, True, archive_dir), 'd'),
+            ('again (duplicates)', lambda target: bulk(source, target, args.batch_rows, True, archive_dir), 'c'),
+            # The CSV has the same sessions to the minute only
+            ('CSV after database', lambda target: bulk(csv_source, target, args.batch_rows, True, archive_dir), 'c'),
+            ('database after CSV', lambda target: bulk(source, target, args.batch_rows, True, archive_dir), 'd'),
+        ]
+        print(f"{'load':<20}{'sessions':>10}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'target MB':>11}")
+        failed = False
+        loaded = set()
+        for label, load, name in runs:
+            target = os.path.join(tmp, f'{name}.db')
+            start = time.perf_counter()
+            sessions, rows = load(target)
+            seconds = time.perf_counter() - start
+            print(f"{label:<20}{sessions:>10}{rows:>10}{seconds:>10.1f}{rows / seconds:>12,.0f}{os.path.getsize(target) / 1e6:>11.1f}")
+            failed = failed or (name in loaded and sessions != 0)
+            loaded.add(name)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# Per-request cost of drawing a participant's question set from the precomputed
+# style index, against the old per-style DataFrame filter + random.sample.
+#
+#   python benchmarks/bench_question_sets.py [--sizes 240 10000 100000]
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from question_bank import QuestionBank, STYLE_NUM_TO_NAME
+
+
+def synthetic_bank(size):
+    questions = tuple((f"Synthetic question {i}", i % len(STYLE_NUM_TO_NAME) + 1) for i in range(size))
+    return QuestionBank('synthetic', questions, (), {})
+
+
+def old_sampling(df):
+    selected = []
+    for style in df['Style_Num'].unique():
+        selected.extend(random.sample(df[df['Style_Num'] == style]['Question'].tolist(), 5))
+    random.shuffle(selected)
+    return selected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[240, 10000, 100000])
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+    print(f"{'questions':>10}{'index build ms':>16}{'draw us':>10}{'pandas us':>12}")
+    for size in args.sizes:
+        build_s = timeit.timeit(lambda: synthetic_bank(size), number=1)
+        bank = synthetic_bank(size)
+        seeds = iter(range(10 ** 9))
+        draw_s = timeit.timeit(lambda: bank.question_texts(bank.draw_question_set(next(seeds))), number=args.number)
+        old = ''
+        if pd is not None:
+            df = pd.DataFrame(list(bank.questions), columns=['Question', 'Style_Num'])
+            number = max(1, args.number // 20)
+            old = f"{timeit.timeit(lambda: old_sampling(df), number=number) / number * 1e6:.1f}"
+        print(f"{size:>10}{build_s * 1000:>16.1f}{draw_s / args.number * 1e6:>10.1f}{old:>12}")
+
+
+if __name__ == '__main__':
+    main()
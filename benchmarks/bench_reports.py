@@ -0,0 +1,75 @@
+# Batch report throughput. Seeds N sessions, then renders every participant's report as
+# HTML and as PDF: in one process with no chart cache, as /results would chart them one
+# request at a time ("serial"), with reports.py's process pool on --workers processes
+# and an empty chart cache ("pool, cold"), and again once the cache holds every chart
+# ("pool, warm").
+#
+#   python benchmarks/bench_reports.py [--sessions 1000] [--workers <cores>]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def serial(store, fmt, directory):
+    # Same output, each chart rendered anew
+    import charts
+    import reports
+    items = list(reports.iter_items(store))
+    for item in items:
+        chart_path = os.path.join(directory, f"chart-{item['id']}.{reports.CHART_FORMATS[fmt]}")
+        with open(chart_path, 'wb') as f:
+            f.write(charts.render_chart(item['scores'], reports.CHART_FORMATS[fmt]))
+        path = os.path.join(directory, reports.report_name(item, fmt))
+        if fmt == 'html':
+            reports._render_html(path, item, chart_path)
+        else:
+            reports._render_pdf(path, item, chart_path)
+    return len(items), len(items)
+
+
+def pool(store, fmt, workers):
+    import reports
+    job_id = reports.create_job({}, fmt)
+    job = reports.run_job(job_id, store, {}, fmt, workers)
+    assert job['state'] == 'done', job
+    return job['done'], job['charts_rendered']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    from seed import seed_database
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        seed_database(path, args.sessions)
+        import reports
+        import storage
+        reports.REPORT_DIR = os.path.join(tmp, 'reports')
+        store = storage.SQLiteStorage(path)
+        print(f"{'format':<8}{'run':<14}{'workers':>8}{'reports':>9}{'charts':>8}{'seconds':>9}{'reports/s':>11}")
+        for fmt in reports.REPORT_FORMATS:
+            shutil.rmtree(reports.REPORT_DIR, ignore_errors=True)
+            directory = os.path.join(tmp, 'serial')
+            os.makedirs(directory, exist_ok=True)
+            runs = [('serial', 1, lambda: serial(store, fmt, directory)),
+                    ('pool, cold', args.workers, lambda: pool(store, fmt, args.workers)),
+                    ('pool, warm', args.workers, lambda: pool(store, fmt, args.workers))]
+            for label, workers, run in runs:
+                start = time.perf_counter()
+                count, rendered = run()
+                seconds = time.perf_counter() - start
+                print(f"{fmt:<8}{label:<14}{workers:>8}{count:>9}{rendered:>8}{seconds:>9.1f}{count / seconds:>11.1f}")
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
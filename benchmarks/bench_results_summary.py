@@ -0,0 +1,93 @@
+# Per-request cost of building the results summary: the old path filtered the
+# ScoreBasedResponse DataFrame once per style (after re-reading the sheet, which is
+# left out here to isolate the lookups) and rebuilt the text blocks; the new path is
+# results_summary.build_summary() over the bank's precompiled description index.
+# Also times the whole /results request through the Flask test client.
+#
+#   python benchmarks/bench_results_summary.py [--requests 200]
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import question_bank
+import results_summary
+
+
+def old_build(response_df, scores):
+    style_summaries = []
+    for style in question_bank.STYLES:
+        score = scores[style]
+        if 5 <= score <= 10:
+            tendency = 'High'
+        elif 0 <= score <= 4:
+            tendency = 'Moderate'
+        else:
+            tendency = 'Low'
+        match = response_df[(response_df['Leadership Style'] == style) & (response_df['Tendency'] == tendency)]
+        description = match.iloc[0]['Description'] if not match.empty else f"No description found for {style} ({tendency})"
+        style_summaries.append({'style': style, 'tendency': tendency, 'description': description})
+    return {'intro_paragraph': str(results_summary.INTRO_PARAGRAPH),
+            'tendency_explanations': dict(results_summary.TENDENCY_EXPLANATIONS),
+            'style_summaries': style_summaries}
+
+
+def latencies(func, inputs):
+    times = []
+    for value in inputs:
+        start = time.perf_counter()
+        func(value)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    import pandas as pd
+    bank = question_bank.get_bank()
+    response_df = pd.DataFrame([(style, tendency, description) for (style, tendency), description in bank.descriptions.items()],
+                               columns=['Leadership Style', 'Tendency', 'Description'])
+    rng = random.Random(0)
+    inputs = [{style: rng.randint(-10, 10) for style in question_bank.STYLES} for _ in range(args.requests)]
+    assert old_build(response_df, inputs[0]) == results_summary.build_summary(bank, inputs[0])
+
+    print(f"{'summary build':<30} {'p50 us':>10} {'p99 us':>10}")
+    for name, func in [('DataFrame filters (old)', lambda s: old_build(response_df, s)),
+                       ('build_summary', lambda s: results_summary.build_summary(bank, s))]:
+        p50, p99 = latencies(func, inputs)
+        print(f"{name:<30} {p50 * 1e6:>10.1f} {p99 * 1e6:>10.1f}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DB_FILE'] = os.path.join(tmp, 'bench.db')
+        os.environ['SESSION_DB_FILE'] = os.path.join(tmp, 'sessions.db')
+        import app
+        import db
+        app.init_db()
+        client = app.app.test_client()
+        questions = bank.question_texts(bank.draw_question_set(1))
+        assessment_ids = [db.save_assessment(f'bench.{i}@example.com', '2024-01-01 09:00:00',
+                                             [(bank.question_to_style[q], q, rng.randint(1, 5)) for q in questions])
+                          for i in range(args.requests)]
+
+        def request(assessment_id):
+            with client.session_transaction() as s:
+                s['email'] = 'bench@example.com'
+                s['assessment_id'] = assessment_id
+                s['summary_pending'] = True
+            assert client.get('/results').status_code == 200
+        request(assessment_ids[0])
+        p50, p99 = latencies(request, assessment_ids)
+        print(f"{'GET /results (whole request)':<30} {p50 * 1e6:>10.1f} {p99 * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
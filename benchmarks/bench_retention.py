@@ -0,0 +1,103 @@
+# Effect of retention on the live database. Seeds N sessions (7 minutes apart from
+# 2024-01-01, so 20,000 span about three months) with every tenth participant's summary
+# written twice, then archives all but the newest --keep-days of them, dedupes summary
+# rows and compacts. Reports the live database's size before and after, the archives'
+# compressed and decompressed sizes, how long each step took, and the latency of one
+# search page served live, from an archived month decompressed on demand, and from one
+# already in the cache.
+#
+#   python benchmarks/bench_retention.py [--sessions 20000] [--keep-days 14]
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def size_mb(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path)) / 1e6
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20000)
+    parser.add_argument('--keep-days', type=int, default=14)
+    args = parser.parse_args()
+    from seed import seed_database, use_database
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        directory = os.path.join(tmp, 'archive')
+        seed_database(path, args.sessions)
+        use_database(path)
+        import db
+        import retention
+        import search
+        conn = db.connect(path)
+        with db.transaction(conn):
+            conn.execute('''
+                INSERT INTO summary_results (email, timestamp, style, score, tendency, description)
+                SELECT email, timestamp, style, score, tendency, description FROM summary_results WHERE id % 80 < 8
+            ''')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        before_size = size_mb(path)
+        newest = conn.execute('SELECT MAX(timestamp) FROM assessment_sessions').fetchone()[0]
+        cutoff = (datetime.date.fromisoformat(newest[:10]) - datetime.timedelta(days=args.keep_days)).isoformat()
+
+        deduped, dedupe_time = timed(lambda: retention.dedupe_summaries(conn))
+        archived, archive_time = timed(lambda: retention.archive_sessions(conn, cutoff, directory))
+        _, vacuum_time = timed(lambda: retention.compact(conn, full=True))
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        live = conn.execute('SELECT COUNT(*) FROM assessment_sessions').fetchone()[0]
+
+        months = retention.months(directory)
+        compressed = size_mb(*(retention.archive_path(month, directory) for month in months))
+        cold = warm = None
+        decompressed = 0.0
+        cache = os.path.join(directory, 'cache')
+        if months:
+            (_, cold), (_, warm) = [timed(lambda: retention.open_archive(months[0], directory).close()) for _ in range(2)]
+            decompressed = size_mb(*(os.path.join(cache, name) for name in os.listdir(cache)))
+            for month in months[1:]:
+                retention.open_archive(month, directory).close()
+            decompressed = max(decompressed, size_mb(*(os.path.join(cache, name) for name in os.listdir(cache))))
+
+        print(f"{'sessions':>9}{'archived':>10}{'months':>8}{'deduped':>9}{'live MB':>9}{'after MB':>10}"
+              f"{'archive MB':>12}{'unpacked MB':>13}")
+        print(f"{args.sessions:>9}{args.sessions - live:>10}{len(months):>8}{deduped:>9}{before_size:>9.1f}"
+              f"{size_mb(path):>10.1f}{compressed:>12.1f}{decompressed:>13.1f}")
+        print()
+        print(f"{'dedupe s':>9}{'archive s':>10}{'vacuum s':>10}{'open cold ms':>14}{'open warm ms':>14}")
+        opens = f"{cold * 1000:>14.1f}{warm * 1000:>14.1f}" if months else f"{'-':>14}{'-':>14}"
+        print(f"{dedupe_time:>9.2f}{archive_time:>10.2f}{vacuum_time:>10.2f}{opens}")
+        print()
+        if not months:
+            # Fewer sessions than span --keep-days (7 minutes apart: about 2,900 for 14 days)
+            print(f"Nothing is older than {cutoff}, so no month was archived; skipping the archive timings. "
+                  f"Use more --sessions or fewer --keep-days.")
+            return
+
+        # One page of the style + tendency filter, live and from the newest archived month
+        criteria = {'style': 'Democratic', 'tendency': 'High'}
+        _, live_search = timed(lambda: search.search_sessions(conn, **criteria))
+        archive_dir_cache = [os.path.join(cache, name) for name in os.listdir(cache)]
+        for name in archive_dir_cache:
+            os.remove(name)
+        sources = lambda: retention.archive_connections(before=(cutoff, 0), directory=directory)
+        _, cold_search = timed(lambda: search.search_sources(sources(), **criteria))
+        _, warm_search = timed(lambda: search.search_sources(sources(), **criteria))
+        print(f"{'search live ms':>15}{'archive cold ms':>17}{'archive warm ms':>17}")
+        print(f"{live_search * 1000:>15.1f}{cold_search * 1000:>17.1f}{warm_search * 1000:>17.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Micro-benchmarks for scoring.py: one submission through the old per-answer dict loop
+# and through score_submission(), an (N x 40) batch through the loop and through the
+# vectorized score_batch(), and a full rescore of a synthetic database.
+#
+#   python benchmarks/bench_scoring.py [--batch 100000] [--sessions 20000]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+from seed import seed_database
+import db
+import question_bank
+import scoring
+
+
+def old_score(responses, question_style_map):
+    # What results() used to do for one submission
+    value_map = {'1': -2, '2': -1, '3': 0, '4': 1, '5': 2}
+    style_scores = {style: [] for style in question_bank.STYLES}
+    for question, answer in responses.items():
+        style = question_style_map.get(question)
+        if style and answer:
+            style_scores[style].append(value_map.get(str(answer), 0))
+    results = {style: sum(scores) for style, scores in style_scores.items()}
+    tendencies = {}
+    for style, score in results.items():
+        if 5 <= score <= 10:
+            tendencies[style] = 'High'
+        elif 0 <= score <= 4:
+            tendencies[style] = 'Moderate'
+        else:
+            tendencies[style] = 'Low'
+    return results, tendencies
+
+
+def new_score(responses, question_style_map):
+    return scoring.summarize(scoring.score_submission(responses, question_style_map))
+
+
+def per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=100000, help='sessions in the in-memory batch')
+    parser.add_argument('--sessions', type=int, default=20000, help='sessions in the database rescore')
+    args = parser.parse_args()
+    bank = question_bank.get_bank()
+    rng = random.Random(0)
+    questions = bank.question_texts(bank.draw_question_set(1))
+    responses = {q: str(rng.randint(1, 5)) for q in questions}
+    assert {s: sc for s, sc, _ in new_score(responses, bank.question_to_style)} == old_score(responses, bank.question_to_style)[0]
+
+    print(f"{'single submission':<28} {'us/call':>10}")
+    print(f"{'  dict loop (old)':<28} {per_call(lambda: old_score(responses, bank.question_to_style), 2000) * 1e6:>10.1f}")
+    print(f"{'  score_submission':<28} {per_call(lambda: new_score(responses, bank.question_to_style), 2000) * 1e6:>10.1f}")
+
+    # Batch: every session answers the same 40 question slots, styles as a shared row
+    styles = np.array([scoring.STYLE_COLUMNS[bank.question_to_style[q]] for q in questions], dtype=np.int8)
+    answers = np.random.default_rng(0).integers(1, 6, size=(args.batch, len(questions)), dtype=np.int8)
+    sample = 2000
+    loop_rows = [{q: str(a) for q, a in zip(questions, row)} for row in answers[:sample].tolist()]
+    start = time.perf_counter()
+    for row in loop_rows:
+        old_score(row, bank.question_to_style)
+    loop_rate = sample / (time.perf_counter() - start)
+    start = time.perf_counter()
+    scores, tendencies = scoring.score_batch(answers, styles)
+    batch_seconds = time.perf_counter() - start
+    expected = old_score(loop_rows[0], bank.question_to_style)[0]
+    assert scores[0].tolist() == [expected[s] for s in question_bank.STYLES]
+    print(f"\n{'batch of %d x %d' % answers.shape:<28} {'sessions/s':>10}")
+    print(f"{'  dict loop (old)':<28} {loop_rate:>10.0f}")
+    print(f"{'  score_batch':<28} {args.batch / batch_seconds:>10.0f}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        seed_database(path, args.sessions, survey_ratio=0)
+        conn = db.connect(path)
+        start = time.perf_counter()
+        session_ids, answers, styles = scoring.load_answer_matrix(conn)
+        loaded = time.perf_counter()
+        scoring.score_batch(answers, styles)
+        scored = time.perf_counter()
+        conn.close()
+    print(f"\nrescore {args.sessions} stored sessions: load {loaded - start:.2f}s, score {(scored - loaded) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# /admin/search query latency against synthetic databases. "LIKE scan" is the
+# unindexed way to answer the same text query (substring match over every email and
+# survey answer); the other columns time search.search_sessions() for a participant
+# term, a rare survey comment term, a comment term in about half of all surveys, a
+# style + tendency filter and the rare term within a date range.
+#
+#   python benchmarks/bench_search.py [--sessions 1000 10000 50000]
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def like_scan(conn, term):
+    pattern = f"%{term}%"
+    return conn.execute('''
+        SELECT s.id FROM assessment_sessions s
+        WHERE s.email LIKE ? OR s.email IN (SELECT email FROM survey_results WHERE answer LIKE ?)
+        ORDER BY s.timestamp DESC, s.id DESC
+        LIMIT 50
+    ''', (pattern, pattern)).fetchall()
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DB_FILE'] = os.path.join(tmp, 'empty.db')
+        from seed import seed_database
+        import db
+        import search
+        print(f"{'sessions':>9}{'answers':>10}{'LIKE scan ms':>14}{'email ms':>10}{'rare ms':>9}{'common ms':>11}"
+              f"{'style ms':>10}{'dated ms':>10}")
+        for sessions in args.sessions:
+            path = os.path.join(tmp, f"bench_{sessions}.db")
+            seed_database(path, sessions)
+            conn = db.connect(path)
+            # A few distinctive comments, indexed by the insert trigger like any other
+            with db.transaction(conn):
+                conn.executemany(db.INSERT_SURVEY, [(f"participant.{i}@example.com", 'Any other comments?',
+                                                     'The quokka exercise was memorable')
+                                                    for i in range(0, sessions, max(sessions // 20, 1))])
+            answers = conn.execute('SELECT COUNT(*) FROM assessment_answers').fetchone()[0]
+            participant = f"participant.{sessions // 2}"
+            scan = timed(lambda: like_scan(conn, participant), args.repeat)
+            email = timed(lambda: search.search_sessions(conn, participant), args.repeat)
+            rare = timed(lambda: search.search_sessions(conn, 'quokka'), args.repeat)
+            common = timed(lambda: search.search_sessions(conn, 'recommend'), args.repeat)
+            style = timed(lambda: search.search_sessions(conn, style='Transformational', tendency='High'), args.repeat)
+            dated = timed(lambda: search.search_sessions(conn, 'quokka', start='2024-02-01', end='2024-03-01'),
+                          args.repeat)
+            print(f"{sessions:>9}{answers:>10}{scan:>14.2f}{email:>10.2f}{rare:>9.2f}{common:>11.2f}"
+                  f"{style:>10.2f}{dated:>10.2f}")
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
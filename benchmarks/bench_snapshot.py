@@ -0,0 +1,128 @@
+# Submission latency while an admin exports. One process submits assessments back to
+# back (40 answers, 8 summary rows, 11 survey answers each) while another streams the
+# full CSV export in a loop: from nothing ("idle"), the live database ("live"), or the
+# snapshot ("snapshot", with a refresher copying the database every --interval seconds
+# meanwhile). Also reports the live database's largest WAL (an open export stops
+# checkpoints from recycling it) and how long one snapshot refresh takes.
+#
+#   python benchmarks/bench_snapshot.py [--sessions 20000] [--seconds 10] [--interval 5]
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ANSWERS = [('Democratic', f"Question {i}", str(i % 5 + 1)) for i in range(40)]
+SUMMARY = [('Democratic', 3, 'Moderate', 'Description text ' * 20)] * 8
+SURVEY = [(f"Survey question {i}", 'Some free text answer') for i in range(11)]
+
+
+def submitter(path, seconds, results):
+    import db
+    from seed import use_database
+    use_database(path)
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    i = 0
+    while time.perf_counter() < deadline:
+        email, timestamp = f"live{i}@example.com", '2025-06-01 09:00:00'
+        start = time.perf_counter()
+        db.save_assessment(email, timestamp, ANSWERS)
+        db.save_summary(email, timestamp, SUMMARY)
+        db.save_survey(email, SURVEY)
+        latencies.append(time.perf_counter() - start)
+        i += 1
+    results.put(latencies)
+
+
+def exporter(mode, path, snapshot_path, stop, results):
+    import db
+    import export
+    import snapshot
+    exported = 0
+    while not stop.is_set():
+        # A fresh connection per pass picks up the newest snapshot
+        conn = db.connect(path) if mode == 'live' else snapshot.connect(snapshot_path)
+        try:
+            for chunk in export.iter_csv(conn):
+                exported += len(chunk)
+                if stop.is_set():
+                    break
+        finally:
+            conn.close()
+    results.put(('exported', exported))
+
+
+def refresher(path, snapshot_path, interval, stop, results):
+    import snapshot
+    durations = []
+    while not stop.wait(interval):
+        durations.append(snapshot.refresh(path, snapshot_path))
+    results.put(('refreshes', durations))
+
+
+def wal_watcher(path, stop, results):
+    # Largest the live database's WAL grows; a reader held open blocks checkpoints
+    largest = 0
+    while not stop.wait(0.05):
+        try:
+            largest = max(largest, os.path.getsize(path + '-wal'))
+        except FileNotFoundError:
+            pass
+    results.put(('wal', largest))
+
+
+def run(mode, path, snapshot_path, seconds, interval):
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    helpers = [(wal_watcher, (path, stop, results))]
+    if mode != 'idle':
+        helpers.append((exporter, (mode, path, snapshot_path, stop, results)))
+    if mode == 'snapshot':
+        helpers.append((refresher, (path, snapshot_path, interval, stop, results)))
+    processes = [multiprocessing.Process(target=target, args=args) for target, args in helpers]
+    for process in processes:
+        process.start()
+    # Let the export get going before measuring
+    time.sleep(0.5)
+    writer = multiprocessing.Process(target=submitter, args=(path, seconds, results))
+    writer.start()
+    latencies = sorted(results.get())
+    writer.join()
+    stop.set()
+    found = dict(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    refreshes = found.get('refreshes')
+    refresh = f"{sum(refreshes) / len(refreshes):.2f}" if refreshes else '-'
+    export_rate = found.get('exported', 0) / (seconds + 0.5) / 1e6
+    print(f"{mode:<10}{len(latencies) / seconds:>14.1f}{percentile(0.5):>9.1f}{percentile(0.95):>9.1f}"
+          f"{percentile(0.99):>9.1f}{latencies[-1] * 1000:>9.1f}{export_rate:>12.1f}{found['wal'] / 1e6:>10.1f}{refresh:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=5, help='snapshot refresh interval in seconds')
+    args = parser.parse_args()
+    from seed import seed_database
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        snapshot_path = os.path.join(tmp, 'bench.snapshot.db')
+        seed_database(path, args.sessions)
+        import snapshot
+        snapshot.refresh(path, snapshot_path)
+        print(f"{'export':<10}{'submissions/s':>14}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'export MB/s':>12}{'WAL MB':>10}{'refresh s':>11}")
+        for mode in ('idle', 'live', 'snapshot'):
+            run(mode, path, snapshot_path, args.seconds, args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# Compares cold-start cost of the old question loading path (two pandas parses of
+# the workbook at import) against loading the precompiled question bank snapshot.
+#
+#   python benchmarks/bench_startup.py [--runs 5]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import question_bank
+
+# What importing app.py used to do, against the bundled workbook so the network is left out
+OLD_PATH = f'''
+import time; t = time.perf_counter()
+import pandas as pd
+path = {question_bank.BUNDLED_WORKBOOK!r}
+df = pd.read_excel(path, sheet_name=None, engine='openpyxl')
+questions = df['Questions']['Question'].tolist()
+styles = pd.read_excel(path, sheet_name='Questions', engine='openpyxl')
+print(time.perf_counter() - t)
+'''
+
+NEW_PATH = f'''
+import time; t = time.perf_counter()
+import sys
+sys.path.insert(0, {ROOT!r})
+import question_bank
+bank = question_bank.get_bank()
+elapsed = time.perf_counter() - t
+assert 'pandas' not in sys.modules and 'openpyxl' not in sys.modules
+print(elapsed)
+'''
+
+
+def run(code, env):
+    out = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'question_bank.snapshot')
+        question_bank.build_snapshot(question_bank.BUNDLED_WORKBOOK, snapshot)
+        env = dict(os.environ, QUESTION_BANK_SNAPSHOT=snapshot, QUESTION_BANK_SOURCE=question_bank.BUNDLED_WORKBOOK)
+        old = [run(OLD_PATH, env) for _ in range(args.runs)]
+        new = [run(NEW_PATH, env) for _ in range(args.runs)]
+    print(f"{'path':<22}{'median ms':>12}{'min ms':>10}")
+    for name, times in (('pandas read_excel x2', old), ('snapshot load', new)):
+        print(f"{name:<22}{statistics.median(times) * 1000:>12.1f}{min(times) * 1000:>10.1f}")
+    print(f"speedup: {statistics.median(old) / statistics.median(new):.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# Storage backends side by side. First a conformance pass: the same submissions and
+# dashboard reads against each backend, with every result compared to SQLite's. Then
+# submissions/s and p95 latency with N threads writing at once, as a threaded worker
+# does at the end of a cohort session, checking the dashboard totals and the pool's
+# open connections afterwards. PostgreSQL runs with --dsn, in a scratch schema that is
+# dropped afterwards, or with --local-postgres, which starts a throwaway server from the
+# pgserver package. Exits non-zero if any check fails.
+#
+#   python benchmarks/bench_storage.py [--dsn postgresql://localhost/bench | --local-postgres] [--threads 1 8 32] [--submissions 100]
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ANSWERS = [(['Democratic', 'Coaching', 'Visionary', 'Pacesetting'][i % 4], f"Question {i}", str(i % 5 + 1)) for i in range(40)]
+SUMMARY = [('Democratic', 3, 'Moderate', 'Description text ' * 20)] * 8
+SURVEY = [(f"Survey question {i}", 'Some free text answer') for i in range(11)]
+
+
+def plain(value):
+    # Rows from either driver as plain dicts and lists; database-assigned row ids differ
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items() if key != 'id'}
+    if hasattr(value, 'keys'):
+        return {key: plain(value[key]) for key in value.keys() if key != 'id'}
+    return value
+
+
+def conformance(store):
+    # Operation name -> result
+    results = {}
+    for i in range(6):
+        email = f"user{i % 3}@example.com"
+        timestamp = f"2025-01-0{i + 1} 09:00:00"
+        store.save_assessment(email, timestamp, ANSWERS[i:] + [('Unknown', 'Unscored question', 'n/a')], 'north' if i % 2 else '')
+        store.save_summary(email, timestamp, SUMMARY[:i + 1])
+        if i % 2:
+            store.save_survey(email, SURVEY)
+    # Appending to an existing session rescores it
+    store.save_assessment('user0@example.com', '2025-01-01 09:00:00', ANSWERS[:4])
+    session_id = store.find_session('user0@example.com', '2025-01-01 09:00:00')
+    results['find_session'] = store.find_session('user1@example.com', '2025-01-02 09:00:00') is not None
+    results['find_session missing'] = store.find_session('nobody@example.com', '2025-01-01 09:00:00')
+    results['session_scores'] = plain(store.session_scores(session_id))
+    first, older = store.session_page(4)
+    results['session_page'] = [plain(first), older]
+    results['session_page before'] = plain(store.session_page(4, before=(first[-1]['timestamp'], first[-1]['id'])))
+    results['session_page after'] = plain(store.session_page(2, after=(first[-1]['timestamp'], first[-1]['id'])))
+    results['session_page filtered'] = plain(store.session_page(10, email='user1@example.com', start='2025-01-02', end='2025-01-06'))
+    results['session_page cohort'] = plain(store.session_page(10, cohort='north'))
+    results['session_details'] = plain(store.session_details(store.find_session('user1@example.com', '2025-01-02 09:00:00')))
+    results['participant_details'] = plain(store.participant_details('user1@example.com'))
+    results['dashboard_stats'] = plain(store.dashboard_stats())
+    with store.batch() as batch:
+        batch.set_journal_offset('segment-a', 10)
+    with store.batch() as batch:
+        batch.set_journal_offset('segment-a', 25)
+    results['journal_offset'] = store.journal_offset('segment-a')
+    store.forget_segment('segment-a')
+    results['forget_segment'] = store.journal_offset('segment-a')
+    return results
+
+
+def throughput(store, threads, submissions):
+    latencies = []
+    lock = threading.Lock()
+
+    def writer(thread_id):
+        own = []
+        for i in range(submissions):
+            email, timestamp = f"load{thread_id}.{i}@example.com", '2025-02-01 09:00:00'
+            start = time.perf_counter()
+            store.save_assessment(email, timestamp, ANSWERS)
+            store.save_summary(email, timestamp, SUMMARY)
+            store.save_survey(email, SURVEY)
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=writer, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return threads * submissions / elapsed, latencies[int(len(latencies) * 0.95) - 1] * 1000
+
+
+def check_totals(store, threads, submissions):
+    # Every writer used its own emails: one session, participant and surveyed session each
+    expected = threads * submissions
+    stats = store.dashboard_stats()
+    return all(stats[total] == expected for total in ('total_assessments', 'unique_users', 'total_surveys'))
+
+
+def sqlite_storage(tmp):
+    import storage
+    return storage.SQLiteStorage(os.path.join(tmp, 'bench.db'))
+
+
+def postgres_storage(dsn, schema, pool_size):
+    import psycopg
+    import storage
+    # Every pooled connection sees only the scratch schema
+    return storage.PostgresStorage(psycopg.conninfo.make_conninfo(dsn, options=f'-c search_path={schema}'), pool_size)
+
+
+def setup(admin, name, make, schema, tmp, label):
+    # A fresh database (SQLite) or schema (PostgreSQL) per run
+    if name == 'postgres':
+        admin.execute(f"CREATE SCHEMA {schema}_{label}")
+    else:
+        os.makedirs(os.path.join(tmp, label))
+    store = make(label)
+    store.setup()
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', help='PostgreSQL database to benchmark against (a scratch schema is created in it)')
+    parser.add_argument('--local-postgres', action='store_true',
+                        help='start a throwaway PostgreSQL server (pip install pgserver) instead of --dsn')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--submissions', type=int, default=100, help='per thread')
+    parser.add_argument('--pool-size', type=int, default=8)
+    args = parser.parse_args()
+    os.environ.setdefault('METRICS', '0')
+
+    server = None
+    if args.local_postgres:
+        import pgserver
+        # Outside the temporary directory: the server may run as its own system user
+        server = pgserver.get_server(tempfile.mkdtemp(prefix='bench_storage_pg_'), cleanup_mode='delete')
+        args.dsn = server.get_uri()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        schema = f"bench_storage_{os.getpid()}"
+        admin = None
+        backends = [('sqlite', lambda name: sqlite_storage(os.path.join(tmp, name)))]
+        if args.dsn:
+            import psycopg
+            admin = psycopg.connect(args.dsn, autocommit=True)
+            backends.append(('postgres', lambda name: postgres_storage(args.dsn, f"{schema}_{name}", args.pool_size)))
+        try:
+            outcomes = {}
+            for name, make in backends:
+                outcomes[name] = conformance(setup(admin, name, make, schema, tmp, 'conformance'))
+            reference = outcomes['sqlite']
+            print(f"{'operation':<24}" + ''.join(f"{name:>10}" for name in outcomes))
+            for operation in reference:
+                same = [results[operation] == reference[operation] for results in outcomes.values()]
+                failed = failed or not all(same)
+                print(f"{operation:<24}" + ''.join(f"{'ok' if ok else 'DIFFERS':>10}" for ok in same))
+
+            print()
+            print(f"{'backend':<10}{'threads':>8}{'submissions/s':>15}{'p95 ms':>10}{'totals':>8}{'open conns':>12}")
+            for name, make in backends:
+                for threads in args.threads:
+                    store = setup(admin, name, make, schema, tmp, f"load{threads}")
+                    rate, p95 = throughput(store, threads, args.submissions)
+                    totals = check_totals(store, threads, args.submissions)
+                    # The pool never opens more than --pool-size connections, however many threads write
+                    opened = store.pool.stats()['open'] if name == 'postgres' else None
+                    failed = failed or not totals or (opened is not None and opened > args.pool_size)
+                    print(f"{name:<10}{threads:>8}{rate:>15.1f}{p95:>10.1f}{'ok' if totals else 'WRONG':>8}"
+                          f"{'-' if opened is None else opened:>12}")
+        finally:
+            if admin is not None:
+                for (nspname,) in admin.execute("SELECT nspname FROM pg_namespace WHERE nspname LIKE %s", (schema + "%",)).fetchall():
+                    admin.execute(f"DROP SCHEMA {nspname} CASCADE")
+                admin.close()
+            if server is not None:
+                server.cleanup()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# Submissions/sec with several worker processes writing at once, as gunicorn
+# workers do at the end of a cohort session. Each submission is 40 answers,
+# 8 summary rows and 11 survey answers. "legacy" replays the old per-row
+# inserts on a fresh connection per route; "batched" uses db.py; "journal" appends to
+# the write-behind journal and lets each worker's writer thread apply batches (p95 is
+# the request-side latency; submissions/s includes draining the queue).
+#
+#   python benchmarks/bench_submissions.py [--workers 8] [--submissions 200]
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ANSWERS = [('Democratic', f"Question {i}", str(i % 5 + 1)) for i in range(40)]
+SUMMARY = [('Democratic', 3, 'Moderate', 'Description text ' * 20)] * 8
+SURVEY = [(f"Survey question {i}", 'Some free text answer') for i in range(11)]
+
+
+def legacy_submit(path, email, now):
+    with sqlite3.connect(path) as conn:
+        for style, question, answer in ANSWERS:
+            conn.execute('INSERT INTO assessment_results (email, timestamp, style, question, answer) VALUES (?, ?, ?, ?, ?)',
+                         (email, now, style, question, answer))
+        conn.commit()
+    with sqlite3.connect(path) as conn:
+        for style, score, tendency, description in SUMMARY:
+            conn.execute('INSERT INTO summary_results (email, timestamp, style, score, tendency, description) VALUES (?, ?, ?, ?, ?, ?)',
+                         (email, now, style, score, tendency, description))
+        conn.commit()
+    with sqlite3.connect(path) as conn:
+        for question, answer in SURVEY:
+            conn.execute('INSERT INTO survey_results (email, question, answer) VALUES (?, ?, ?)', (email, question, answer))
+        conn.commit()
+
+
+def batched_submit(path, email, now):
+    import db
+    db.save_assessment(email, now, ANSWERS)
+    db.save_summary(email, now, SUMMARY)
+    db.save_survey(email, SURVEY)
+
+
+def journal_submit(path, email, now):
+    import write_behind
+    write_behind.submit_assessment(email, now, ANSWERS)
+    write_behind.submit_summary(email, now, SUMMARY)
+    write_behind.submit_survey(email, SURVEY)
+
+
+def worker(args):
+    mode, path, worker_id, submissions = args
+    import db
+    import write_behind
+    # Forked workers inherit db imported by the parent, so point it at the scratch file explicitly
+    db.DB_FILE = path
+    write_behind._journal.directory = os.path.join(os.path.dirname(path), 'journal')
+    submit = {'legacy': legacy_submit, 'batched': batched_submit, 'journal': journal_submit}[mode]
+    latencies, locked = [], 0
+    for i in range(submissions):
+        start = time.perf_counter()
+        try:
+            submit(path, f"user{worker_id}.{i}@example.com", '2025-01-01 09:00:00')
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+        latencies.append(time.perf_counter() - start)
+    while mode == 'journal' and write_behind.stats()['depth']:
+        time.sleep(0.005)
+    return latencies, locked
+
+
+def run(mode, workers, submissions):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        import db
+        import migrate
+        migrate.upgrade(db.connect(path))
+        start = time.perf_counter()
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(worker, [(mode, path, w, submissions) for w in range(workers)])
+        elapsed = time.perf_counter() - start
+    latencies = sorted(l for worker_latencies, _ in results for l in worker_latencies)
+    locked = sum(l for _, l in results)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+    print(f"{mode:<8}{workers * submissions / elapsed:>14.1f}{p95:>10.1f}{locked:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--submissions', type=int, default=200, help='per worker')
+    parser.add_argument('--mode', choices=['legacy', 'batched', 'journal', 'all'], default='all')
+    args = parser.parse_args()
+    print(f"{'mode':<8}{'submissions/s':>14}{'p95 ms':>10}{'locked':>8}")
+    for mode in (['legacy', 'batched', 'journal'] if args.mode == 'all' else [args.mode]):
+        run(mode, args.workers, args.submissions)
+
+
+if __name__ == '__main__':
+    main()
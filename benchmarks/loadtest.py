@@ -0,0 +1,345 @@
+# Load test of the full participant flow: / -> /instructions -> /assessment (GET, POST)
+# -> /results (+ chart) -> /survey (GET, POST), for N participants with C of them in
+# flight at once. Runs against the app in-process through Flask test clients, or over
+# HTTP against a local gunicorn it starts (or any --url). Everything lives in a scratch
+# directory with a generated stand-in question workbook, so the repo's data and the
+# network are left alone. Reports p50/p95/p99 per route, throughput and peak RSS, and
+# writes them as JSON for comparing commits (--compare an earlier file).
+#
+#   python benchmarks/loadtest.py [--participants 200] [--concurrency 20] [--mode client|gunicorn]
+#                                 [--workers 4] [--url http://host:port] [--output loadtest.json]
+#                                 [--compare baseline.json]
+import argparse
+import concurrent.futures
+import datetime
+import html
+import http.client
+import http.cookies
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUESTION_PATTERN = re.compile(r'<input type="radio" name="([^"]+)" value="1"')
+CHART_PATTERN = re.compile(r'<img src="(/chart/[^"]+)"')
+SURVEY_ANSWERS = {'survey_0': 'Clear', 'survey_1': 'Helpful', 'survey_2': 'No', 'survey_3': 'About Right',
+                  'survey_5': 'Useful exercise, would recommend.'}
+
+
+def write_standin_workbook(path, per_style=20, survey_questions=11):
+    # Same sheets and columns as the real workbook, with synthetic text
+    from openpyxl import Workbook
+    from question_bank import STYLE_NUM_TO_NAME, TENDENCIES
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = 'Questions'
+    sheet.append(['Question', 'Style_Num'])
+    for style_num in STYLE_NUM_TO_NAME:
+        for i in range(per_style):
+            sheet.append([f"Stand-in question {i + 1} for style {style_num}", style_num])
+    sheet = workbook.create_sheet('SurveyQuestions')
+    sheet.append(['Question'])
+    for i in range(survey_questions):
+        sheet.append([f"Stand-in survey question {i + 1}"])
+    sheet = workbook.create_sheet('ScoreBasedResponse')
+    sheet.append(['Leadership Style', 'Tendency', 'Description'])
+    for style in STYLE_NUM_TO_NAME.values():
+        for tendency in TENDENCIES:
+            sheet.append([style, tendency, f"Stand-in description of a {tendency.lower()} {style} tendency. " * 4])
+    workbook.save(path)
+
+
+def scratch_environment(directory):
+    return {
+        'DB_FILE': os.path.join(directory, 'responses.db'),
+        'SESSION_DB_FILE': os.path.join(directory, 'sessions.db'),
+        'WRITE_BEHIND_DIR': os.path.join(directory, 'journal'),
+        'QUESTION_BANK_SOURCE': os.path.join(directory, 'questions.xlsx'),
+        'QUESTION_BANK_SNAPSHOT': os.path.join(directory, 'question_bank.snapshot'),
+    }
+
+
+class FlaskClient:
+    # In-process: one Flask test client (and so one cookie jar) per participant
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data().decode('utf-8', 'replace')
+
+
+class HttpClient:
+    # One keep-alive connection and session cookie per participant; redirects are not
+    # followed, so every hop is timed as its own route
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+        self.cookies = http.cookies.SimpleCookie()
+
+    def request(self, method, path, data=None):
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f"{key}={morsel.value}" for key, morsel in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        text = response.read().decode('utf-8', 'replace')
+        for header in response.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(header)
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+        return response.status, text
+
+
+def participant(client, number, think_time, rng):
+    # Runs one participant through the flow; returns [(route, seconds, ok)]
+    timings = []
+
+    def step(route, method, path, data=None, expect=(200,)):
+        start = time.perf_counter()
+        try:
+            status, body = client.request(method, path, data)
+        except Exception:
+            timings.append((route, time.perf_counter() - start, False))
+            raise
+        timings.append((route, time.perf_counter() - start, status in expect))
+        if think_time:
+            time.sleep(rng.uniform(0, 2 * think_time))
+        return body
+
+    email = f"load.{number}@example.com"
+    try:
+        step('GET /', 'GET', '/')
+        step('POST /', 'POST', '/', {'name': f"Load {number}", 'identifier': email}, expect=(302,))
+        step('GET /instructions', 'GET', '/instructions')
+        step('POST /instructions', 'POST', '/instructions', {'email': email}, expect=(302,))
+        page = step('GET /assessment', 'GET', '/assessment')
+        questions = [html.unescape(q) for q in QUESTION_PATTERN.findall(page)]
+        step('POST /assessment', 'POST', '/assessment', {q: str(rng.randint(1, 5)) for q in questions}, expect=(302,))
+        page = step('GET /results', 'GET', '/results')
+        chart = CHART_PATTERN.search(page)
+        if chart:
+            step('GET /chart/<key>.png', 'GET', html.unescape(chart.group(1)))
+        step('GET /survey', 'GET', '/survey')
+        step('POST /survey', 'POST', '/survey', SURVEY_ANSWERS, expect=(302,))
+    except Exception:
+        pass
+    return timings
+
+
+def _process_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+class RssSampler:
+    # Peak combined RSS of a server process and its workers, sampled every interval
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            total = sum(_process_rss_kb(pid) for pid in [self.pid] + _children(self.pid))
+            self.peak_kb = max(self.peak_kb, total)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak_kb
+
+
+def start_gunicorn(env, workers, port):
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', f'127.0.0.1:{port}', 'app:app']
+    server = subprocess.Popen(command, cwd=ROOT, env={**os.environ, **env},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited: {server.stderr.read().decode()[-2000:]}")
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/admin/login')
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start within 60s')
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(timings, elapsed, participants):
+    routes = {}
+    for route, seconds, ok in timings:
+        entry = routes.setdefault(route, {'times': [], 'errors': 0})
+        entry['times'].append(seconds)
+        entry['errors'] += not ok
+    report = {}
+    for route, entry in routes.items():
+        times = sorted(entry['times'])
+        report[route] = {
+            'count': len(times),
+            'errors': entry['errors'],
+            'mean_ms': round(statistics.fmean(times) * 1000, 3),
+            'p50_ms': round(percentile(times, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(times, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(times, 0.99) * 1000, 3),
+        }
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'participants_per_s': round(participants / elapsed, 2),
+        'requests_per_s': round(len(timings) / elapsed, 2),
+        'errors': sum(entry['errors'] for entry in report.values()),
+        'routes': report,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result, baseline=None):
+    print(f"{result['participants']} participants, concurrency {result['concurrency']}, mode {result['mode']}: "
+          f"{result['participants_per_s']} participants/s, {result['requests_per_s']} requests/s, "
+          f"peak RSS {result['peak_rss_mb']} MB, {result['errors']} errors")
+    header = f"{'route':<24}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}"
+    if baseline:
+        header += f"{'p95 vs base':>13}"
+    print(header)
+    for route, stats in result['routes'].items():
+        line = f"{route:<24}{stats['count']:>7}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['errors']:>8}"
+        base = baseline['routes'].get(route) if baseline else None
+        if base and base['p95_ms']:
+            line += f"{(stats['p95_ms'] / base['p95_ms'] - 1) * 100:>+12.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--participants', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--mode', choices=['client', 'gunicorn'], default='client')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--url', help='load an already running server instead of starting one')
+    parser.add_argument('--think-ms', type=float, default=0, help='mean pause between steps')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadtest.json')
+    parser.add_argument('--compare', help='earlier JSON result to compare p95s against')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    env = scratch_environment(directory)
+    server = sampler = None
+    try:
+        if not args.url and args.mode == 'client':
+            # The app reads its configuration at import (question_bank included, which the
+            # workbook generator imports), and writes its log to the cwd
+            os.environ.update(env)
+            os.chdir(directory)
+        write_standin_workbook(env['QUESTION_BANK_SOURCE'])
+        if args.url:
+            mode = 'http'
+            make_client = lambda: HttpClient(args.url)
+        elif args.mode == 'gunicorn':
+            mode = 'gunicorn'
+            server = start_gunicorn(env, args.workers, args.port)
+            sampler = RssSampler(server.pid)
+            make_client = lambda: HttpClient(f'http://127.0.0.1:{args.port}')
+        else:
+            mode = 'client'
+            import app
+            make_client = lambda: FlaskClient(app.app)
+
+        def run(number):
+            return participant(make_client(), number, args.think_ms / 1000, random.Random(args.seed * 1000003 + number))
+
+        start = time.perf_counter()
+        timings = []
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+            for participant_timings in pool.map(run, range(args.participants)):
+                timings.extend(participant_timings)
+        elapsed = time.perf_counter() - start
+    finally:
+        if sampler:
+            peak_kb = sampler.stop()
+        if server:
+            server.terminate()
+            server.wait()
+        os.chdir(ROOT)
+        shutil.rmtree(directory, ignore_errors=True)
+    if mode == 'client':
+        # Harness and app share the process, so this includes the load generator itself
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elif mode == 'http':
+        # Not our process to measure
+        peak_kb = None
+
+    result = {
+        'commit': git_commit(),
+        'recorded_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'mode': mode,
+        'participants': args.participants,
+        'concurrency': args.concurrency,
+        'workers': args.workers if mode == 'gunicorn' else None,
+        'think_ms': args.think_ms,
+        'peak_rss_mb': round(peak_kb / 1024, 1) if peak_kb is not None else None,
+        **summarize(timings, elapsed, args.participants),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# Synthetic data for the benchmarks: N sessions of 40 answers, 8 summary rows and
+# (for survey_ratio of them) 11 survey answers, written in large transactions.
+import datetime
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import migrate
+import question_bank
+
+SURVEY_ANSWERS = ['Very clear', 'Helpful', 'No', 'About Right', 'Relevant', 'Useful exercise, would recommend.']
+
+
+def seed_database(path, sessions, survey_ratio=0.5, batch=500, seed=0):
+    rng = random.Random(seed)
+    bank = question_bank.get_bank()
+    conn = db.connect(path)
+    migrate.upgrade(conn)
+    start = datetime.datetime(2024, 1, 1, 9, 0, 0)
+    for first in range(0, sessions, batch):
+        with db.transaction(conn):
+            for i in range(first, min(first + batch, sessions)):
+                email = f"participant.{i}@example.com"
+                # Seconds as the app stores them, which a CSV export drops
+                timestamp = (start + datetime.timedelta(minutes=7 * i, seconds=i % 60)).isoformat(sep=' ')
+                question_ids = bank.draw_question_set(rng.getrandbits(32))
+                answers = [(bank.question_to_style[q], q, rng.randint(1, 5)) for q in bank.question_texts(question_ids)]
+                db.insert_assessment(conn, email, timestamp, answers)
+                conn.executemany(db.INSERT_SUMMARY, [(email, timestamp, style, 0, 'Moderate', 'Synthetic')
+                                                     for style in question_bank.STYLES])
+                if rng.random() < survey_ratio:
+                    conn.executemany(db.INSERT_SURVEY, [(email, q, rng.choice(SURVEY_ANSWERS))
+                                                        for q in bank.survey_questions])
+    conn.close()
+
+
+def use_database(path):
+    # Point db.py (and therefore the app) at another file from inside this process
+    db.DB_FILE = path
+    db._local.conn = None
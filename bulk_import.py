@@ -0,0 +1,476 @@
+import argparse
+import collections
+import contextlib
+import csv
+import datetime
+import fcntl
+import itertools
+import os
+import sqlite3
+import time
+import urllib.parse
+
+import db
+import export
+import migrate
+import question_bank
+import retention
+
+# Source rows (answers, summary rows, survey answers) written per transaction. Large
+# batches amortize the commit and the per-batch summary/analytics pass; each one still
+# holds the write lock only briefly, so a running app keeps accepting submissions.
+IMPORT_BATCH_ROWS = int(os.environ.get('IMPORT_BATCH_ROWS', '50000'))
+# Page cache for the loading connection, which also speeds up recreating the indexes
+IMPORT_CACHE_MB = int(os.environ.get('IMPORT_CACHE_MB', '256'))
+
+# Formats the CSV export has written Assessment_Timestamp in
+CSV_TIMESTAMP_FORMATS = ('%m-%d-%Y %I:%M%p',)
+
+# Secondary indexes and the full-text search triggers on the tables a load fills. Each
+# would otherwise be updated row by row; dropping them for the load and recreating them
+# (and rebuilding the search index) at the end is one sorted pass each. The dashboard,
+# search and exports read through them, so they are only dropped while nothing serves
+# the database (see serving_lock_path). The unique
+# (email, timestamp) index on sessions and the email indexes on summary and survey rows
+# stay, since deduplication looks rows up through them, and so do the dashboard counter
+# triggers, which are a few indexed lookups per row.
+DEFERRED_SCHEMA_QUERY = '''
+    SELECT name, type, sql FROM sqlite_master
+    WHERE sql IS NOT NULL
+      AND ((type = 'index' AND tbl_name IN ('assessment_sessions', 'session_summary'))
+           OR (type = 'trigger' AND tbl_name IN ('assessment_sessions', 'survey_results')
+               AND name NOT GLOB 'dashboard_stats_*'))
+'''
+SEARCH_INDEXES = ('participant_search', 'survey_search')
+
+INSERT_SESSION = 'INSERT INTO assessment_sessions (id, email, timestamp, cohort, revision) VALUES (?, ?, ?, ?, ?)'
+SUMMARY_EXISTS = 'SELECT 1 FROM summary_results WHERE email = ? AND timestamp = ? LIMIT 1'
+# A CSV export drops the seconds, so its sessions are stored to the minute. Where one side
+# has no seconds, sessions are matched by the minute, whichever format was loaded first:
+# each of the participant's sessions in that minute accounts for one source session.
+COUNT_SESSIONS_MINUTE = 'SELECT COUNT(*) FROM assessment_sessions WHERE email = ? AND substr(timestamp, 1, 16) = ?'
+MINUTE_LENGTH = len('2025-04-20 16:12')
+
+
+# Deferred indexes and triggers
+
+def lock_path(path=None):
+    return (path or db.DB_FILE) + '.import.lock'
+
+
+def serving_lock_path(path=None):
+    # Held shared by every process serving the database and exclusively by a load that
+    # defers its indexes, so neither runs while the other does
+    return (path or db.DB_FILE) + '.serving.lock'
+
+
+_serving_locks = {}
+
+
+def hold_serving_lock(path=None):
+    # Taken by SQLiteStorage.setup() and kept until the process exits. A load with its
+    # indexes dropped is waited out, so the app never serves without them.
+    path = serving_lock_path(path)
+    if path in _serving_locks:
+        return
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f"Waiting for the bulk import holding {path} to recreate its indexes")
+        fcntl.flock(lock, fcntl.LOCK_SH)
+    _serving_locks[path] = lock
+
+
+def serving(path=None):
+    # Whether some process is serving the database
+    with open(serving_lock_path(path), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        return False
+
+
+def defer_schema(conn):
+    # Drops the deferred indexes and triggers, remembering them in deferred_schema
+    with db.transaction(conn):
+        deferred = conn.execute(DEFERRED_SCHEMA_QUERY).fetchall()
+        for name, kind, sql in deferred:
+            conn.execute('INSERT OR REPLACE INTO deferred_schema (name, type, sql) VALUES (?, ?, ?)', (name, kind, sql))
+            conn.execute(f'DROP {kind} {name}')
+    return len(deferred)
+
+
+def restore_schema(conn):
+    # Recreates whatever defer_schema dropped; the search indexes are rebuilt from their
+    # tables first, since rows written meanwhile never went through the triggers
+    with db.transaction(conn):
+        deferred = conn.execute('SELECT name, type, sql FROM deferred_schema').fetchall()
+        if any(kind == 'trigger' for _, kind, _ in deferred):
+            for index in SEARCH_INDEXES:
+                conn.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+        for name, kind, sql in deferred:
+            if not conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (name,)).fetchone():
+                conn.execute(sql)
+        conn.execute('DELETE FROM deferred_schema')
+    return len(deferred)
+
+
+def recover(conn, path=None):
+    # Restores indexes left dropped by a load that died. A load still running holds
+    # the lock file and is left alone. -> objects recreated
+    if not conn.execute('SELECT EXISTS (SELECT 1 FROM deferred_schema)').fetchone()[0]:
+        return 0
+    with open(lock_path(path), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        return restore_schema(conn)
+
+
+# Sources. Each yields records, the last field of which holds the source rows:
+#   ('session', email, timestamp, cohort, [(style, question, answer), ...])
+#   ('summary', email, timestamp, [(style, score, tendency, description), ...])
+#   ('survey', email, [(question, answer), ...])
+# timestamp is None where the source has none and stops at the minute ('2025-04-20 16:12')
+# where the source has no seconds; style is None where it is unknown.
+
+def parse_timestamp(text):
+    # Export timestamps ('04-20-2025 04:12PM') back to the stored form, to the minute;
+    # None if unparseable
+    for fmt in CSV_TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).isoformat(sep=' ', timespec='minutes')
+        except ValueError:
+            pass
+    try:
+        return datetime.datetime.fromisoformat(text).isoformat(sep=' ')
+    except ValueError:
+        return None
+
+
+def read_csv(path):
+    # The comprehensive CSV from /admin/export. Rows come grouped by session with
+    # answers numbered from 1, followed by the participant's survey answers; the
+    # timestamp only has minute precision, so a new session is also recognized by its
+    # numbering starting over.
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None or header == ['No data available']:
+            return
+        if header != export.CSV_COLUMNS:
+            raise ValueError(f"{path} is not an assessment export (header {header[:3]}...)")
+        current, answers, last_number = None, [], 0
+        for _, email, timestamp, number, question, style, answer, _, _ in reader:
+            if number.startswith('SURVEY-'):
+                yield 'survey', email, [(question, answer)]
+                last_number = float('inf')
+                continue
+            number = int(number)
+            if (email, timestamp) != current or number <= last_number:
+                if answers:
+                    yield 'session', current[0], parse_timestamp(current[1]), '', answers
+                current, answers = (email, timestamp), []
+            answers.append((None if style == 'Unknown' else style, question, answer))
+            last_number = number
+        if answers:
+            yield 'session', current[0], parse_timestamp(current[1]), '', answers
+
+
+def _columns(src, table):
+    return {row[1] for row in src.execute(f'PRAGMA table_info({table})')}
+
+
+def _legacy_sessions(rows):
+    # assessment_results rows (email, timestamp, style, question, answer) in id order.
+    # Rows written together share email and timestamp; app_db.py wrote no timestamp, so
+    # there a session ends where the participant's next one starts repeating questions.
+    for (email, timestamp), group in itertools.groupby(rows, key=lambda row: (row[0] or '', row[1])):
+        answers, questions = [], set()
+        for _, _, style, question, answer in group:
+            if timestamp is None and question in questions:
+                yield 'session', email, None, '', answers
+                answers, questions = [], set()
+            answers.append((style, question, answer))
+            questions.add(question)
+        yield 'session', email, timestamp, '', answers
+
+
+def read_database(path):
+    # Another deployment's responses.db, at any schema version down to app_db.py's
+    src = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro", uri=True)
+    try:
+        tables = {row[0] for row in src.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        legacy_after = 0
+        if 'assessment_sessions' in tables:
+            cohort = 's.cohort' if 'cohort' in _columns(src, 'assessment_sessions') else "''"
+            rows = src.execute(f'''
+                SELECT s.id, s.email, s.timestamp, {cohort}, st.name, q.text, a.answer
+                FROM assessment_sessions s
+                JOIN assessment_answers a ON a.session_id = s.id
+                JOIN questions q ON q.id = a.question_id
+                LEFT JOIN styles st ON st.id = q.style_id
+                ORDER BY s.id, a.position
+            ''')
+            for (_, email, timestamp, cohort), group in itertools.groupby(rows, key=lambda row: row[:4]):
+                yield 'session', email, timestamp, cohort, [row[4:] for row in group]
+            # Legacy rows the source's own backfill had not reached yet
+            if 'migration_state' in tables:
+                row = src.execute('SELECT value FROM migration_state WHERE key = ?', (migrate.BACKFILL_KEY,)).fetchone()
+                legacy_after = row[0] if row else 0
+        if 'assessment_results' in tables:
+            columns = _columns(src, 'assessment_results')
+            yield from _legacy_sessions(src.execute(f'''
+                SELECT email, {'timestamp' if 'timestamp' in columns else 'NULL'}, {'style' if 'style' in columns else 'NULL'},
+                       question, answer
+                FROM assessment_results
+                WHERE id > ?
+                ORDER BY id
+            ''', (legacy_after,)))
+        if 'summary_results' in tables:
+            rows = src.execute('SELECT email, timestamp, style, score, tendency, description FROM summary_results ORDER BY id')
+            for (email, timestamp), group in itertools.groupby(rows, key=lambda row: row[:2]):
+                yield 'summary', email or '', timestamp, [row[2:] for row in group]
+        if 'survey_results' in tables:
+            rows = src.execute('SELECT email, question, answer FROM survey_results ORDER BY id')
+            for email, group in itertools.groupby(rows, key=lambda row: row[0]):
+                yield 'survey', email or '', [row[1:] for row in group]
+    finally:
+        src.close()
+
+
+def read_source(path):
+    if path.lower().endswith('.csv'):
+        return read_csv(path)
+    with open(path, 'rb') as f:
+        if f.read(16) != b'SQLite format 3\x00':
+            raise ValueError(f"{path} is neither a CSV export nor an SQLite database")
+    return read_database(path)
+
+
+# Loading
+
+class Importer:
+    # Writes records into the live schema in batches of IMPORT_BATCH_ROWS source rows.
+    # A session whose (email, timestamp) is already stored, live or in an archived month,
+    # is skipped (matched by the minute where one side has no seconds), as is a summary set whose (email, timestamp) already has rows and a
+    # survey answer the participant already gave; loading the same source twice adds
+    # nothing the second time.
+    def __init__(self, conn, cohort=None, undated=None, archive_dir=None, batch_rows=IMPORT_BATCH_ROWS):
+        self.conn = conn
+        # Cohort for every imported session; None keeps the source's ('' if it has none)
+        self.cohort = None if cohort is None else question_bank.normalize_cohort(cohort)
+        # Base timestamp for sessions without one (legacy rows, 'Unknown' in a CSV): the
+        # participant's n-th such session gets it plus n seconds. None skips them.
+        self.undated = undated
+        self.undated_counts = collections.Counter()
+        self.batch_rows = batch_rows
+        self.archive_dir = archive_dir
+        self.archived_months = set(retention.months(archive_dir))
+        self.archives = {}
+        self.styles = {}
+        # (email, minute) -> stored sessions already matched by minute to a source session
+        self.minute_matches = collections.Counter()
+        self.stats = collections.Counter()
+
+    def close(self):
+        for archive in self.archives.values():
+            archive.close()
+        self.archives.clear()
+
+    def _style(self, cohort, style, question):
+        # The source's style when it names one, else the cohort's question bank's
+        if style in db.STYLE_IDS:
+            return style
+        mapping = self.styles.get(cohort)
+        if mapping is None:
+            try:
+                mapping = question_bank.get_bank(cohort).question_to_style
+            except question_bank.UnknownCohort:
+                mapping = question_bank.get_bank().question_to_style
+            self.styles[cohort] = mapping
+        return mapping.get(question) or mapping.get((question or '').strip())
+
+    def _timestamp(self, email, timestamp):
+        if timestamp is not None or self.undated is None:
+            return timestamp
+        count = self.undated_counts[email]
+        self.undated_counts[email] += 1
+        return (self.undated + datetime.timedelta(seconds=count)).isoformat(sep=' ')
+
+    def _archived(self, key, query=db.SELECT_SESSION):
+        # First column of the query's row in key's archived month; None if there is none
+        month = key[1][:7]
+        if month not in self.archived_months:
+            return None
+        archive = self.archives.get(month)
+        if archive is None:
+            archive = self.archives[month] = retention.open_archive(month, self.archive_dir)
+        row = archive.execute(query, key).fetchone()
+        return row[0] if row else None
+
+    def _exists(self, conn, key, seen_sessions):
+        return key in seen_sessions or conn.execute(db.SELECT_SESSION, key).fetchone() is not None \
+            or self._archived(key) is not None
+
+    def _duplicate(self, conn, key, seen_sessions, seen_minutes):
+        # -> the stats counter a stored session (email, timestamp) is skipped under, or None
+        # if it is new. A timestamp with seconds is only matched by the minute against a
+        # session stored without them, so distinct sessions within a minute stay distinct.
+        if self._exists(conn, key, seen_sessions):
+            # Without seconds, one loaded earlier in this batch is another session in the
+            # same minute, which the stored timestamp cannot tell apart
+            return 'same_minute_sessions' if key in seen_sessions and len(key[1]) == MINUTE_LENGTH else 'duplicate_sessions'
+        minute = (key[0], key[1][:MINUTE_LENGTH])
+        if len(key[1]) == MINUTE_LENGTH:
+            candidates = conn.execute(COUNT_SESSIONS_MINUTE, minute).fetchone()[0] \
+                + (self._archived(minute, COUNT_SESSIONS_MINUTE) or 0) + seen_minutes[minute]
+        else:
+            candidates = int(self._exists(conn, minute, seen_sessions))
+        if self.minute_matches[minute] >= candidates:
+            return None
+        self.minute_matches[minute] += 1
+        return 'minute_matched_sessions'
+
+    def _write(self, records):
+        conn, stats = self.conn, self.stats
+        with db.transaction(conn):
+            # Ids are handed out here, under the write lock, so the batch's sessions form
+            # one range that the summary and analytics passes below can select by
+            first_id = next_id = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM assessment_sessions').fetchone()[0]
+            sessions, answers, summaries, surveys = [], [], [], {}
+            seen_sessions, seen_minutes, seen_summaries = set(), collections.Counter(), set()
+            for record in records:
+                if record[0] == 'session':
+                    _, email, timestamp, cohort, rows = record
+                    email = email or ''
+                    cohort = self.cohort if self.cohort is not None else question_bank.normalize_cohort(cohort)
+                    timestamp = self._timestamp(email, timestamp)
+                    if timestamp is None:
+                        stats['undated_answers'] += len(rows)
+                        continue
+                    skipped = self._duplicate(conn, (email, timestamp), seen_sessions, seen_minutes)
+                    if skipped:
+                        stats[skipped] += 1
+                        continue
+                    seen_sessions.add((email, timestamp))
+                    seen_minutes[email, timestamp[:MINUTE_LENGTH]] += 1
+                    sessions.append((next_id, email, timestamp, cohort))
+                    answers.extend((next_id, position, db.question_id(conn, question, self._style(cohort, style, question)),
+                                    db._answer_value(answer))
+                                   for position, (style, question, answer) in enumerate(rows, 1))
+                    next_id += 1
+                elif record[0] == 'summary':
+                    _, email, timestamp, rows = record
+                    key = (email, timestamp)
+                    if timestamp is None or key in seen_summaries or conn.execute(SUMMARY_EXISTS, key).fetchone():
+                        stats['duplicate_summaries'] += len(rows)
+                        continue
+                    seen_summaries.add(key)
+                    summaries.extend((email, timestamp, *row) for row in rows)
+                else:
+                    surveys.setdefault(record[1], []).extend(record[2])
+            if sessions:
+                first_revision = db.next_revisions(conn, len(sessions))
+                conn.executemany(INSERT_SESSION, [(*session, first_revision + number) for number, session in enumerate(sessions)])
+            conn.executemany(db.INSERT_ANSWER, answers)
+            if sessions:
+                db.refresh_session_summaries(conn, first_id, next_id - 1)
+                db.add_daily_stats(conn, first_id, next_id - 1)
+            conn.executemany(db.INSERT_SUMMARY, summaries)
+            new_surveys = []
+            for email, rows in surveys.items():
+                given = {tuple(row) for row in conn.execute('SELECT question, answer FROM survey_results WHERE email = ?', (email,))}
+                for question, answer in rows:
+                    if (question, answer) in given:
+                        stats['duplicate_surveys'] += 1
+                    else:
+                        given.add((question, answer))
+                        new_surveys.append((email, question, answer))
+            conn.executemany(db.INSERT_SURVEY, new_surveys)
+        stats['sessions'] += len(sessions)
+        stats['answers'] += len(answers)
+        stats['summaries'] += len(summaries)
+        stats['surveys'] += len(new_surveys)
+
+    def load(self, records):
+        batch, rows = [], 0
+        for record in records:
+            batch.append(record)
+            rows += len(record[-1])
+            if rows >= self.batch_rows:
+                self._write(batch)
+                self.stats['rows'] += rows
+                batch, rows = [], 0
+        if batch:
+            self._write(batch)
+            self.stats['rows'] += rows
+        return self.stats
+
+
+def _report(label, stats, seconds):
+    print(f"{label}: {stats['rows']} rows in {seconds:.1f}s ({stats['rows'] / max(seconds, 1e-9):,.0f} rows/s); "
+          f"added {stats['sessions']} sessions, {stats['answers']} answers, {stats['summaries']} summary rows, "
+          f"{stats['surveys']} survey answers; skipped {stats['duplicate_sessions']} duplicate sessions, "
+          f"{stats['minute_matched_sessions']} sessions matching a stored one by the minute, "
+          f"{stats['duplicate_summaries']} duplicate summary rows, {stats['duplicate_surveys']} duplicate survey answers"
+          + (f", {stats['undated_answers']} answers without a timestamp" if stats['undated_answers'] else '')
+          + (f", {stats['same_minute_sessions']} sessions sharing a timestamp without seconds with another in the source"
+             if stats['same_minute_sessions'] else ''))
+
+
+@contextlib.contextmanager
+def deferred(conn, path=None):
+    # Holds the import lock with the deferred indexes dropped, and the serving lock so the
+    # app does not start on the database meanwhile
+    with open(lock_path(path), 'w') as lock, open(serving_lock_path(path), 'a') as serving_lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f"Another import into {path or db.DB_FILE} is running")
+        try:
+            fcntl.flock(serving_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f"{path or db.DB_FILE} is being served; stop the app or load with --no-defer")
+        restore_schema(conn)
+        defer_schema(conn)
+        try:
+            yield
+        finally:
+            restore_schema(conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load CSV exports and other responses.db files')
+    parser.add_argument('sources', nargs='+', help='CSV files from /admin/export or SQLite databases')
+    parser.add_argument('--db', default=db.DB_FILE)
+    parser.add_argument('--cohort', help="put every imported session in this cohort ('' for the default)")
+    parser.add_argument('--undated-timestamp', type=datetime.datetime.fromisoformat,
+                        help='import sessions without a timestamp at this time instead of skipping them')
+    parser.add_argument('--batch-rows', type=int, default=IMPORT_BATCH_ROWS)
+    parser.add_argument('--archive-dir', default=retention.ARCHIVE_DIR)
+    parser.add_argument('--no-defer', action='store_true', help='keep indexes and search triggers during the load')
+    args = parser.parse_args()
+    conn = db.connect(args.db)
+    conn.execute(f'PRAGMA cache_size=-{IMPORT_CACHE_MB * 1024}')
+    migrate.upgrade(conn)
+    importer = Importer(conn, args.cohort, args.undated_timestamp, args.archive_dir, args.batch_rows)
+    if not args.no_defer and serving(args.db):
+        print(f"{args.db} is being served, so its indexes are kept during the load; stop the app to load faster")
+        args.no_defer = True
+    started = time.perf_counter()
+    try:
+        with contextlib.nullcontext() if args.no_defer else deferred(conn, args.db):
+            for source in args.sources:
+                before = importer.stats.copy()
+                start = time.perf_counter()
+                importer.load(read_source(source))
+                _report(source, importer.stats - before, time.perf_counter() - start)
+    finally:
+        importer.close()
+    # Includes recreating the deferred indexes
+    if len(args.sources) > 1 or not args.no_defer:
+        _report('Total', importer.stats, time.perf_counter() - started)
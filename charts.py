@@ -0,0 +1,92 @@
+import collections
+import io
+import os
+import struct
+import threading
+
+import metrics
+import scoring
+from question_bank import QUESTIONS_PER_STYLE, STYLES
+
+# Bump when the chart's look changes so cached URLs and ETags roll over
+CHART_VERSION = 1
+# Rendered images kept per worker; each is ~40 KB of PNG or ~30 KB of SVG
+CHART_CACHE_SIZE = int(os.environ.get('CHART_CACHE_SIZE', '256'))
+# Largest score a style reaches on one question set: QUESTIONS_PER_STYLE answers at +-2
+# each. A session with appended answers can go past it; its bars are drawn at the limit.
+MAX_SCORE = QUESTIONS_PER_STYLE * max(scoring.ANSWER_SCORES.values())
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def chart_scores(scores):
+    # The scores as charted: each clamped to +-MAX_SCORE
+    return tuple(max(-MAX_SCORE, min(MAX_SCORE, score)) for score in scores)
+
+
+def chart_key(scores):
+    # The key is the score vector itself (one signed byte per style), so any worker can
+    # render a URL it has never seen and identical results share one cached image
+    return f"v{CHART_VERSION}-" + struct.pack(f'{len(scores)}b', *chart_scores(scores)).hex()
+
+
+def scores_from_key(key):
+    prefix = f"v{CHART_VERSION}-"
+    if not key.startswith(prefix):
+        return None
+    try:
+        data = bytes.fromhex(key[len(prefix):])
+    except ValueError:
+        return None
+    if len(data) != len(STYLES):
+        return None
+    scores = struct.unpack(f'{len(data)}b', data)
+    # Only keys chart_key() produces, spelled the way it spells them, so
+    # made-up URLs cannot fill the cache with charts no participant will ask for
+    if any(abs(score) > MAX_SCORE for score in scores) or key != chart_key(scores):
+        return None
+    return scores
+
+
+def render_chart(scores, fmt='png'):
+    # Object-oriented Figure + Agg canvas: no pyplot global state, safe across threads
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(10, 5))
+    ax = fig.add_subplot()
+    x = range(len(STYLES))
+    ax.bar(x, chart_scores(scores), align='center', color='skyblue')
+    ax.set_title('Leadership Style Assessment Results', pad=20)
+    ax.set_ylabel('Tendency Level')
+    ax.set_xticks(x, STYLES, rotation=45, ha='right')
+    ax.set_yticks([-10, 0, 10], ['Low Tendency', 'Moderate', 'High Tendency'])
+    ax.grid(True, axis='y', linestyle='--', alpha=0.7)
+    ax.axhline(y=0, color='gray', linestyle='-', alpha=0.3)
+    fig.tight_layout()
+    img = io.BytesIO()
+    fig.savefig(img, format=fmt, bbox_inches='tight')
+    return img.getvalue()
+
+
+def get_chart(scores, fmt='png'):
+    # LRU-cached render of the chart for a score vector
+    cache_key = (chart_scores(scores), fmt)
+    with _cache_lock:
+        data = _cache.get(cache_key)
+        if data is not None:
+            _cache.move_to_end(cache_key)
+            return data
+    with metrics.span('chart.render'):
+        data = render_chart(scores, fmt)
+    with _cache_lock:
+        _cache[cache_key] = data
+        _cache.move_to_end(cache_key)
+        while len(_cache) > CHART_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return data
+
+
+def inline_svg(scores):
+    # SVG markup for embedding directly in the page, without the XML prolog
+    svg = get_chart(scores, 'svg').decode('utf-8')
+    return svg[svg.index('<svg'):]
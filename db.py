@@ -0,0 +1,512 @@
+import contextlib
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+import scoring
+from question_bank import STYLE_NUM_TO_NAME
+
+DB_FILE = os.environ.get('DB_FILE', 'responses.db')
+# How long a writer waits for the lock before failing with "database is locked"
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '10000'))
+# NORMAL is durable across application crashes in WAL mode; FULL also survives power loss
+SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+
+INSERT_SESSION = 'INSERT OR IGNORE INTO assessment_sessions (email, timestamp, cohort) VALUES (?, ?, ?)'
+SELECT_SESSION = 'SELECT id FROM assessment_sessions WHERE email = ? AND timestamp = ?'
+INSERT_ANSWER = 'INSERT INTO assessment_answers (session_id, position, question_id, answer) VALUES (?, ?, ?, ?)'
+INSERT_SUMMARY = 'INSERT INTO summary_results (email, timestamp, style, score, tendency, description) VALUES (?, ?, ?, ?, ?, ?)'
+INSERT_SURVEY = 'INSERT INTO survey_results (email, question, answer) VALUES (?, ?, ?)'
+BUMP_COUNTER = ('INSERT INTO counters (name, value) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value')
+
+STYLE_IDS = {name: num for num, name in STYLE_NUM_TO_NAME.items()}
+
+_local = threading.local()
+
+
+class Cursor(sqlite3.Cursor):
+    # Times each statement and counts the rows it changes or returns (see metrics.py)
+    label = None
+
+    def _observe(self, sql, start):
+        self.label = metrics.statement_label(sql)
+        metrics.QUERY_DURATION.observe(time.perf_counter() - start, self.label)
+        if self.rowcount > 0:
+            metrics.QUERY_ROWS.inc(self.rowcount, self.label)
+
+    def _count(self, rows):
+        if self.label is not None and rows:
+            metrics.QUERY_ROWS.inc(rows, self.label)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self._observe(sql, start)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._observe(sql, start)
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        self._count(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self._count(1)
+        return row
+
+
+class Connection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (question text, style id) -> questions.id; ids never change once committed
+        self.question_ids = {}
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or (Cursor if metrics.METRICS_ENABLED else sqlite3.Cursor))
+
+    # The shortcuts would otherwise bypass cursor() and go untimed
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(path=None):
+    # isolation_level=None leaves transaction control to transaction() below
+    conn = sqlite3.connect(path or DB_FILE, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                           check_same_thread=False, cached_statements=64, factory=Connection)
+    conn.row_factory = sqlite3.Row
+    # Only takes effect on a new database; existing ones are converted by
+    # `python retention.py compact --full` (see retention.py)
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={SYNCHRONOUS}')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    return conn
+
+
+def get_connection():
+    # One long-lived connection per worker thread; reopened in a forked child
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+@contextlib.contextmanager
+def transaction(conn=None):
+    # BEGIN IMMEDIATE takes the write lock up front, so concurrent writers queue on
+    # busy_timeout instead of failing when a read lock cannot be upgraded
+    conn = conn or get_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        # Ids handed out inside the rolled back transaction no longer exist
+        conn.question_ids.clear()
+        raise
+    conn.execute('COMMIT')
+
+
+def question_id(conn, question, style):
+    # Questions are keyed by text and style, since cohorts' banks may file the same text
+    # under different styles. Must run inside a transaction.
+    style_id = STYLE_IDS.get(style)
+    qid = conn.question_ids.get((question, style_id))
+    if qid is None:
+        row = conn.execute('SELECT id FROM questions WHERE text = ? AND style_id IS ?', (question, style_id)).fetchone()
+        if row is None:
+            qid = conn.execute('INSERT INTO questions (text, style_id) VALUES (?, ?)', (question, style_id)).lastrowid
+        else:
+            qid = row[0]
+        conn.question_ids[(question, style_id)] = qid
+    return qid
+
+
+def _answer_value(answer):
+    try:
+        return int(answer)
+    except (TypeError, ValueError):
+        return None
+
+
+def next_revisions(conn, count=1):
+    # Must run inside a transaction. Reserves count session revisions -> the first one
+    conn.execute(BUMP_COUNTER, ('session_revision', count))
+    return conn.execute("SELECT value FROM counters WHERE name = 'session_revision'").fetchone()[0] - count + 1
+
+
+def insert_assessment(conn, email, timestamp, answers, cohort=''):
+    # Must run inside a transaction. Answers for an (email, timestamp) that already
+    # exists are appended to that session, as the old per-row table grouped them.
+    conn.execute(INSERT_SESSION, (email, timestamp, cohort))
+    session_id = conn.execute(SELECT_SESSION, (email, timestamp)).fetchone()[0]
+    start = conn.execute('SELECT COALESCE(MAX(position), 0) FROM assessment_answers WHERE session_id = ?',
+                         (session_id,)).fetchone()[0]
+    # An existing session's old scores come out of the analytics before its new ones go in
+    previous = _session_day_scores(conn, session_id) if start else None
+    conn.executemany(INSERT_ANSWER, [(session_id, start + position, question_id(conn, question, style), _answer_value(answer))
+                                     for position, (style, question, answer) in enumerate(answers, 1)])
+    refresh_session_summary(conn, session_id)
+    conn.execute('UPDATE assessment_sessions SET revision = ? WHERE id = ?', (next_revisions(conn), session_id))
+    if previous:
+        _add_daily_stats(conn, previous, -1)
+    _add_daily_stats(conn, _session_day_scores(conn, session_id), 1)
+    return session_id
+
+
+def save_assessment(email, timestamp, answers, cohort=''):
+    # answers: iterable of (style, question, answer)
+    with transaction() as conn:
+        return insert_assessment(conn, email, timestamp, answers, cohort)
+
+
+def save_summary(email, timestamp, style_results):
+    # style_results: iterable of (style, score, tendency, description)
+    with transaction() as conn:
+        conn.executemany(INSERT_SUMMARY, [(email, timestamp, style, score, tendency, description)
+                                          for style, score, tendency, description in style_results])
+
+
+def save_survey(email, survey_responses):
+    # survey_responses: iterable of (question, answer)
+    with transaction() as conn:
+        conn.executemany(INSERT_SURVEY, [(email, question, answer) for question, answer in survey_responses])
+
+
+# Raw 1-5 rating -> -2..+2 contribution to its style's score
+SCORE_CASE = scoring.sql_answer_score('a.answer')
+
+
+# session_summary holds one row per session: score_<style id> and tendency_<style id>
+SUMMARY_SCORE_COLUMNS = [f'score_{style_id}' for style_id in STYLE_NUM_TO_NAME]
+SUMMARY_TENDENCY_COLUMNS = [f'tendency_{style_id}' for style_id in STYLE_NUM_TO_NAME]
+SUMMARY_COLUMNS = ', '.join(SUMMARY_SCORE_COLUMNS + SUMMARY_TENDENCY_COLUMNS)
+INSERT_SESSION_SUMMARY = (f"INSERT OR REPLACE INTO session_summary (session_id, {SUMMARY_COLUMNS}) "
+                          f"VALUES ({', '.join('?' * (1 + 2 * len(STYLE_NUM_TO_NAME)))})")
+# Recomputes the rows of a range of sessions from all of their stored answers, so running
+# it again is harmless and answers appended to an existing session are included
+REFRESH_SESSION_SUMMARY = f'''
+    INSERT OR REPLACE INTO session_summary (session_id, {SUMMARY_COLUMNS})
+    SELECT id, {', '.join(SUMMARY_SCORE_COLUMNS)}, {', '.join(scoring.sql_tendency(column) for column in SUMMARY_SCORE_COLUMNS)}
+    FROM (
+        SELECT s.id, {', '.join(f'COALESCE(SUM(CASE q.style_id WHEN {style_id} THEN {SCORE_CASE} END), 0) AS score_{style_id}'
+                                for style_id in STYLE_NUM_TO_NAME)}
+        FROM assessment_sessions s
+        LEFT JOIN assessment_answers a ON a.session_id = s.id
+        LEFT JOIN questions q ON q.id = a.question_id
+        WHERE s.id BETWEEN :first_id AND :last_id
+        GROUP BY s.id
+    )
+'''
+
+
+def refresh_session_summary(conn, session_id):
+    conn.execute(REFRESH_SESSION_SUMMARY, {'first_id': session_id, 'last_id': session_id})
+
+
+def refresh_session_summaries(conn, first_id, last_id):
+    conn.execute(REFRESH_SESSION_SUMMARY, {'first_id': first_id, 'last_id': last_id})
+
+
+# Cohort analytics, kept per cohort per style per day: running session counts, score
+# sums and sums of squares (mean and spread) plus a score histogram. Each submission
+# adds its summary row to its day; a session whose answers change is subtracted first.
+UPSERT_DAILY_STATS = '''
+    INSERT INTO style_daily_stats (cohort, day, style_id, sessions, score_sum, score_sq_sum) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (cohort, day, style_id) DO UPDATE SET
+        sessions = sessions + excluded.sessions,
+        score_sum = score_sum + excluded.score_sum,
+        score_sq_sum = score_sq_sum + excluded.score_sq_sum
+'''
+UPSERT_DAILY_HISTOGRAM = '''
+    INSERT INTO style_daily_histogram (cohort, day, style_id, score, sessions) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (cohort, day, style_id, score) DO UPDATE SET sessions = sessions + excluded.sessions
+'''
+
+
+def _session_day_scores(conn, session_id):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute(f'''
+        SELECT s.cohort, substr(s.timestamp, 1, 10), {', '.join(SUMMARY_SCORE_COLUMNS)}
+        FROM assessment_sessions s
+        JOIN session_summary ss ON ss.session_id = s.id
+        WHERE s.id = ?
+    ''', (session_id,)).fetchone()
+
+
+def _add_daily_stats(conn, day_scores, sign):
+    cohort, day, scores = day_scores[0], day_scores[1], day_scores[2:]
+    conn.executemany(UPSERT_DAILY_STATS, [(cohort, day, style_id, sign, sign * score, sign * score * score)
+                                          for style_id, score in zip(STYLE_NUM_TO_NAME, scores)])
+    conn.executemany(UPSERT_DAILY_HISTOGRAM, [(cohort, day, style_id, score, sign)
+                                              for style_id, score in zip(STYLE_NUM_TO_NAME, scores)])
+
+
+def add_daily_stats(conn, first_id=None, last_id=None):
+    # Adds a range of sessions (default all) to the analytics in one pass per style,
+    # reading their session_summary rows
+    where = '1' if first_id is None else 's.id BETWEEN :first_id AND :last_id'
+    params = {'first_id': first_id, 'last_id': last_id}
+    for style_id in STYLE_NUM_TO_NAME:
+        conn.execute(f'''
+            INSERT INTO style_daily_stats (cohort, day, style_id, sessions, score_sum, score_sq_sum)
+            SELECT s.cohort, substr(s.timestamp, 1, 10), {style_id}, COUNT(*), SUM(ss.score_{style_id}), SUM(ss.score_{style_id} * ss.score_{style_id})
+            FROM assessment_sessions s
+            JOIN session_summary ss ON ss.session_id = s.id
+            WHERE {where}
+            GROUP BY 1, 2
+            ON CONFLICT (cohort, day, style_id) DO UPDATE SET
+                sessions = sessions + excluded.sessions,
+                score_sum = score_sum + excluded.score_sum,
+                score_sq_sum = score_sq_sum + excluded.score_sq_sum
+        ''', params)
+        conn.execute(f'''
+            INSERT INTO style_daily_histogram (cohort, day, style_id, score, sessions)
+            SELECT s.cohort, substr(s.timestamp, 1, 10), {style_id}, ss.score_{style_id}, COUNT(*)
+            FROM assessment_sessions s
+            JOIN session_summary ss ON ss.session_id = s.id
+            WHERE {where}
+            GROUP BY 1, 2, 4
+            ON CONFLICT (cohort, day, style_id, score) DO UPDATE SET sessions = sessions + excluded.sessions
+        ''', params)
+
+
+def rebuild_daily_stats(conn):
+    # Recomputes the analytics tables from session_summary; run inside a transaction
+    conn.execute('DELETE FROM style_daily_stats')
+    conn.execute('DELETE FROM style_daily_histogram')
+    add_daily_stats(conn)
+
+
+def rebuild_session_summary(conn, batch_size=5000):
+    # Rescores every session with the batch scorer (e.g. after the thresholds change) and
+    # rewrites session_summary. Run inside a transaction so no submission lands between
+    # reading the answers and replacing the rows.
+    session_ids, answers, styles = scoring.load_answer_matrix(conn)
+    scores, tendencies = scoring.score_batch(answers, styles)
+    conn.execute('DELETE FROM session_summary')
+    for first in range(0, len(session_ids), batch_size):
+        last = first + batch_size
+        conn.executemany(INSERT_SESSION_SUMMARY, [
+            (session_id, *score_row, *(scoring.TENDENCIES[code] for code in tendency_row))
+            for session_id, score_row, tendency_row in zip(session_ids[first:last].tolist(), scores[first:last].tolist(),
+                                                           tendencies[first:last].tolist())])
+    return len(session_ids)
+
+
+def summary_dicts(values):
+    # score_* then tendency_* columns -> ({style: score}, {style: tendency}); sessions
+    # without a summary row yet read as all zero
+    count = len(STYLE_NUM_TO_NAME)
+    scores = {style: score or 0 for style, score in zip(STYLE_NUM_TO_NAME.values(), values[:count])}
+    tendencies = {style: tendency or scoring.tendency(scores[style])
+                  for style, tendency in zip(STYLE_NUM_TO_NAME.values(), values[count:])}
+    return scores, tendencies
+
+
+def session_page(conn, limit, email=None, start=None, end=None, before=None, after=None, cohort=None):
+    # Keyset page of sessions, newest first by (timestamp, id). before/after are the
+    # (timestamp, id) of the last/first row of the neighbouring page, so the cost of a
+    # page does not depend on how deep into the history it is.
+    where, params = [], []
+    if cohort is not None:
+        where.append('s.cohort = ?')
+        params.append(cohort)
+    if email:
+        where.append('s.email = ?')
+        params.append(email)
+    if start:
+        where.append('s.timestamp >= ?')
+        params.append(start)
+    if end:
+        where.append('s.timestamp < ?')
+        params.append(end)
+    if before:
+        where.append('(s.timestamp, s.id) < (?, ?)')
+        params.extend(before)
+    elif after:
+        where.append('(s.timestamp, s.id) > (?, ?)')
+        params.extend(after)
+    order = 'ASC' if after else 'DESC'
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(f'''
+        SELECT s.id, s.email, s.timestamp, s.cohort, {', '.join('ss.' + column for column in SUMMARY_SCORE_COLUMNS + SUMMARY_TENDENCY_COLUMNS)}
+        FROM assessment_sessions s
+        LEFT JOIN session_summary ss ON ss.session_id = s.id
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY s.timestamp {order}, s.id {order}
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after:
+        rows.reverse()
+    sessions = []
+    for row in rows:
+        scores, tendencies = summary_dicts(row[4:])
+        sessions.append({'id': row[0], 'email': row[1], 'timestamp': row[2], 'cohort': row[3],
+                         'scores': scores, 'tendencies': tendencies})
+    return sessions, has_more
+
+
+def session_scores(conn, session_id):
+    # ({style: score}, {style: tendency}) for one stored session, or None if it does not exist
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    row = cursor.execute(f'''
+        SELECT {SUMMARY_COLUMNS}
+        FROM assessment_sessions s
+        LEFT JOIN session_summary ss ON ss.session_id = s.id
+        WHERE s.id = ?
+    ''', (session_id,)).fetchone()
+    return summary_dicts(row) if row else None
+
+
+def cohort_statistics(conn, start=None, end=None, cohort=None):
+    # Per style count, mean, population standard deviation, score histogram and tendency
+    # split for sessions taken on days in [start, end), in one cohort or all of them.
+    # Reads only the per day aggregates, so the cost depends on the number of days, not
+    # the number of sessions.
+    where, params = [], []
+    if cohort is not None:
+        where.append('cohort = ?')
+        params.append(cohort)
+    if start:
+        where.append('day >= ?')
+        params.append(start)
+    if end:
+        where.append('day < ?')
+        params.append(end)
+    where = 'WHERE ' + ' AND '.join(where) if where else ''
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    totals = {style_id: (count, total, squares) for style_id, count, total, squares in cursor.execute(f'''
+        SELECT style_id, SUM(sessions), SUM(score_sum), SUM(score_sq_sum)
+        FROM style_daily_stats {where}
+        GROUP BY style_id
+    ''', params)}
+    histograms = {style_id: {} for style_id in STYLE_NUM_TO_NAME}
+    for style_id, score, count in cursor.execute(f'''
+        SELECT style_id, score, SUM(sessions)
+        FROM style_daily_histogram {where}
+        GROUP BY style_id, score
+        HAVING SUM(sessions) > 0
+        ORDER BY style_id, score
+    ''', params):
+        histograms[style_id][score] = count
+    statistics = []
+    for style_id, style in STYLE_NUM_TO_NAME.items():
+        count, total, squares = totals.get(style_id, (0, 0, 0))
+        mean = total / count if count else 0.0
+        variance = max(squares / count - mean * mean, 0.0) if count else 0.0
+        tendencies = dict.fromkeys(scoring.TENDENCIES, 0)
+        for score, sessions in histograms[style_id].items():
+            tendencies[scoring.tendency(score)] += sessions
+        statistics.append({'style': style, 'count': count, 'mean': mean, 'stddev': math.sqrt(variance),
+                           'histogram': histograms[style_id], 'tendencies': tendencies})
+    return statistics
+
+
+def daily_means(conn, days=30, cohort=None):
+    # [(day, {style: mean})] for the most recent days that have sessions, oldest first
+    where, params = 'sessions > 0', []
+    if cohort is not None:
+        where += ' AND cohort = ?'
+        params.append(cohort)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(f'''
+        SELECT day, style_id, SUM(sessions), SUM(score_sum)
+        FROM style_daily_stats
+        WHERE {where} AND day IN (SELECT DISTINCT day FROM style_daily_stats WHERE {where} ORDER BY day DESC LIMIT ?)
+        GROUP BY day, style_id
+        HAVING SUM(sessions) > 0
+        ORDER BY day
+    ''', params + params + [days]).fetchall()
+    means = {}
+    for day, style_id, count, total in rows:
+        means.setdefault(day, {})[STYLE_NUM_TO_NAME[style_id]] = total / count
+    return list(means.items())
+
+
+# Dashboard total -> its running count in counters (see migration 11). The counts cover
+# the live tables only: archiving a month deletes its rows, which takes them out.
+DASHBOARD_COUNTERS = {'total_assessments': 'sessions', 'unique_users': 'participants',
+                      'total_surveys': 'surveyed_sessions'}
+# The same totals counted from scratch
+COUNT_DASHBOARD_STATS = '''
+    SELECT COUNT(*) AS sessions,
+           COUNT(DISTINCT email) AS participants,
+           COALESCE(SUM(CASE WHEN email IN (SELECT email FROM survey_results) THEN 1 ELSE 0 END), 0) AS surveyed_sessions
+    FROM assessment_sessions
+'''
+
+
+def rebuild_dashboard_stats(conn):
+    # Recounts the dashboard totals; run inside a transaction
+    row = conn.execute(COUNT_DASHBOARD_STATS).fetchone()
+    conn.executemany('INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+                     [(name, row[name]) for name in DASHBOARD_COUNTERS.values()])
+
+
+def dashboard_stats(conn):
+    values = dict(conn.execute(f"SELECT name, value FROM counters WHERE name IN ({', '.join('?' * len(DASHBOARD_COUNTERS))})",
+                               list(DASHBOARD_COUNTERS.values())).fetchall())
+    return {total: values.get(name, 0) for total, name in DASHBOARD_COUNTERS.items()}
+
+
+def session_details(conn, session_id):
+    # The session row, its answers in the order asked and its email's survey answers
+    session = conn.execute('SELECT id, email, timestamp FROM assessment_sessions WHERE id = ?', (session_id,)).fetchone()
+    if session is None:
+        return None, [], []
+    answers = conn.execute('''
+        SELECT question, style, answer
+        FROM session_answers
+        WHERE session_id = ?
+        ORDER BY position
+    ''', (session_id,)).fetchall()
+    surveys = conn.execute('''
+        SELECT question, answer
+        FROM survey_results
+        WHERE id IN (SELECT MIN(id) FROM survey_results WHERE email = ? GROUP BY question)
+        ORDER BY id
+    ''', (session['email'],)).fetchall()
+    return session, answers, surveys
+
+
+def participant_details(conn, email):
+    # Every summary, answer and survey row recorded for one email. Ties are broken down to
+    # the row, so both storage backends return the same order.
+    summary = conn.execute('SELECT * FROM summary_results WHERE email = ? ORDER BY style, id', (email,)).fetchall()
+    assessment = conn.execute('SELECT email, timestamp, style, question, answer FROM session_answers WHERE email = ? '
+                              'ORDER BY question, timestamp, position', (email,)).fetchall()
+    survey = conn.execute('SELECT * FROM survey_results WHERE email = ? ORDER BY question, id', (email,)).fetchall()
+    return summary, assessment, survey
@@ -0,0 +1,271 @@
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+
+import scoring
+from question_bank import STYLE_NUM_TO_NAME
+
+# Rows fetched from SQLite, and CSV rows buffered, per chunk of the streamed response
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', '2000'))
+
+CSV_COLUMNS = ['Name', 'Email', 'Assessment_Timestamp', 'Question_Number', 'Question_Text',
+               'Leadership_Style', 'User_Answer', 'Calculated_Score', 'Survey_Completed']
+
+# Answers (kind 0) and de-duplicated survey answers (kind 1) for every session, newest
+# session first. CROSS JOIN keeps assessment_sessions as the outer loop so both halves
+# come out of the (timestamp, id) index already ordered and SQLite merges them without
+# a sort: the first row is available immediately and nothing is materialized. With a
+# cohort the same walk runs over the (cohort, timestamp, id) index.
+EXPORT_QUERY = '''
+    SELECT s.id, s.email, s.timestamp, 0 AS kind, a.position, q.text, st.name, a.answer,
+           EXISTS (SELECT 1 FROM survey_results WHERE email = s.email) AS has_survey
+    FROM assessment_sessions s
+    CROSS JOIN assessment_answers a ON a.session_id = s.id
+    JOIN questions q ON q.id = a.question_id
+    LEFT JOIN styles st ON st.id = q.style_id
+    WHERE {cohort}
+    UNION ALL
+    SELECT s.id, s.email, s.timestamp, 1 AS kind, sr.id, sr.question, 'Survey', sr.answer, 1
+    FROM assessment_sessions s
+    CROSS JOIN survey_results sr ON sr.email = s.email
+    WHERE NOT EXISTS (SELECT 1 FROM survey_results p WHERE p.email = sr.email AND p.question = sr.question AND p.id < sr.id)
+      AND {cohort}
+    ORDER BY 3 DESC, 1 DESC, 4, 5
+'''
+
+
+def participant_name(email):
+    return email.split('@')[0].replace('.', ' ').title()
+
+
+def format_timestamp(timestamp):
+    try:
+        from datetime import datetime
+        dt = datetime.fromisoformat(timestamp.replace(' ', 'T'))
+        return dt.strftime('%m-%d-%Y %I:%M%p')
+    except:
+        return timestamp or 'Unknown'
+
+
+def iter_export_rows(conn, chunk_size=EXPORT_CHUNK_SIZE, cohort=None):
+    # Yields CSV_COLUMNS-shaped lists while walking the query cursor chunk by chunk;
+    # cohort limits the export to that cohort's sessions
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    if cohort is None:
+        cursor.execute(EXPORT_QUERY.format(cohort='1'))
+    else:
+        cursor.execute(EXPORT_QUERY.format(cohort='s.cohort = :cohort'), {'cohort': cohort})
+    current_session = None
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for session_id, email, timestamp, kind, position, question, style, answer, has_survey in rows:
+            if session_id != current_session:
+                current_session = session_id
+                name = participant_name(email)
+                formatted_timestamp = format_timestamp(timestamp)
+                survey_number = 0
+            if kind == 0:
+                yield [name, email, formatted_timestamp, position, question, style or 'Unknown',
+                       answer, scoring.answer_score(answer), 'Yes' if has_survey else 'No']
+            else:
+                survey_number += 1
+                yield [name, email, formatted_timestamp, f'SURVEY-{survey_number}', question, 'Survey',
+                       answer, 'N/A', 'Yes']
+
+
+def iter_csv(conn, chunk_size=EXPORT_CHUNK_SIZE, cohort=None, archives=()):
+    # CSV text in chunks of chunk_size rows; memory use does not grow with the data.
+    # archives: further connections, holding older sessions, whose rows follow conn's
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    rows = itertools.chain.from_iterable(iter_export_rows(source, chunk_size, cohort)
+                                         for source in itertools.chain([conn], archives))
+    first = next(rows, None)
+    if first is None:
+        writer.writerow(['No data available'])
+        yield buffer.getvalue()
+        return
+    writer.writerow(CSV_COLUMNS)
+    writer.writerow(first)
+    for count, row in enumerate(rows, 2):
+        writer.writerow(row)
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# Typed, per-table exports for analytics. Each table is read from SQLite in chunks of
+# EXPORT_CHUNK_SIZE rows (pandas.read_sql_query) and written batch by batch, so like the
+# CSV it never holds a whole table in memory. Watermarks make pulls incremental: only
+# sessions with revision > after_revision and survey rows with id > after_survey_id are
+# exported, and the manifest reports the watermarks to pass next time. A session's
+# revision moves on whenever answers are appended to it, and the session is then
+# exported again in full: keep the rows of its highest revision. A cohort limits
+# every table to that cohort's sessions (and their participants' surveys).
+COLUMNAR_FORMATS = {'parquet': '.parquet', 'feather': '.arrow', 'xlsx': '.xlsx'}
+
+COLUMNAR_TABLES = {
+    'answers': {
+        'query': f'''
+            SELECT s.id AS session_id, s.revision, s.cohort, s.email, s.timestamp, a.position, a.question_id,
+                   q.text AS question, st.name AS style, a.answer,
+                   {scoring.sql_answer_score('a.answer')} AS score
+            FROM assessment_sessions s
+            CROSS JOIN assessment_answers a ON a.session_id = s.id
+            JOIN questions q ON q.id = a.question_id
+            LEFT JOIN styles st ON st.id = q.style_id
+            WHERE s.revision > :after_revision AND (:cohort IS NULL OR s.cohort = :cohort)
+            ORDER BY s.revision, a.position
+        ''',
+        'dtypes': {'session_id': 'int64', 'revision': 'int64', 'cohort': 'string', 'email': 'string', 'position': 'int16', 'question_id': 'int32',
+                   'question': 'string', 'style': 'string', 'answer': 'Int8', 'score': 'int8'},
+        'watermark': ('revision', 'after_revision'),
+    },
+    'summaries': {
+        # One row per session and style, unpivoted from session_summary
+        'query': f'''
+            SELECT s.id AS session_id, s.revision, s.cohort, s.email, s.timestamp, st.name AS style,
+                   COALESCE(CASE st.id {' '.join(f'WHEN {i} THEN ss.score_{i}' for i in STYLE_NUM_TO_NAME)} END, 0) AS score,
+                   COALESCE(CASE st.id {' '.join(f'WHEN {i} THEN ss.tendency_{i}' for i in STYLE_NUM_TO_NAME)} END,
+                            {scoring.sql_tendency('0')}) AS tendency
+            FROM assessment_sessions s
+            CROSS JOIN styles st
+            LEFT JOIN session_summary ss ON ss.session_id = s.id
+            WHERE s.revision > :after_revision AND (:cohort IS NULL OR s.cohort = :cohort)
+            ORDER BY s.revision, st.id
+        ''',
+        'dtypes': {'session_id': 'int64', 'revision': 'int64', 'cohort': 'string', 'email': 'string', 'style': 'string', 'score': 'int16', 'tendency': 'string'},
+        'watermark': ('revision', 'after_revision'),
+    },
+    'surveys': {
+        'query': '''
+            SELECT id AS survey_id, email, question, answer
+            FROM survey_results
+            WHERE id > :after_survey_id
+              AND (:cohort IS NULL OR email IN (SELECT email FROM assessment_sessions WHERE cohort = :cohort))
+            ORDER BY id
+        ''',
+        'dtypes': {'survey_id': 'int64', 'email': 'string', 'question': 'string', 'answer': 'string'},
+        'watermark': ('survey_id', 'after_survey_id'),
+    },
+}
+
+
+def iter_table_frames(conn, table, watermarks, chunk_size=EXPORT_CHUNK_SIZE):
+    # Explicit dtypes keep every chunk's schema identical, even when a chunk is all NULL
+    import pandas as pd
+    spec = COLUMNAR_TABLES[table]
+    for frame in pd.read_sql_query(spec['query'], conn, params=watermarks, chunksize=chunk_size):
+        frame = frame.astype(spec['dtypes'])
+        if 'timestamp' in frame:
+            frame['timestamp'] = pd.to_datetime(frame['timestamp'], errors='coerce')
+        yield frame
+
+
+class _ArrowTableWriter:
+    # Parquet or Arrow IPC (Feather v2) file, one record batch per chunk
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self.writer = None
+
+    def write(self, frame):
+        import pyarrow as pa
+        batch = pa.RecordBatch.from_pandas(frame, preserve_index=False)
+        if self.writer is None:
+            if self.fmt == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.path, batch.schema, compression='zstd')
+            else:
+                import pyarrow.ipc
+                self.writer = pa.ipc.new_file(self.path, batch.schema)
+        if self.fmt == 'parquet':
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def write_columnar(conn, fmt, directory, after_revision=0, after_survey_id=0, chunk_size=EXPORT_CHUNK_SIZE,
+                   cohort=None):
+    # Writes answers, summaries and surveys into directory (one file per table, or one
+    # sheet per table for xlsx) and returns the manifest, including the next watermarks.
+    if fmt not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt in ('parquet', 'feather'):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise RuntimeError(f"{fmt} export requires the pyarrow package")
+    watermarks = {'after_revision': after_revision, 'after_survey_id': after_survey_id}
+    manifest = {'format': fmt, 'cohort': cohort, 'since': dict(watermarks), 'next': dict(watermarks), 'tables': {}, 'files': []}
+    workbook = None
+    if fmt == 'xlsx':
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+    for table, spec in COLUMNAR_TABLES.items():
+        rows = 0
+        column, watermark = spec['watermark']
+        if workbook is not None:
+            sheet = workbook.create_sheet(table)
+        else:
+            filename = table + COLUMNAR_FORMATS[fmt]
+            writer = _ArrowTableWriter(os.path.join(directory, filename), fmt)
+        for frame in iter_table_frames(conn, table, {**watermarks, 'cohort': cohort}, chunk_size):
+            if workbook is not None:
+                if rows == 0:
+                    sheet.append(list(frame.columns))
+                for record in frame.astype(object).where(frame.notna(), None).itertuples(index=False):
+                    sheet.append([value.to_pydatetime() if hasattr(value, 'to_pydatetime') else value for value in record])
+            else:
+                writer.write(frame)
+            rows += len(frame)
+            if len(frame):
+                manifest['next'][watermark] = max(manifest['next'][watermark], int(frame[column].max()))
+        if workbook is None:
+            writer.close()
+            if rows:
+                manifest['files'].append(filename)
+        manifest['tables'][table] = rows
+    if workbook is not None:
+        workbook.save(os.path.join(directory, 'assessment_data.xlsx'))
+        manifest['files'].append('assessment_data.xlsx')
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    manifest['files'].append('manifest.json')
+    return manifest
+
+
+if __name__ == '__main__':
+    import db
+    parser = argparse.ArgumentParser(description='Export assessment data as typed columnar files')
+    parser.add_argument('format', choices=sorted(COLUMNAR_FORMATS))
+    parser.add_argument('directory')
+    parser.add_argument('--db', default=db.DB_FILE)
+    # --after-session-id is the earlier name; sessions written before revisions existed
+    # have their id as revision
+    parser.add_argument('--after-revision', '--after-session-id', dest='after_revision', type=int, default=0)
+    parser.add_argument('--after-survey-id', type=int, default=0)
+    parser.add_argument('--cohort', help="only this cohort's sessions ('' for the default cohort)")
+    parser.add_argument('--month', help='export this archived month (YYYY-MM, see retention.py) instead')
+    args = parser.parse_args()
+    os.makedirs(args.directory, exist_ok=True)
+    if args.month:
+        import retention
+        conn = retention.open_archive(args.month)
+    else:
+        conn = db.connect(args.db)
+    manifest = write_columnar(conn, args.format, args.directory,
+                              args.after_revision, args.after_survey_id, cohort=args.cohort)
+    print(json.dumps(manifest, indent=2))
@@ -0,0 +1,269 @@
+import bisect
+import collections
+import contextlib
+import functools
+import os
+import re
+import sys
+import threading
+import time
+
+# Request, span and SQLite query instrumentation, exposed as Prometheus text on /metrics.
+# Each gunicorn worker keeps its own registry, so a scrape sees the worker that answers it.
+METRICS_ENABLED = os.environ.get('METRICS', '1') != '0'
+# When set, /metrics requires "Authorization: Bearer <token>"; unset, it only answers
+# requests made on this host directly (not through a proxy)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Sampling profiler: on at startup with PROFILER=1, or toggled from /admin/profiler
+PROFILER_AT_START = os.environ.get('PROFILER', '0') == '1'
+PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL_MS', '10')) / 1000
+
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+_registry = []
+# Thread ident -> "METHOD route" of the request it is serving, for the profiler
+_requests = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _quote(value):
+    return '"' + _escape(value) + '"'
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}={_quote(value)}' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        # label values -> [per-bucket counts (+ overflow), sum, count]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self.lock:
+            series = {labels: ([*counts], total, count) for labels, (counts, total, count) in self.series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, ["le=%s" % _quote(bound)])} {cumulative}'
+            yield f'{self.name}_bucket{_labels(self.labelnames, labels, ["le=%s" % _quote("+Inf")])} {count}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {count}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values = collections.defaultdict(float)
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] += amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+class Gauge:
+    # Read from a callback at scrape time
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        try:
+            value = self.read()
+        except Exception:
+            return
+        yield f'{self.name} {value}'
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def histogram(name, help, buckets=REQUEST_BUCKETS, labelnames=()):
+    return _register(Histogram(name, help, buckets, labelnames))
+
+
+def counter(name, help, labelnames=()):
+    return _register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, read):
+    return _register(Gauge(name, help, read))
+
+
+REQUEST_DURATION = histogram('http_request_duration_seconds', 'Request latency by route', REQUEST_BUCKETS,
+                             ('method', 'route', 'status'))
+SPAN_DURATION = histogram('span_duration_seconds', 'Time spent in named spans', REQUEST_BUCKETS, ('span',))
+QUERY_DURATION = histogram('sqlite_query_duration_seconds', 'SQLite statement execution time', QUERY_BUCKETS,
+                           ('statement',))
+QUERY_ROWS = counter('sqlite_rows_total', 'Rows fetched by or changed by SQLite statements', ('statement',))
+_started = time.time()
+gauge('process_uptime_seconds', 'Seconds since this worker started', lambda: round(time.time() - _started, 3))
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if METRICS_ENABLED:
+            SPAN_DURATION.observe(time.perf_counter() - start, name)
+
+
+_STATEMENT_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE(?: IF NOT EXISTS)?)\s+([A-Za-z_][A-Za-z0-9_]*)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql):
+    # Low-cardinality label for a statement: its verb and first table, e.g. "SELECT assessment_sessions"
+    words = sql.split(None, 1)
+    if not words:
+        return 'EMPTY'
+    verb = words[0].upper()
+    match = _STATEMENT_PATTERN.search(sql)
+    return f'{verb} {match.group(1)}' if match else verb
+
+
+def authorized(request):
+    # Whether a request may read /metrics
+    if METRICS_TOKEN:
+        return request.headers.get('Authorization') == f"Bearer {METRICS_TOKEN}"
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
+
+def init_app(app):
+    @app.before_request
+    def track_request():
+        from flask import request
+        route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        _requests[threading.get_ident()] = f'{request.method} {route}'
+
+    @app.teardown_request
+    def untrack_request(exc):
+        _requests.pop(threading.get_ident(), None)
+
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_timer():
+        from flask import g
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        from flask import g, request
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+            REQUEST_DURATION.observe(time.perf_counter() - start, request.method, route, str(response.status_code))
+        return response
+
+
+class SamplingProfiler:
+    # Samples the stack of each thread serving a request every interval and counts them as
+    # collapsed stacks rooted at the request's route ("GET /results;outer;inner;leaf
+    # count"), the input format of flamegraph tools. Background threads are left out.
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            collapsed = []
+            for thread_id, route in list(_requests.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                if stack:
+                    collapsed.append(';'.join([route, *reversed(stack)]))
+            with self.lock:
+                self.stacks.update(collapsed)
+                self.samples += len(collapsed)
+
+    def collapsed(self):
+        with self.lock:
+            return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common()) + '\n'
+
+
+profiler = SamplingProfiler()
+if PROFILER_AT_START:
+    profiler.start()
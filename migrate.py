@@ -0,0 +1,447 @@
+import argparse
+import datetime
+import itertools
+import os
+import threading
+
+import db
+from question_bank import STYLE_NUM_TO_NAME
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Legacy rows copied per backfill transaction; small enough not to starve live writers
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', '5000'))
+BACKFILL_KEY = 'assessment_results_backfill'
+
+
+def _columns(conn, table):
+    return {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _execute_script(conn, script):
+    # executescript() would commit the migration's transaction, so run statements one by one
+    for statement in script.split(';'):
+        if statement.strip():
+            conn.execute(statement)
+
+
+def _base_schema(conn):
+    _execute_script(conn, open(os.path.join(BASE_DIR, 'init_db.sql')).read())
+
+
+def _add_timestamp_style(conn):
+    # Formerly migrate_add_timestamp_style.sql, which failed when run twice
+    columns = _columns(conn, 'assessment_results')
+    if 'timestamp' not in columns:
+        conn.execute('ALTER TABLE assessment_results ADD COLUMN timestamp TEXT')
+    if 'style' not in columns:
+        conn.execute('ALTER TABLE assessment_results ADD COLUMN style TEXT')
+
+
+def _normalized_schema(conn):
+    _execute_script(conn, '''
+        CREATE TABLE IF NOT EXISTS styles (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+
+        CREATE TABLE IF NOT EXISTS questions (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL UNIQUE,
+            style_id INTEGER REFERENCES styles(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS assessment_sessions (
+            id INTEGER PRIMARY KEY,
+            email TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            UNIQUE (email, timestamp)
+        );
+        CREATE INDEX IF NOT EXISTS idx_assessment_sessions_timestamp ON assessment_sessions (timestamp, id);
+
+        -- One row per answered question, answer being the raw 1-5 rating
+        CREATE TABLE IF NOT EXISTS assessment_answers (
+            session_id INTEGER NOT NULL REFERENCES assessment_sessions(id),
+            position INTEGER NOT NULL,
+            question_id INTEGER NOT NULL REFERENCES questions(id),
+            answer INTEGER,
+            PRIMARY KEY (session_id, position)
+        ) WITHOUT ROWID;
+
+        -- Same shape the routes used to read from assessment_results
+        CREATE VIEW IF NOT EXISTS session_answers AS
+            SELECT s.id AS session_id, s.email, s.timestamp, a.position,
+                   q.text AS question, st.name AS style, a.answer
+            FROM assessment_answers a
+            JOIN assessment_sessions s ON s.id = a.session_id
+            JOIN questions q ON q.id = a.question_id
+            LEFT JOIN styles st ON st.id = q.style_id;
+
+        CREATE INDEX IF NOT EXISTS idx_assessment_results_email_timestamp ON assessment_results (email, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_survey_results_email ON survey_results (email, id);
+        CREATE INDEX IF NOT EXISTS idx_summary_results_email_timestamp ON summary_results (email, timestamp);
+
+        CREATE TABLE IF NOT EXISTS migration_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    ''')
+    conn.executemany('INSERT OR IGNORE INTO styles (id, name) VALUES (?, ?)', STYLE_NUM_TO_NAME.items())
+
+
+def _session_summary(conn):
+    # One row per session with its 8 style scores and tendencies, written in the same
+    # transaction as the session's answers (db.refresh_session_summary)
+    columns = ',\n'.join([f'            {column} INTEGER NOT NULL DEFAULT 0' for column in db.SUMMARY_SCORE_COLUMNS] +
+                          [f'            {column} TEXT' for column in db.SUMMARY_TENDENCY_COLUMNS])
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS session_summary (
+            session_id INTEGER PRIMARY KEY REFERENCES assessment_sessions(id),
+{columns}
+        )
+    ''')
+    db.rebuild_session_summary(conn)
+
+
+def _journal_progress(conn):
+    # Offset up to which each write-behind journal segment has been applied
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS journal_progress (
+            segment TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL
+        )
+    ''')
+
+
+def _daily_stats(conn):
+    # Per style per day running aggregates behind /admin/analytics
+    _execute_script(conn, '''
+        CREATE TABLE IF NOT EXISTS style_daily_stats (
+            day TEXT NOT NULL,
+            style_id INTEGER NOT NULL REFERENCES styles(id),
+            sessions INTEGER NOT NULL,
+            score_sum INTEGER NOT NULL,
+            score_sq_sum INTEGER NOT NULL,
+            PRIMARY KEY (day, style_id)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS style_daily_histogram (
+            day TEXT NOT NULL,
+            style_id INTEGER NOT NULL REFERENCES styles(id),
+            score INTEGER NOT NULL,
+            sessions INTEGER NOT NULL,
+            PRIMARY KEY (day, style_id, score)
+        ) WITHOUT ROWID
+    ''')
+    _rebuild_daily_stats_by_day(conn)
+
+
+def _rebuild_daily_stats_by_day(conn):
+    # db.rebuild_daily_stats as migration 6 shipped it, before the tables were keyed by
+    # cohort; kept here so migration 6 does the same on every database
+    conn.execute('DELETE FROM style_daily_stats')
+    conn.execute('DELETE FROM style_daily_histogram')
+    for style_id in STYLE_NUM_TO_NAME:
+        conn.execute(f'''
+            INSERT INTO style_daily_stats (day, style_id, sessions, score_sum, score_sq_sum)
+            SELECT substr(s.timestamp, 1, 10), {style_id}, COUNT(*), SUM(ss.score_{style_id}), SUM(ss.score_{style_id} * ss.score_{style_id})
+            FROM assessment_sessions s
+            JOIN session_summary ss ON ss.session_id = s.id
+            GROUP BY 1
+        ''')
+        conn.execute(f'''
+            INSERT INTO style_daily_histogram (day, style_id, score, sessions)
+            SELECT substr(s.timestamp, 1, 10), {style_id}, ss.score_{style_id}, COUNT(*)
+            FROM assessment_sessions s
+            JOIN session_summary ss ON ss.session_id = s.id
+            GROUP BY 1, 3
+        ''')
+
+
+def _search_index(conn):
+    # FTS5 indexes over participant emails (the dashboard derives names from them) and
+    # survey answers. Both are external content tables kept current by triggers, so every
+    # writer (routes, write-behind, backfill, imports) maintains them incrementally.
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS participant_search
+        USING fts5(email, content='assessment_sessions', content_rowid='id', prefix='2 3')
+    ''')
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS survey_search
+        USING fts5(answer, content='survey_results', content_rowid='id', prefix='2 3')
+    ''')
+    for table, index, column in (('assessment_sessions', 'participant_search', 'email'),
+                                 ('survey_results', 'survey_search', 'answer')):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {index} (rowid, {column}) VALUES (new.id, new.{column});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {index} ({index}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {column} ON {table} BEGIN
+                INSERT INTO {index} ({index}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                INSERT INTO {index} (rowid, {column}) VALUES (new.id, new.{column});
+            END
+        ''')
+        conn.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+    # Style and tendency filters
+    for style_id in STYLE_NUM_TO_NAME:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_session_summary_tendency_{style_id} '
+                     f'ON session_summary (tendency_{style_id}, session_id)')
+
+
+def _cohorts(conn):
+    if 'cohort' not in _columns(conn, 'assessment_sessions'):
+        conn.execute("ALTER TABLE assessment_sessions ADD COLUMN cohort TEXT NOT NULL DEFAULT ''")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_assessment_sessions_cohort_timestamp ON assessment_sessions (cohort, timestamp, id)')
+    # Cohorts' banks may file the same question text under different styles, so questions
+    # become unique by (text, style). SQLite cannot drop a constraint: rebuild the table
+    # with the same ids, recreating the views that read it.
+    views = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'view'").fetchall()
+    for view in views:
+        conn.execute(f"DROP VIEW {view['name']}")
+    _execute_script(conn, '''
+        CREATE TABLE questions_by_style (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL,
+            style_id INTEGER REFERENCES styles(id),
+            UNIQUE (text, style_id)
+        );
+        INSERT INTO questions_by_style (id, text, style_id) SELECT id, text, style_id FROM questions;
+        DROP TABLE questions;
+        ALTER TABLE questions_by_style RENAME TO questions
+    ''')
+    for view in views:
+        conn.execute(view['sql'])
+    # Analytics per cohort
+    _execute_script(conn, '''
+        DROP TABLE IF EXISTS style_daily_stats;
+        DROP TABLE IF EXISTS style_daily_histogram;
+
+        CREATE TABLE style_daily_stats (
+            cohort TEXT NOT NULL,
+            day TEXT NOT NULL,
+            style_id INTEGER NOT NULL REFERENCES styles(id),
+            sessions INTEGER NOT NULL,
+            score_sum INTEGER NOT NULL,
+            score_sq_sum INTEGER NOT NULL,
+            PRIMARY KEY (cohort, day, style_id)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE style_daily_histogram (
+            cohort TEXT NOT NULL,
+            day TEXT NOT NULL,
+            style_id INTEGER NOT NULL REFERENCES styles(id),
+            score INTEGER NOT NULL,
+            sessions INTEGER NOT NULL,
+            PRIMARY KEY (cohort, day, style_id, score)
+        ) WITHOUT ROWID
+    ''')
+    db.rebuild_daily_stats(conn)
+
+
+def _deferred_schema(conn):
+    # Indexes and triggers bulk_import.py drops for the length of a load, kept here until
+    # they are recreated so an interrupted load cannot lose them
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS deferred_schema (
+            name TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            sql TEXT NOT NULL
+        )
+    ''')
+
+
+def _session_revisions(conn):
+    # Every write to a session (a new session or answers appended to one) stamps it with
+    # the next value of the session_revision counter, so columnar exports can pull
+    # incrementally by revision. The counter lives in its own table rather than in
+    # MAX(revision), so values are not reused after the newest sessions are archived.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    if 'revision' not in _columns(conn, 'assessment_sessions'):
+        conn.execute('ALTER TABLE assessment_sessions ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+    # Existing sessions keep their id as revision, so an after_session_id from an earlier
+    # pull is still a valid watermark
+    conn.execute('UPDATE assessment_sessions SET revision = id')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_assessment_sessions_revision ON assessment_sessions (revision)')
+    conn.execute("INSERT OR REPLACE INTO counters (name, value) "
+                 "SELECT 'session_revision', COALESCE(MAX(id), 0) FROM assessment_sessions")
+
+
+def _dashboard_counters(conn):
+    # The dashboard's totals as running counts in counters, kept current by triggers in
+    # the transaction of every write (submissions, imports, retention), so
+    # /admin/results reads three rows instead of counting every session
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_session_insert AFTER INSERT ON assessment_sessions BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'sessions';
+            UPDATE counters SET value = value + 1 WHERE name = 'participants'
+                AND NOT EXISTS (SELECT 1 FROM assessment_sessions WHERE email = new.email AND id != new.id);
+            UPDATE counters SET value = value + 1 WHERE name = 'surveyed_sessions'
+                AND EXISTS (SELECT 1 FROM survey_results WHERE email = new.email);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_session_delete AFTER DELETE ON assessment_sessions BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'sessions';
+            UPDATE counters SET value = value - 1 WHERE name = 'participants'
+                AND NOT EXISTS (SELECT 1 FROM assessment_sessions WHERE email = old.email);
+            UPDATE counters SET value = value - 1 WHERE name = 'surveyed_sessions'
+                AND EXISTS (SELECT 1 FROM survey_results WHERE email = old.email);
+        END
+    ''')
+    # A participant's first survey answer makes all their sessions surveyed; the last one
+    # going takes them all back out
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_survey_insert AFTER INSERT ON survey_results BEGIN
+            UPDATE counters SET value = value + (SELECT COUNT(*) FROM assessment_sessions WHERE email = new.email)
+            WHERE name = 'surveyed_sessions'
+              AND NOT EXISTS (SELECT 1 FROM survey_results WHERE email = new.email AND id != new.id);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_survey_delete AFTER DELETE ON survey_results BEGIN
+            UPDATE counters SET value = value - (SELECT COUNT(*) FROM assessment_sessions WHERE email = old.email)
+            WHERE name = 'surveyed_sessions'
+              AND NOT EXISTS (SELECT 1 FROM survey_results WHERE email = old.email);
+        END
+    ''')
+    db.rebuild_dashboard_stats(conn)
+
+
+def _cohort_daily_stats(conn):
+    # Recomputes the cohort-keyed analytics, so every database has the same rows whichever
+    # body of migration 6 it ran before migration 8 re-keyed the tables
+    db.rebuild_daily_stats(conn)
+
+
+# (version, description, function); append only, never renumber
+MIGRATIONS = [
+    (1, 'base schema from init_db.sql', _base_schema),
+    (2, 'add timestamp and style to assessment_results', _add_timestamp_style),
+    (3, 'normalized questions, styles, sessions and answers', _normalized_schema),
+    (4, 'materialized per-session summary', _session_summary),
+    (5, 'write-behind journal progress', _journal_progress),
+    (6, 'per style per day cohort analytics', _daily_stats),
+    (7, 'full-text search over participants and survey answers', _search_index),
+    (8, 'cohorts: per-cohort sessions, questions and analytics', _cohorts),
+    (9, 'bulk import: indexes and triggers deferred during a load', _deferred_schema),
+    (10, 'session revisions for incremental exports', _session_revisions),
+    (11, 'running dashboard totals', _dashboard_counters),
+    (12, 'per-cohort analytics rebuilt from session summaries', _cohort_daily_stats),
+]
+
+
+def applied_versions(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT
+        )
+    ''')
+    return {row['version'] for row in conn.execute('SELECT version FROM schema_migrations')}
+
+
+def upgrade(conn=None, verbose=True):
+    conn = conn or db.get_connection()
+    applied = applied_versions(conn)
+    for version, description, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        with db.transaction(conn):
+            # Another worker may have applied it while we waited for the write lock
+            if conn.execute('SELECT 1 FROM schema_migrations WHERE version = ?', (version,)).fetchone():
+                continue
+            migration(conn)
+            conn.execute('INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)',
+                         (version, description, datetime.datetime.now().isoformat(sep=' ', timespec='seconds')))
+            if verbose:
+                print(f"Applied migration {version}: {description}")
+
+
+def backfill_pending(conn=None):
+    conn = conn or db.get_connection()
+    row = conn.execute('SELECT value FROM migration_state WHERE key = ?', (BACKFILL_KEY,)).fetchone()
+    last_id = row['value'] if row else 0
+    return conn.execute('SELECT EXISTS (SELECT 1 FROM assessment_results WHERE id > ?)', (last_id,)).fetchone()[0] == 1
+
+
+def backfill(conn=None, batch_size=BACKFILL_BATCH_SIZE):
+    # Copies legacy assessment_results rows into the normalized tables. Each batch and
+    # its cursor are committed together, so the job can be stopped and resumed at any
+    # point and is safe to run while the app keeps serving.
+    conn = conn or db.get_connection()
+    copied = skipped = 0
+    while True:
+        with db.transaction(conn):
+            row = conn.execute('SELECT value FROM migration_state WHERE key = ?', (BACKFILL_KEY,)).fetchone()
+            last_id = row['value'] if row else 0
+            rows = conn.execute('''
+                SELECT id, email, timestamp, style, question, answer
+                FROM assessment_results
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            # Consecutive rows with the same (email, timestamp) belong to one session; a session
+            # split across batches is rejoined by insert_assessment
+            for (email, timestamp), session_rows in itertools.groupby(rows, key=lambda r: (r['email'] or '', r['timestamp'])):
+                session_rows = list(session_rows)
+                # Rows without a timestamp predate sessions and were never shown on the dashboard
+                if timestamp is None:
+                    skipped += len(session_rows)
+                    continue
+                db.insert_assessment(conn, email, timestamp, [(r['style'], r['question'], r['answer']) for r in session_rows])
+            copied += len(rows)
+            conn.execute('INSERT OR REPLACE INTO migration_state (key, value) VALUES (?, ?)', (BACKFILL_KEY, rows[-1]['id']))
+    return copied, skipped
+
+
+def start_backfill_thread():
+    # Run any outstanding backfill off the request path
+    def run():
+        try:
+            copied, skipped = backfill(db.connect())
+            print(f"Backfill complete: {copied} legacy rows scanned, {skipped} without timestamp skipped")
+        except Exception as e:
+            print(f"Backfill stopped, will resume on next start: {e}")
+    thread = threading.Thread(target=run, name='backfill', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply schema migrations and backfill normalized tables')
+    parser.add_argument('command', choices=['upgrade', 'backfill', 'rebuild-summary', 'status'])
+    parser.add_argument('--db', default=db.DB_FILE)
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE)
+    args = parser.parse_args()
+    conn = db.connect(args.db)
+    if args.command == 'status':
+        applied = applied_versions(conn)
+        for version, description, _ in MIGRATIONS:
+            print(f"{version:>3} {'applied' if version in applied else 'pending':<8} {description}")
+        if 3 in applied:
+            print(f"backfill {'pending' if backfill_pending(conn) else 'complete'}")
+    else:
+        upgrade(conn)
+        if args.command == 'backfill':
+            copied, skipped = backfill(conn, args.batch_size)
+            print(f"Backfill complete: {copied} legacy rows scanned, {skipped} without timestamp skipped")
+        elif args.command == 'rebuild-summary':
+            with db.transaction(conn):
+                sessions = db.rebuild_session_summary(conn, args.batch_size)
+                db.rebuild_daily_stats(conn)
+            print(f"Rebuilt session_summary and daily stats: {sessions} sessions")
@@ -0,0 +1,303 @@
+import argparse
+import collections
+import hashlib
+import io
+import os
+import pickle
+import random
+import re
+import threading
+import time
+import weakref
+
+import metrics
+
+# The question bank workbook ships with the app; QUESTION_BANK_SOURCE may point
+# at another local file or at an http(s) URL (e.g. the raw GitHub copy).
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_WORKBOOK = os.path.join(BASE_DIR, 'Questions 2.0 (5).xlsx')
+QUESTION_BANK_SOURCE = os.environ.get('QUESTION_BANK_SOURCE', BUNDLED_WORKBOOK)
+# Seconds between checks of the source for changes
+CHECK_INTERVAL = float(os.environ.get('QUESTION_BANK_CHECK_INTERVAL', '60'))
+# Questions drawn per style for each participant
+QUESTIONS_PER_STYLE = 5
+# Precompiled snapshot of the parsed bank, so startup needs neither pandas nor the network.
+# The bundled workbook's snapshot is checked in; rebuild it with
+# 'python question_bank.py build' whenever the workbook changes.
+SNAPSHOT_FILE = os.environ.get('QUESTION_BANK_SNAPSHOT', os.path.join(BASE_DIR, 'question_bank.snapshot'))
+SNAPSHOT_MAGIC = b'QBSNAP1\n'
+# Cohorts: a participant who enters a cohort code gets that cohort's bank, read from
+# COHORT_SOURCE with {code} filled in (a local path or an http(s) URL). Banks are loaded
+# on first use and at most COHORT_CACHE_SIZE cohorts are kept, least recently used
+# first out. No code means the default bank above.
+COHORT_SOURCE = os.environ.get('COHORT_SOURCE', os.path.join(BASE_DIR, 'cohorts', '{code}.xlsx'))
+COHORT_CACHE_SIZE = int(os.environ.get('COHORT_CACHE_SIZE', '32'))
+COHORT_CODE_PATTERN = re.compile(r'[a-z0-9][a-z0-9_-]{0,31}')
+
+STYLE_NUM_TO_NAME = {
+    1: 'Transformational',
+    2: 'Democratic',
+    3: 'Charismatic',
+    4: 'Autocratic',
+    5: 'Laissez-Faire',
+    6: 'Situational',
+    7: 'Transactional',
+    8: 'Servant'
+}
+STYLES = list(STYLE_NUM_TO_NAME.values())
+TENDENCIES = ('Low', 'Moderate', 'High')
+
+
+class QuestionBank:
+    def __init__(self, version, questions, survey_questions, descriptions):
+        # version: sha256 of the workbook bytes the bank was parsed from
+        # questions: tuple of (question text, style number) in workbook order
+        # descriptions: {(style name, tendency): description}
+        self.version = version
+        self.questions = questions
+        self.survey_questions = survey_questions
+        self.descriptions = descriptions
+        # Every (style, tendency) the results page can ask for, fallback text included
+        self.description_index = {(style, tendency): descriptions.get((style, tendency), f"No description found for {style} ({tendency})")
+                                  for style in STYLES for tendency in TENDENCIES}
+        self.question_to_style = {q: STYLE_NUM_TO_NAME.get(s, s) for q, s in questions}
+        # style number -> tuple of question ids (indexes into self.questions)
+        style_index = {}
+        for question_id, (_, style) in enumerate(questions):
+            style_index.setdefault(style, []).append(question_id)
+        self.style_index = {style: tuple(ids) for style, ids in sorted(style_index.items())}
+
+    def draw_question_set(self, seed, per_style=QUESTIONS_PER_STYLE):
+        # Deterministic for a given seed, so a session only needs to keep the seed.
+        # random.sample on a tuple touches O(per_style) elements, not the whole style.
+        rng = random.Random(seed)
+        question_ids = []
+        for ids in self.style_index.values():
+            question_ids.extend(rng.sample(ids, min(per_style, len(ids))))
+        rng.shuffle(question_ids)
+        return question_ids
+
+    def question_texts(self, question_ids):
+        questions = self.questions
+        return [questions[question_id][0] for question_id in question_ids]
+
+    def description(self, style, tendency):
+        return self.description_index.get((style, tendency), f"No description found for {style} ({tendency})")
+
+
+class UnknownCohort(LookupError):
+    pass
+
+
+# Parsed banks by workbook sha256: cohorts (and reloads) whose workbooks have the same
+# bytes share one QuestionBank instead of each holding a copy
+_shared_banks = weakref.WeakValueDictionary()
+_shared_lock = threading.Lock()
+
+
+def _share(bank):
+    with _shared_lock:
+        return _shared_banks.setdefault(bank.version, bank)
+
+
+def _is_url(source):
+    return source.startswith('http://') or source.startswith('https://')
+
+
+def parse_workbook(data):
+    # pandas/openpyxl are only needed when the workbook actually has to be parsed
+    import pandas as pd
+    sheets = pd.read_excel(io.BytesIO(data), sheet_name=['Questions', 'SurveyQuestions', 'ScoreBasedResponse'], engine='openpyxl')
+    questions_df = sheets['Questions'].dropna(subset=['Question', 'Style_Num'])
+    questions = tuple((str(q), int(s)) for q, s in zip(questions_df['Question'], questions_df['Style_Num']))
+    survey_questions = tuple(str(q) for q in sheets['SurveyQuestions']['Question'].dropna())
+    response_df = sheets['ScoreBasedResponse'].dropna(subset=['Leadership Style', 'Tendency'])
+    descriptions = {}
+    for style, tendency, description in zip(response_df['Leadership Style'], response_df['Tendency'], response_df['Description']):
+        # First match wins, as with the old DataFrame filter
+        descriptions.setdefault((str(style), str(tendency)), str(description))
+    return _share(QuestionBank(hashlib.sha256(data).hexdigest(), questions, survey_questions, descriptions))
+
+
+def write_snapshot(bank, path=SNAPSHOT_FILE):
+    # Layout: magic line, sha256 of the payload, then a pickle of plain tuples/dicts
+    payload = pickle.dumps((bank.version, bank.questions, bank.survey_questions, bank.descriptions),
+                           protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + hashlib.sha256(payload).hexdigest().encode() + b'\n' + payload)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    with open(path, 'rb') as f:
+        data = f.read()
+    header_len = len(SNAPSHOT_MAGIC) + 65
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError(f"{path} is not a question bank snapshot")
+    payload = data[header_len:]
+    if hashlib.sha256(payload).hexdigest().encode() != data[len(SNAPSHOT_MAGIC):header_len - 1]:
+        raise ValueError(f"{path} is corrupt (payload hash mismatch)")
+    return _share(QuestionBank(*pickle.loads(payload)))
+
+
+def build_snapshot(source, path=SNAPSHOT_FILE):
+    with open(source, 'rb') as f:
+        bank = parse_workbook(f.read())
+    write_snapshot(bank, path)
+    return bank
+
+
+class _Loader:
+    def __init__(self, source, snapshot_path=SNAPSHOT_FILE, fallback=True):
+        self.source = source
+        self.snapshot_path = snapshot_path
+        # Whether a first load that fails falls back to the bundled workbook
+        self.fallback = fallback
+        self.bank = None
+        self.etag = None
+        self.stat = None
+        self.last_check = 0.0
+        self.lock = threading.Lock()
+
+    def _fetch(self):
+        # Returns the workbook bytes, or None if the source is unchanged
+        if _is_url(self.source):
+            import requests
+            headers = {'If-None-Match': self.etag} if self.etag and self.bank else {}
+            resp = requests.get(self.source, headers=headers, timeout=10)
+            if resp.status_code == 304:
+                return None
+            resp.raise_for_status()
+            self.etag = resp.headers.get('ETag')
+            return resp.content
+        st = os.stat(self.source)
+        stat = (st.st_mtime_ns, st.st_size)
+        if self.bank is not None and stat == self.stat:
+            return None
+        with open(self.source, 'rb') as f:
+            data = f.read()
+        self.stat = stat
+        return data
+
+    def _load_snapshot(self):
+        try:
+            bank = load_snapshot(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring question bank snapshot: {e}")
+            return None
+        if _is_url(self.source):
+            # Serve from the snapshot right away; the remote copy is checked after CHECK_INTERVAL
+            self.bank = bank
+            self.last_check = time.monotonic()
+            return bank
+        # A local workbook is cheap to hash, so only trust a snapshot built from the same bytes
+        try:
+            st = os.stat(self.source)
+            with open(self.source, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != bank.version:
+                    return None
+            self.stat = (st.st_mtime_ns, st.st_size)
+        except OSError as e:
+            print(f"Question bank source {self.source} unreadable ({e}); using snapshot")
+        self.bank = bank
+        self.last_check = time.monotonic()
+        return bank
+
+    def refresh(self):
+        with self.lock, metrics.span('question_bank.refresh'):
+            self.last_check = time.monotonic()
+            try:
+                data = self._fetch()
+            except Exception as e:
+                if self.bank is None and self.fallback and self.source != BUNDLED_WORKBOOK:
+                    # Never start without questions: fall back to the bundled workbook
+                    print(f"Question bank source {self.source} unavailable ({e}); using bundled workbook")
+                    with open(BUNDLED_WORKBOOK, 'rb') as f:
+                        data = f.read()
+                elif self.bank is None:
+                    raise
+                else:
+                    print(f"Question bank refresh failed, keeping version {self.bank.version[:12]}: {e}")
+                    return self.bank
+            version = hashlib.sha256(data).hexdigest() if data is not None else None
+            if version is not None and (self.bank is None or version != self.bank.version):
+                # Another cohort may already have parsed the same workbook
+                self.bank = _shared_banks.get(version) or parse_workbook(data)
+                try:
+                    write_snapshot(self.bank, self.snapshot_path)
+                except OSError as e:
+                    print(f"Could not write question bank snapshot: {e}")
+            return self.bank
+
+    def get(self):
+        if self.bank is None:
+            with self.lock:
+                if self.bank is None:
+                    self._load_snapshot()
+        if self.bank is None or time.monotonic() - self.last_check >= CHECK_INTERVAL:
+            return self.refresh()
+        return self.bank
+
+
+_loader = _Loader(QUESTION_BANK_SOURCE)
+# cohort code -> _Loader, most recently used last
+_cohort_loaders = collections.OrderedDict()
+_cohort_lock = threading.Lock()
+
+
+def normalize_cohort(code):
+    # Cohort codes are case-insensitive; '' is the default cohort
+    code = (code or '').strip().lower()
+    if code and not COHORT_CODE_PATTERN.fullmatch(code):
+        raise UnknownCohort(code)
+    return code
+
+
+def _cohort_loader(code):
+    with _cohort_lock:
+        loader = _cohort_loaders.get(code)
+        if loader is not None:
+            _cohort_loaders.move_to_end(code)
+            return loader
+    snapshot_path = os.path.join(os.path.dirname(SNAPSHOT_FILE), f'question_bank.{code}.snapshot')
+    loader = _Loader(COHORT_SOURCE.format(code=code), snapshot_path, fallback=False)
+    try:
+        loader.get()
+    except Exception as e:
+        # Not cached, so a workbook added later is picked up on the next attempt
+        print(f"Question bank for cohort {code} unavailable: {e}")
+        raise UnknownCohort(code) from e
+    with _cohort_lock:
+        loader = _cohort_loaders.setdefault(code, loader)
+        _cohort_loaders.move_to_end(code)
+        while len(_cohort_loaders) > COHORT_CACHE_SIZE:
+            _cohort_loaders.popitem(last=False)
+    return loader
+
+
+def get_bank(cohort=''):
+    # Shared, process-wide question bank for a cohort; reparsed only when its source
+    # changes. Raises UnknownCohort for a code without a workbook.
+    cohort = normalize_cohort(cohort)
+    if not cohort:
+        return _loader.get()
+    return _cohort_loader(cohort).get()
+
+
+def loaded_cohorts():
+    with _cohort_lock:
+        return len(_cohort_loaders)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the question bank workbook into a snapshot')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('workbook', nargs='?', default=BUNDLED_WORKBOOK)
+    parser.add_argument('-o', '--output', default=SNAPSHOT_FILE)
+    args = parser.parse_args()
+    bank = build_snapshot(args.workbook, args.output)
+    print(f"Wrote {args.output}: {len(bank.questions)} questions, {len(bank.survey_questions)} survey questions, "
+          f"{len(bank.descriptions)} descriptions (sha256 {bank.version})")
@@ -0,0 +1,339 @@
+import argparse
+import concurrent.futures
+import datetime
+import fcntl
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import textwrap
+import threading
+import time
+import uuid
+import zipfile
+
+import charts
+import export
+import question_bank
+import results_summary
+
+# Printable per-participant reports (chart, scores and descriptions) for a filtered set
+# of sessions, rendered by a pool of processes. Each job lives in REPORT_DIR/<job id>:
+# status.json, which any worker can serve to a polling admin, the rendered files while
+# the job runs, then reports.zip.
+REPORT_DIR = os.environ.get('REPORT_DIR', 'reports')
+# Rendering processes per job; 0 uses every core
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '0')) or os.cpu_count() or 1
+# Sessions handed to a process at a time
+REPORT_CHUNK_SIZE = int(os.environ.get('REPORT_CHUNK_SIZE', '25'))
+# Jobs, and cached charts no job has used since, are deleted after this many hours
+REPORT_RETENTION_HOURS = float(os.environ.get('REPORT_RETENTION_HOURS', '24'))
+# Sessions read from the storage per page
+REPORT_PAGE_SIZE = 500
+
+REPORT_FORMATS = ('html', 'pdf')
+# Chart file each format embeds
+CHART_FORMATS = {'html': 'svg', 'pdf': 'png'}
+JOB_ID = re.compile(r'[0-9a-f]{32}')
+FINISHED = ('done', 'failed')
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_templates = None
+
+
+def _job_dir(job_id):
+    return os.path.join(REPORT_DIR, job_id)
+
+
+def chart_dir():
+    # Shared by all jobs: a score vector's chart is rendered once and reused until it
+    # goes unused for REPORT_RETENTION_HOURS
+    return os.path.join(REPORT_DIR, 'charts')
+
+
+def zip_path(job_id):
+    return os.path.join(_job_dir(job_id), 'reports.zip')
+
+
+def _write_status(job_id, status):
+    path = os.path.join(_job_dir(job_id), 'status.json')
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, 'w') as f:
+        json.dump(status, f)
+    os.replace(temporary, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def status(job_id):
+    # The job's status dict, or None for an unknown job. A job whose process has gone
+    # away (a restarted worker) reads as failed.
+    if not JOB_ID.fullmatch(job_id or ''):
+        return None
+    try:
+        with open(os.path.join(_job_dir(job_id), 'status.json')) as f:
+            job = json.load(f)
+    except FileNotFoundError:
+        return None
+    if job['state'] not in FINISHED and job['host'] == os.uname().nodename and not _alive(job['pid']):
+        job.update(state='failed', error='The process running this job exited')
+    return job
+
+
+# Rendering, in the pool's processes
+
+def _cached_chart(directory, scores, fmt):
+    # -> (path, whether it had to be rendered)
+    path = os.path.join(directory, f"{charts.chart_key(scores)}.{fmt}")
+    if os.path.exists(path):
+        os.utime(path)
+        return path, False
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(charts.render_chart(scores, fmt))
+    os.replace(temporary, path)
+    return path, True
+
+
+def report_name(item, fmt):
+    return f"{re.sub(r'[^A-Za-z0-9._-]+', '_', item['email']) or 'participant'}_{item['id']}.{fmt}"
+
+
+def _render_html(path, item, chart_path):
+    global _templates
+    if _templates is None:
+        import jinja2
+        _templates = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(BASE_DIR, 'templates')), autoescape=True)
+    html = _templates.get_template('report.html').render(
+        item=item, chart=f"charts/{os.path.basename(chart_path)}", intro_paragraph=results_summary.INTRO_PARAGRAPH,
+        tendency_explanations=results_summary.TENDENCY_EXPLANATIONS, tendencies=('High', 'Moderate', 'Low'))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+
+
+# Characters per line of body text on an A4 page
+PDF_WRAP = 95
+
+
+def _pdf_lines(item):
+    # (text, font size, weight, family) per line of the text that follows the chart
+    yield 'Scores', 12, 'bold', 'sans-serif'
+    for row in item['summary']:
+        yield f"{row['style']:<20}{row['score']:>5}   {row['tendency']}", 10, 'normal', 'monospace'
+    yield '', 10, 'normal', 'sans-serif'
+    for line in textwrap.wrap(results_summary.INTRO_PARAGRAPH, PDF_WRAP):
+        yield line, 9, 'normal', 'sans-serif'
+    for tendency in ('High', 'Moderate', 'Low'):
+        yield '', 9, 'normal', 'sans-serif'
+        yield f"{tendency} Tendency", 12, 'bold', 'sans-serif'
+        for line in textwrap.wrap(results_summary.TENDENCY_EXPLANATIONS[tendency], PDF_WRAP):
+            yield line, 9, 'italic', 'sans-serif'
+        for row in item['summary']:
+            if row['tendency'] == tendency:
+                yield row['style'], 10, 'bold', 'sans-serif'
+                for line in textwrap.wrap(row['description'], PDF_WRAP):
+                    yield line, 9, 'normal', 'sans-serif'
+
+
+def _render_pdf(path, item, chart_path):
+    # A4 pages laid out with matplotlib, which the app already depends on
+    import matplotlib.image
+    from matplotlib.backends.backend_pdf import PdfPages
+    from matplotlib.figure import Figure
+    with PdfPages(path, metadata={'Title': f"Leadership Style Assessment: {item['name']}"}) as pdf:
+        fig = Figure(figsize=(8.27, 11.69))
+        fig.text(0.08, 0.95, 'Leadership Style Assessment Results', fontsize=16, weight='bold')
+        fig.text(0.08, 0.925, ' · '.join(filter(None, [item['name'], item['email'], item['timestamp'], item['cohort']])),
+                 fontsize=10, color='#555555')
+        ax = fig.add_axes([0.06, 0.58, 0.88, 0.33])
+        ax.imshow(matplotlib.image.imread(chart_path))
+        ax.axis('off')
+        y = 0.55
+        for text, size, weight, family in _pdf_lines(item):
+            if y < 0.06:
+                pdf.savefig(fig)
+                fig = Figure(figsize=(8.27, 11.69))
+                y = 0.95
+            fig.text(0.08, y, text, fontsize=size, weight='bold' if weight == 'bold' else 'normal',
+                     style='italic' if weight == 'italic' else 'normal', family=family)
+            y -= size * 1.5 / (11.69 * 72)
+        pdf.savefig(fig)
+
+
+def render_chunk(directory, charts_directory, fmt, items):
+    # Pool task: writes one report per item into directory. The directories are passed
+    # in, since a spawned process sees REPORT_DIR as the environment set it, not as the
+    # parent may have changed it since.
+    # -> (reports written, [(session id, error)], charts rendered)
+    written, failed, rendered = 0, [], 0
+    for item in items:
+        try:
+            chart_path, new = _cached_chart(charts_directory, item['scores'], CHART_FORMATS[fmt])
+            rendered += new
+            path = os.path.join(directory, report_name(item, fmt))
+            if fmt == 'html':
+                _render_html(path, item, chart_path)
+            else:
+                _render_pdf(path, item, chart_path)
+            written += 1
+        except Exception as e:
+            failed.append((item['id'], str(e)))
+    return written, failed, rendered
+
+
+# Jobs
+
+def iter_items(store, email=None, start=None, end=None, cohort=None):
+    # Sessions matching the filters, newest first, with the scores stored when they were
+    # submitted and the descriptions of their cohort's question bank
+    banks = {}
+    before = None
+    while True:
+        sessions, has_more = store.session_page(REPORT_PAGE_SIZE, email=email, start=start, end=end, before=before,
+                                                cohort=cohort)
+        for session in sessions:
+            bank = banks.get(session['cohort'])
+            if bank is None:
+                try:
+                    bank = question_bank.get_bank(session['cohort'])
+                except question_bank.UnknownCohort:
+                    bank = question_bank.get_bank()
+                banks[session['cohort']] = bank
+            summary = results_summary.build_summary(bank, session['scores'])['style_summaries']
+            yield {
+                'id': session['id'],
+                'name': export.participant_name(session['email']),
+                'email': session['email'],
+                'cohort': session['cohort'],
+                'timestamp': export.format_timestamp(session['timestamp']),
+                'scores': [session['scores'][style] for style in question_bank.STYLES],
+                'summary': [dict(row, score=session['scores'][row['style']]) for row in summary],
+            }
+        if not has_more or not sessions:
+            break
+        before = (sessions[-1]['timestamp'], sessions[-1]['id'])
+
+
+def _prune():
+    cutoff = time.time() - REPORT_RETENTION_HOURS * 3600
+    for name in os.listdir(REPORT_DIR):
+        path = os.path.join(REPORT_DIR, name)
+        if JOB_ID.fullmatch(name) and os.path.getmtime(path) < cutoff:
+            job = status(name)
+            if job is None or job['state'] in FINISHED:
+                shutil.rmtree(path, ignore_errors=True)
+    for name in os.listdir(chart_dir()):
+        path = os.path.join(chart_dir(), name)
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+
+
+def run_job(job_id, store, filters, fmt, workers=REPORT_WORKERS):
+    # Renders the job's reports and zips them, keeping status.json current. One job runs
+    # at a time per REPORT_DIR (each already uses every core); others wait queued.
+    job = status(job_id)
+    started = time.time()
+    with open(os.path.join(REPORT_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            _prune()
+            job.update(state='running', started_at=datetime.datetime.now().isoformat(sep=' ', timespec='seconds'))
+            _write_status(job_id, job)
+            items = list(iter_items(store, **filters))
+            directory = os.path.join(_job_dir(job_id), 'files')
+            os.makedirs(directory, exist_ok=True)
+            chunks = [items[i:i + REPORT_CHUNK_SIZE] for i in range(0, len(items), REPORT_CHUNK_SIZE)]
+            job['total'] = len(items)
+            _write_status(job_id, job)
+            last_write = time.monotonic()
+            if chunks:
+                # Spawned, not forked: the job runs on a thread of a multi-threaded server,
+                # and a fork would copy whatever locks the other threads held at the time
+                with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(chunks)),
+                                                            mp_context=multiprocessing.get_context('spawn')) as pool:
+                    futures = [pool.submit(render_chunk, directory, chart_dir(), fmt, chunk) for chunk in chunks]
+                    for future in concurrent.futures.as_completed(futures):
+                        written, failed, rendered = future.result()
+                        job['done'] += written
+                        job['failed'] += len(failed)
+                        job['charts_rendered'] += rendered
+                        job['errors'] = (job['errors'] + [f"session {session_id}: {error}" for session_id, error in failed])[:20]
+                        if time.monotonic() - last_write >= 0.5:
+                            job['seconds'] = round(time.time() - started, 1)
+                            _write_status(job_id, job)
+                            last_write = time.monotonic()
+            job['state'] = 'zipping'
+            _write_status(job_id, job)
+            temporary = zip_path(job_id) + '.tmp'
+            with zipfile.ZipFile(temporary, 'w', zipfile.ZIP_DEFLATED) as zf:
+                included = set()
+                for item in items:
+                    name = report_name(item, fmt)
+                    if not os.path.exists(os.path.join(directory, name)):
+                        continue
+                    zf.write(os.path.join(directory, name), name)
+                    chart = f"{charts.chart_key(item['scores'])}.{CHART_FORMATS[fmt]}"
+                    # HTML reports link their chart; identical charts are stored once
+                    if fmt == 'html' and chart not in included:
+                        zf.write(os.path.join(chart_dir(), chart), f"charts/{chart}")
+                        included.add(chart)
+            os.replace(temporary, zip_path(job_id))
+            shutil.rmtree(directory, ignore_errors=True)
+            job['state'] = 'done'
+        except Exception as e:
+            job.update(state='failed', error=str(e))
+        job['seconds'] = round(time.time() - started, 1)
+        job['finished_at'] = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+        _write_status(job_id, job)
+    return job
+
+
+def create_job(filters, fmt):
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format: {fmt}")
+    job_id = uuid.uuid4().hex
+    os.makedirs(_job_dir(job_id))
+    os.makedirs(chart_dir(), exist_ok=True)
+    _write_status(job_id, {
+        'id': job_id, 'state': 'queued', 'format': fmt, 'filters': filters,
+        'created_at': datetime.datetime.now().isoformat(sep=' ', timespec='seconds'),
+        'host': os.uname().nodename, 'pid': os.getpid(),
+        'total': None, 'done': 0, 'failed': 0, 'charts_rendered': 0, 'errors': [], 'seconds': 0,
+    })
+    return job_id
+
+
+def start_job(store, filters, fmt):
+    # Runs the job on a background thread of this process; returns its id at once.
+    # filters: email, start, end, cohort as taken by the storage's session_page
+    job_id = create_job(filters, fmt)
+    thread = threading.Thread(target=run_job, args=(job_id, store, filters, fmt), name=f'report-{job_id[:8]}', daemon=True)
+    thread.start()
+    return job_id
+
+
+if __name__ == '__main__':
+    import storage
+    parser = argparse.ArgumentParser(description='Render per-participant reports for a set of sessions into a zip')
+    parser.add_argument('format', choices=REPORT_FORMATS)
+    parser.add_argument('--email')
+    parser.add_argument('--cohort', help="only this cohort's sessions ('' for the default cohort)")
+    parser.add_argument('--start', help='first day (YYYY-MM-DD)')
+    parser.add_argument('--end', help='day after the last (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, default=REPORT_WORKERS)
+    args = parser.parse_args()
+    filters = {'email': args.email, 'start': args.start, 'end': args.end, 'cohort': args.cohort}
+    job_id = create_job(filters, args.format)
+    job = run_job(job_id, storage.get_storage(), filters, args.format, args.workers)
+    print(json.dumps(job, indent=2))
+    if job['state'] == 'done':
+        print(f"Reports: {zip_path(job_id)}")
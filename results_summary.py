@@ -0,0 +1,58 @@
+import scoring
+
+# Static text of the results page, built once at import rather than on every request
+INTRO_PARAGRAPH = (
+    "It's important to remember that there is no right or wrong score in this assessment; rather, the "
+    "goal is to develop self-awareness as a leader. Each leadership style has its strengths and "
+    "challenges, and understanding your tendencies allows you to recognize how your approach "
+    "impacts others. By becoming more aware of your natural leadership style, you can adapt and "
+    "refine your methods to better meet the needs of your team and organization. Self-awareness "
+    "empowers you to make conscious decisions about when to lean into certain behaviors and "
+    "when to adjust your approach, ensuring you lead in a way that fosters growth, collaboration, "
+    "and positive outcomes."
+)
+TENDENCY_EXPLANATIONS = {
+    'High': (
+        "High Tendency: "
+        "If a person scores high in this assessment area, it suggests that they strongly exhibit behaviors "
+        "aligned with specific leadership styles. For example, a high score in democratic leadership "
+        "indicates a tendency to prioritize collaboration and actively involve team members in decision-"
+        "making. A high score in transformational leadership suggests a natural ability to inspire and "
+        "motivate others toward long-term goals and personal growth. These tendencies reflect an "
+        "individual who is skilled in creating an inclusive and visionary environment, fostering "
+        "engagement and innovation within their team."
+    ),
+    'Moderate': (
+        "Moderate Tendency: "
+        "If a person scores moderately in this assessment area, it indicates that they exhibit a balanced "
+        "approach to the behaviors associated with that leadership trait. They may demonstrate some "
+        "strength in the area, but also show room for improvement. For example, a moderate score in "
+        "decision-making suggests they are capable of making decisions, but may occasionally hesitate "
+        "or seek more input from others. Similarly, a moderate score in communication might indicate "
+        "that they communicate effectively at times, but could benefit from refining their clarity or "
+        "engagement with different audiences. Overall, they are likely adaptable, but may need to "
+        "develop more consistency in their approach to fully leverage their leadership potential."
+    ),
+    'Low': (
+        "Low Tendency: "
+        "If a person scores low in this assessment area, it suggests that they may find certain behaviors "
+        "associated with that leadership trait more challenging. For example, a low score in democratic "
+        "leadership might indicate a preference for making decisions independently, rather than "
+        "involving others in the decision-making process. A low score in servant leadership might suggest "
+        "a tendency to prioritize tasks over the well-being and development of team members. These "
+        "tendencies reflect areas where the individual may benefit from additional development or "
+        "practice to enhance their effectiveness in specific situations."
+    )
+}
+
+
+def build_summary(bank, scores):
+    # scores: {style: score} -> the summary the results page renders. Descriptions come
+    # from the bank's precompiled (style, tendency) index, so this is dict lookups only.
+    style_summaries = [{'style': style, 'tendency': tendency, 'description': bank.description(style, tendency)}
+                       for style, score, tendency in scoring.summarize(scores)]
+    return {
+        'intro_paragraph': INTRO_PARAGRAPH,
+        'tendency_explanations': TENDENCY_EXPLANATIONS,
+        'style_summaries': style_summaries
+    }
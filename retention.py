@@ -0,0 +1,370 @@
+import argparse
+import datetime
+import fcntl
+import gzip
+import os
+import re
+import shutil
+import threading
+import time
+
+import db
+import migrate
+import snapshot
+
+# Sessions older than RETENTION_DAYS move out of the live database into one gzipped
+# SQLite database per month under ARCHIVE_DIR (YYYY-MM.db.gz). An archive has the live
+# schema, so search and export run the same queries against it. 0 keeps everything live.
+# The dashboard totals count live sessions only, so archived months drop out of them.
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', '0'))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+# Months kept decompressed under ARCHIVE_DIR/cache for queries, least recently used evicted
+ARCHIVE_CACHE_SIZE = int(os.environ.get('ARCHIVE_CACHE_SIZE', '6'))
+# Seconds between background retention runs (dedupe, archive, incremental vacuum)
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', str(24 * 3600)))
+# Rows copied or deleted per transaction, so live writers are never held up for long
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '500'))
+# Free pages returned to the filesystem per incremental_vacuum step
+VACUUM_STEP_PAGES = int(os.environ.get('VACUUM_STEP_PAGES', '2000'))
+
+ARCHIVE_NAME = re.compile(r'(\d{4}-\d{2})\.db\.gz')
+
+# Hot row ids already copied into an archive, so a run that dies between writing the
+# archive and deleting the hot rows copies nothing twice when it is repeated. Survey and
+# summary ids are AUTOINCREMENT; session ids can be reused once deleted, so a session
+# also has to match on (email, timestamp).
+ARCHIVED_ROWS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS archived_rows (
+        kind TEXT NOT NULL,
+        hot_id INTEGER NOT NULL,
+        PRIMARY KEY (kind, hot_id)
+    ) WITHOUT ROWID
+'''
+
+
+def cutoff(days=RETENTION_DAYS, now=None):
+    # Sessions with a timestamp before this date are archived
+    now = now or datetime.datetime.now()
+    return (now - datetime.timedelta(days=days)).date().isoformat()
+
+
+def archive_path(month, directory=None):
+    return os.path.join(directory or ARCHIVE_DIR, f"{month}.db.gz")
+
+
+def months(directory=None):
+    # Archived months, newest first
+    try:
+        names = os.listdir(directory or ARCHIVE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((match.group(1) for match in map(ARCHIVE_NAME.fullmatch, names) if match), reverse=True)
+
+
+def _next_month(month):
+    year, number = map(int, month.split('-'))
+    return f"{year + number // 12:04d}-{number % 12 + 1:02d}"
+
+
+# Reading
+
+def _evict(cache, keep):
+    # Drops superseded copies of keep's month, then the least recently used months
+    month = os.path.basename(keep).split('.')[0]
+    copies = [os.path.join(cache, name) for name in os.listdir(cache) if name.endswith('.db')]
+    for path in copies:
+        if path != keep and os.path.basename(path).split('.')[0] == month:
+            os.remove(path)
+    copies = sorted((path for path in copies if os.path.exists(path) and path != keep), key=os.path.getmtime)
+    for path in copies[:max(0, len(copies) + 1 - ARCHIVE_CACHE_SIZE)]:
+        os.remove(path)
+
+
+def open_archive(month, directory=None):
+    # A read-only connection to one month, decompressed into the cache on first use.
+    # The copy is named after the archive's mtime, so a rewritten month is fetched anew;
+    # connections open on an evicted copy keep working until they are closed.
+    directory = directory or ARCHIVE_DIR
+    source = archive_path(month, directory)
+    cache = os.path.join(directory, 'cache')
+    path = os.path.join(cache, f"{month}.{os.stat(source).st_mtime_ns}.db")
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        os.makedirs(cache, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(source, 'rb') as src, open(temporary, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(temporary, path)
+        _evict(cache, path)
+    return snapshot.connect(path)
+
+
+def archive_connections(start=None, end=None, before=None, directory=None):
+    # (month, connection) for each archived month that can hold sessions in
+    # [start, end) older than the before cursor, newest first. Each connection is
+    # closed when the caller moves on to the next month.
+    for month in months(directory):
+        if (start and _next_month(month) + '-01' <= start) or (end and month + '-01' >= end) \
+                or (before and month + '-01' >= before[0]):
+            continue
+        conn = open_archive(month, directory)
+        try:
+            yield month, conn
+        finally:
+            conn.close()
+
+
+# Writing
+
+def _open_for_append(month, directory):
+    # The month's archive decompressed to a working file (or a new one), schema current
+    work = os.path.join(directory, f".{month}.building.db")
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(work + suffix):
+            os.remove(work + suffix)
+    if os.path.exists(archive_path(month, directory)):
+        with gzip.open(archive_path(month, directory), 'rb') as src, open(work, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    conn = db.connect(work)
+    migrate.upgrade(conn, verbose=False)
+    conn.execute(ARCHIVED_ROWS_SCHEMA)
+    return work, conn
+
+
+def _seal(month, work, conn, directory):
+    # Packs the working file and swaps it in for the month's archive
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.execute('VACUUM')
+    conn.close()
+    target = archive_path(month, directory)
+    temporary = f"{target}.{os.getpid()}.tmp"
+    with open(work, 'rb') as src, gzip.open(temporary, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    with open(temporary, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(temporary, target)
+    os.remove(work)
+
+
+def _archived(archive, kind, hot_ids):
+    done = set()
+    for first in range(0, len(hot_ids), RETENTION_BATCH_SIZE):
+        chunk = hot_ids[first:first + RETENTION_BATCH_SIZE]
+        done.update(row[0] for row in archive.execute(
+            f"SELECT hot_id FROM archived_rows WHERE kind = ? AND hot_id IN ({', '.join('?' * len(chunk))})", [kind, *chunk]))
+    return done
+
+
+def _delete_ids(conn, statement, ids):
+    for first in range(0, len(ids), RETENTION_BATCH_SIZE):
+        chunk = ids[first:first + RETENTION_BATCH_SIZE]
+        with db.transaction(conn):
+            for sql in statement:
+                conn.execute(sql.format(ids=', '.join('?' * len(chunk))), chunk)
+
+
+def _archive_month(conn, month, end, directory):
+    # Copies the month's sessions before end, its summary rows and the survey answers of
+    # its participants into the month's archive, then deletes the sessions and summary
+    # rows from the live database. -> (sessions, summary rows, ids of the survey rows
+    # the archive now holds)
+    start = month + '-01'
+    sessions = conn.execute('SELECT id, email, timestamp, cohort FROM assessment_sessions '
+                            'WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp, id', (start, end)).fetchall()
+    summary_ids = [row[0] for row in conn.execute('SELECT id FROM summary_results WHERE timestamp >= ? AND timestamp < ? ORDER BY id',
+                                                  (start, end))]
+    emails = sorted({row['email'] for row in sessions})
+    survey_ids = []
+    if not sessions and not summary_ids:
+        return 0, 0, survey_ids
+    work, archive = _open_for_append(month, directory)
+    try:
+        done = _archived(archive, 'session', [row['id'] for row in sessions])
+        for first in range(0, len(sessions), RETENTION_BATCH_SIZE):
+            with db.transaction(archive):
+                for row in sessions[first:first + RETENTION_BATCH_SIZE]:
+                    if row['id'] in done and archive.execute(db.SELECT_SESSION, (row['email'], row['timestamp'])).fetchone():
+                        continue
+                    answers = conn.execute('SELECT style, question, answer FROM session_answers WHERE session_id = ? ORDER BY position',
+                                           (row['id'],)).fetchall()
+                    db.insert_assessment(archive, row['email'], row['timestamp'], [tuple(answer) for answer in answers], row['cohort'])
+                    archive.execute("INSERT OR REPLACE INTO archived_rows (kind, hot_id) VALUES ('session', ?)", (row['id'],))
+        for first in range(0, len(summary_ids), RETENTION_BATCH_SIZE):
+            chunk = summary_ids[first:first + RETENTION_BATCH_SIZE]
+            done = _archived(archive, 'summary', chunk)
+            chunk = [hot_id for hot_id in chunk if hot_id not in done]
+            with db.transaction(archive):
+                for row in conn.execute(f"SELECT id, email, timestamp, style, score, tendency, description FROM summary_results "
+                                        f"WHERE id IN ({', '.join('?' * len(chunk))}) ORDER BY id", chunk):
+                    archive.execute(db.INSERT_SUMMARY, tuple(row)[1:])
+                    archive.execute("INSERT INTO archived_rows (kind, hot_id) VALUES ('summary', ?)", (row['id'],))
+        # Surveys belong to an email, not a session: every month holding one of its
+        # sessions gets a copy, so each archive exports and searches on its own
+        for first in range(0, len(emails), RETENTION_BATCH_SIZE):
+            chunk = emails[first:first + RETENTION_BATCH_SIZE]
+            rows = conn.execute(f"SELECT id, email, question, answer FROM survey_results "
+                                f"WHERE email IN ({', '.join('?' * len(chunk))}) ORDER BY id", chunk).fetchall()
+            done = _archived(archive, 'survey', [row['id'] for row in rows])
+            with db.transaction(archive):
+                for row in rows:
+                    if row['id'] not in done:
+                        archive.execute(db.INSERT_SURVEY, tuple(row)[1:])
+                        archive.execute("INSERT INTO archived_rows (kind, hot_id) VALUES ('survey', ?)", (row['id'],))
+            survey_ids.extend(row['id'] for row in rows)
+        _seal(month, work, archive, directory)
+    except BaseException:
+        archive.close()
+        os.remove(work)
+        raise
+    # Only now that the archive is on disk; the per style per day analytics keep counting
+    # archived sessions
+    _delete_ids(conn, ['DELETE FROM assessment_answers WHERE session_id IN ({ids})',
+                       'DELETE FROM session_summary WHERE session_id IN ({ids})',
+                       'DELETE FROM assessment_sessions WHERE id IN ({ids})'], [row['id'] for row in sessions])
+    _delete_ids(conn, ['DELETE FROM summary_results WHERE id IN ({ids})'], summary_ids)
+    return len(sessions), len(summary_ids), survey_ids
+
+
+def archive_sessions(conn, before, directory=None):
+    # Archives everything timestamped before the given date, one month at a time.
+    # -> {month: (sessions, summary rows)}
+    directory = directory or ARCHIVE_DIR
+    os.makedirs(directory, exist_ok=True)
+    old_months = [row[0] for row in conn.execute('''
+        SELECT substr(timestamp, 1, 7) FROM assessment_sessions WHERE timestamp < ?
+        UNION
+        SELECT substr(timestamp, 1, 7) FROM summary_results WHERE timestamp < ?
+        ORDER BY 1
+    ''', (before, before))]
+    archived, survey_ids = {}, set()
+    for month in old_months:
+        sessions, summaries, month_survey_ids = _archive_month(conn, month, min(before, _next_month(month) + '-01'), directory)
+        archived[month] = (sessions, summaries)
+        survey_ids.update(month_survey_ids)
+    # Survey answers stay live while their participant still has a live session. Only rows
+    # an archive holds are deleted: answers given since the copy stay live.
+    survey_ids = sorted(survey_ids)
+    for first in range(0, len(survey_ids), RETENTION_BATCH_SIZE):
+        chunk = survey_ids[first:first + RETENTION_BATCH_SIZE]
+        with db.transaction(conn):
+            conn.execute(f"DELETE FROM survey_results WHERE id IN ({', '.join('?' * len(chunk))}) "
+                         f"AND email NOT IN (SELECT email FROM assessment_sessions)", chunk)
+    return archived
+
+
+def dedupe_summaries(conn):
+    # summary_results gets a full set of rows per (email, timestamp); a row repeated within
+    # its set adds nothing. Identical sets at different timestamps stay, since a retake
+    # that scores the same is a result of its own. -> rows deleted
+    redundant = []
+    seen_key, seen = None, set()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute('SELECT id, email, timestamp, style, score, tendency, description FROM summary_results '
+                   'ORDER BY email, timestamp, id')
+    for row in cursor:
+        if row[1:3] != seen_key:
+            seen_key, seen = row[1:3], set()
+        if row[3:] in seen:
+            redundant.append(row[0])
+        else:
+            seen.add(row[3:])
+    _delete_ids(conn, ['DELETE FROM summary_results WHERE id IN ({ids})'], redundant)
+    return len(redundant)
+
+
+def compact(conn, full=False, step_pages=VACUUM_STEP_PAGES):
+    # Returns free pages to the filesystem a step at a time, each step its own short
+    # write transaction. Databases created before incremental auto_vacuum was switched
+    # on need one full VACUUM (full=True), which blocks writers while it runs.
+    # -> pages freed, or None if the database still needs the full VACUUM
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        if not full:
+            return None
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        before = conn.execute('PRAGMA page_count').fetchone()[0]
+        conn.execute('VACUUM')
+        return before - conn.execute('PRAGMA page_count').fetchone()[0]
+    freed = 0
+    while True:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            break
+        # The pragma only does its work as its result rows are stepped through
+        conn.execute(f'PRAGMA incremental_vacuum({step_pages})').fetchall()
+        freed += min(free, step_pages)
+        time.sleep(0.01)
+    # Also shrink the WAL, which otherwise keeps its high-water size
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    return freed
+
+
+def run(conn, days=RETENTION_DAYS, directory=None):
+    deduped = dedupe_summaries(conn)
+    archived = archive_sessions(conn, cutoff(days), directory) if days > 0 else {}
+    # Until the snapshot is retaken it still has the sessions just archived, and admin
+    # pages reading both would show them twice
+    if any(sessions for sessions, _ in archived.values()) and snapshot.enabled():
+        snapshot.refresh_if_stale(0)
+    freed = compact(conn)
+    return deduped, archived, freed
+
+
+def _report(deduped, archived, freed):
+    for month, (sessions, summaries) in archived.items():
+        print(f"Archived {month}: {sessions} sessions, {summaries} summary rows")
+    print(f"Removed {deduped} duplicate summary rows")
+    if freed is None:
+        print("Incremental vacuum is off for this database; run `python retention.py compact --full` once")
+    else:
+        print(f"Freed {freed} pages")
+
+
+def start(interval=RETENTION_INTERVAL, days=RETENTION_DAYS):
+    # Every worker wakes on the interval; the lock file lets one of them do the run
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                os.makedirs(ARCHIVE_DIR, exist_ok=True)
+                with open(os.path.join(ARCHIVE_DIR, '.lock'), 'w') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    conn = db.connect()
+                    try:
+                        _report(*run(conn, days))
+                    finally:
+                        conn.close()
+            except Exception as e:
+                print(f"Retention run failed, will retry: {e}")
+    thread = threading.Thread(target=loop, name='retention', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Archive old sessions, dedupe summary rows and compact the database')
+    parser.add_argument('command', choices=['run', 'archive', 'dedupe', 'compact', 'months'])
+    parser.add_argument('--db', default=db.DB_FILE)
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS, help='archive sessions older than this many days')
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--full', action='store_true', help='compact: one-off VACUUM enabling incremental vacuum')
+    args = parser.parse_args()
+    conn = db.connect(args.db)
+    if args.command == 'months':
+        for month in months(args.archive_dir):
+            print(f"{month} {os.path.getsize(archive_path(month, args.archive_dir)):>12} bytes")
+    elif args.command == 'run':
+        _report(*run(conn, args.days, args.archive_dir))
+    elif args.command == 'archive':
+        if args.days <= 0:
+            parser.error('--days (or RETENTION_DAYS) must be positive')
+        _report(0, archive_sessions(conn, cutoff(args.days), args.archive_dir), 0)
+    elif args.command == 'dedupe':
+        print(f"Removed {dedupe_summaries(conn)} duplicate summary rows")
+    else:
+        freed = compact(conn, args.full)
+        _report(0, {}, freed)
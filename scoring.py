@@ -0,0 +1,152 @@
+import argparse
+import time
+
+from question_bank import STYLE_NUM_TO_NAME, STYLES, TENDENCIES
+
+# Raw 1-5 rating -> contribution to its style's score; anything else counts 0
+ANSWER_SCORES = {1: -2, 2: -1, 3: 0, 4: 1, 5: 2}
+# Inclusive score ranges per tendency; scores outside both ranges are Low
+HIGH_RANGE = (5, 10)
+MODERATE_RANGE = (0, 4)
+# Tendency codes used by the batch scorer, as indexes into TENDENCIES
+LOW, MODERATE, HIGH = range(3)
+
+# Answers arrive as strings from forms and integers from SQLite
+_SCORE_LOOKUP = {**ANSWER_SCORES, **{str(answer): score for answer, score in ANSWER_SCORES.items()}}
+# style name -> column in the batch score matrix
+STYLE_COLUMNS = {style: column for column, style in enumerate(STYLES)}
+
+
+def answer_score(answer):
+    return _SCORE_LOOKUP.get(answer, 0)
+
+
+def tendency(score):
+    if HIGH_RANGE[0] <= score <= HIGH_RANGE[1]:
+        return 'High'
+    if MODERATE_RANGE[0] <= score <= MODERATE_RANGE[1]:
+        return 'Moderate'
+    return 'Low'
+
+
+def score_submission(responses, question_to_style):
+    # responses: {question: answer} for one participant -> {style: score} over all styles.
+    # Unanswered questions and questions not in the bank are ignored.
+    scores = dict.fromkeys(STYLES, 0)
+    lookup = _SCORE_LOOKUP
+    for question, answer in responses.items():
+        style = question_to_style.get(question)
+        if style in scores and answer:
+            scores[style] += lookup.get(answer, 0)
+    return scores
+
+
+def summarize(scores):
+    # {style: score} -> [(style, score, tendency)] in STYLES order
+    values = [scores.get(style, 0) for style in STYLES]
+    return [(style, score, tendency(score)) for style, score in zip(STYLES, values)]
+
+
+# Vectorized scoring. Answers are an (N sessions x Q answers) integer array of raw
+# ratings, 0 where a position is unanswered or padding; styles is the matching array of
+# style columns (STYLE_COLUMNS values), or one length-Q row shared by every session.
+
+def _answer_table():
+    import numpy as np
+    # Indexed by raw rating; out-of-range ratings are clipped onto the 0 entries at either end
+    table = np.zeros(max(ANSWER_SCORES) + 2, dtype=np.int16)
+    for answer, score in ANSWER_SCORES.items():
+        table[answer] = score
+    return table
+
+
+def score_matrix(answers, styles):
+    # -> (N x 8) int array of style scores, one bincount over the whole batch
+    import numpy as np
+    answers = np.asarray(answers)
+    styles = np.broadcast_to(np.asarray(styles), answers.shape)
+    table = _answer_table()
+    values = table[np.clip(answers, 0, len(table) - 1)]
+    # Answers whose style is unknown (-1) do not count, as in score_submission()
+    known = styles >= 0
+    sessions = np.broadcast_to(np.arange(answers.shape[0])[:, None], answers.shape)
+    bins = (sessions * len(STYLES) + np.where(known, styles, 0))[known]
+    totals = np.bincount(bins, weights=values[known], minlength=answers.shape[0] * len(STYLES))
+    return totals.astype(np.int32).reshape(answers.shape[0], len(STYLES))
+
+
+def tendency_matrix(scores):
+    # Style scores (any shape) -> matching int8 array of LOW / MODERATE / HIGH codes
+    import numpy as np
+    scores = np.asarray(scores)
+    codes = np.full(scores.shape, LOW, dtype=np.int8)
+    codes[(scores >= MODERATE_RANGE[0]) & (scores <= MODERATE_RANGE[1])] = MODERATE
+    codes[(scores >= HIGH_RANGE[0]) & (scores <= HIGH_RANGE[1])] = HIGH
+    return codes
+
+
+def score_batch(answers, styles):
+    scores = score_matrix(answers, styles)
+    return scores, tendency_matrix(scores)
+
+
+def load_answer_matrix(conn):
+    # Every stored session as (session ids, answers, styles) arrays for score_batch().
+    # Sessions with fewer answers than the longest one are padded with unanswered slots.
+    import numpy as np
+    total, longest = conn.execute('SELECT COUNT(*), COALESCE(MAX(position), 0) FROM assessment_answers').fetchone()
+    session_ids = np.array([row[0] for row in conn.execute('SELECT id FROM assessment_sessions ORDER BY id')],
+                           dtype=np.int64)
+    width = max(longest, 1)
+    answers = np.zeros((len(session_ids), width), dtype=np.int8)
+    styles = np.full((len(session_ids), width), -1, dtype=np.int8)
+    if not len(session_ids) or not total:
+        return session_ids, answers, styles
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute('''
+        SELECT a.session_id, a.position, COALESCE(a.answer, 0), COALESCE(q.style_id, 0)
+        FROM assessment_answers a
+        JOIN questions q ON q.id = a.question_id
+    ''')
+    while True:
+        rows = cursor.fetchmany(100000)
+        if not rows:
+            break
+        chunk = np.array(rows, dtype=np.int64)
+        index = np.searchsorted(session_ids, chunk[:, 0])
+        position = chunk[:, 1] - 1
+        answers[index, position] = np.clip(chunk[:, 2], 0, 127)
+        # styles.id is the style number; columns follow STYLES, i.e. style number - 1
+        styles[index, position] = np.where(np.isin(chunk[:, 3], list(STYLE_NUM_TO_NAME)), chunk[:, 3] - 1, -1)
+    return session_ids, answers, styles
+
+
+# The same rules for queries that score inside SQLite
+
+def sql_answer_score(column):
+    cases = ' '.join(f'WHEN {answer} THEN {score}' for answer, score in ANSWER_SCORES.items())
+    return f'CASE {column} {cases} ELSE 0 END'
+
+
+def sql_tendency(expression):
+    return (f"CASE WHEN {expression} BETWEEN {HIGH_RANGE[0]} AND {HIGH_RANGE[1]} THEN 'High' "
+            f"WHEN {expression} BETWEEN {MODERATE_RANGE[0]} AND {MODERATE_RANGE[1]} THEN 'Moderate' "
+            f"ELSE 'Low' END")
+
+
+if __name__ == '__main__':
+    import db
+    parser = argparse.ArgumentParser(description='Rescore every stored session with the batch scorer')
+    parser.add_argument('command', choices=['rescore'])
+    parser.add_argument('--db', default=db.DB_FILE)
+    args = parser.parse_args()
+    t = time.perf_counter()
+    session_ids, answers, styles = load_answer_matrix(db.connect(args.db))
+    loaded = time.perf_counter()
+    scores, tendencies = score_batch(answers, styles)
+    scored = time.perf_counter()
+    print(f"Rescored {len(session_ids)} sessions: load {loaded - t:.2f}s, score {scored - loaded:.3f}s")
+    for column, style in enumerate(STYLES):
+        counts = [(tendencies[:, column] == code).sum() for code in range(len(TENDENCIES))]
+        print(f"{style:<18} " + '  '.join(f"{name} {count}" for name, count in zip(TENDENCIES, counts)))
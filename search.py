@@ -0,0 +1,112 @@
+import os
+
+from markupsafe import Markup, escape
+
+import db
+
+# Admin search: FTS5 over participant emails and survey answers (migration 7), combined
+# with indexed date, style and tendency filters on assessment_sessions / session_summary
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', '50'))
+# Words of context around each match in survey answer snippets
+SNIPPET_WORDS = 12
+
+_MARK_START, _MARK_END = '\x02', '\x03'
+
+
+def match_expression(text):
+    # Each word becomes a quoted prefix term and all of them must match, so nothing typed
+    # in the search box is ever parsed as FTS5 query syntax. None when there is nothing
+    # searchable.
+    terms = ['"' + word.replace('"', '""') + '"*' for word in text.split() if any(ch.isalnum() for ch in word)]
+    return ' '.join(terms) or None
+
+
+def highlight(snippet):
+    # FTS5 snippet with raw markers -> escaped HTML with the matches in <mark>
+    return Markup(str(escape(snippet)).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>'))
+
+
+def search_sessions(conn, text=None, start=None, end=None, style=None, tendency=None, before=None,
+                    limit=SEARCH_PAGE_SIZE, cohort=None):
+    # Sessions matching every given criterion, newest first by (timestamp, id), with the
+    # survey answers that matched the text. A text query matches the participant's email
+    # or any of their survey answers. before is the (timestamp, id) of the previous page's
+    # last row. -> (sessions, has_more)
+    where, params = [], []
+    match = match_expression(text) if text else None
+    if text and match is None:
+        return [], False
+    if match:
+        where.append('''(s.id IN (SELECT rowid FROM participant_search WHERE participant_search MATCH ?)
+                         OR s.email IN (SELECT r.email FROM survey_search
+                                        JOIN survey_results r ON r.id = survey_search.rowid
+                                        WHERE survey_search MATCH ?))''')
+        params.extend([match, match])
+    if cohort is not None:
+        where.append('s.cohort = ?')
+        params.append(cohort)
+    if start:
+        where.append('s.timestamp >= ?')
+        params.append(start)
+    if end:
+        where.append('s.timestamp < ?')
+        params.append(end)
+    if style in db.STYLE_IDS and tendency:
+        where.append(f'ss.tendency_{db.STYLE_IDS[style]} = ?')
+        params.append(tendency)
+    if before:
+        where.append('(s.timestamp, s.id) < (?, ?)')
+        params.extend(before)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(f'''
+        SELECT s.id, s.email, s.timestamp, s.cohort, {', '.join('ss.' + column for column in db.SUMMARY_SCORE_COLUMNS + db.SUMMARY_TENDENCY_COLUMNS)}
+        FROM assessment_sessions s
+        JOIN session_summary ss ON ss.session_id = s.id
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY s.timestamp DESC, s.id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+    has_more = len(rows) > limit
+    sessions = []
+    for row in rows[:limit]:
+        scores, tendencies = db.summary_dicts(row[4:])
+        sessions.append({'id': row[0], 'email': row[1], 'timestamp': row[2], 'cohort': row[3], 'scores': scores,
+                         'tendencies': tendencies, 'comments': []})
+    if match and sessions:
+        _attach_comments(cursor, match, sessions)
+    return sessions, has_more
+
+
+def search_sources(sources, limit=SEARCH_PAGE_SIZE, **criteria):
+    # search_sessions() over several databases holding successively older sessions (the
+    # live one, then archived months newest first), filling one page from as many as it
+    # takes. sources yields (label, conn); each session gets its source's label. A page
+    # filled exactly at the end of a source reports has_more, since older sources may
+    # still hold matches.
+    sessions = []
+    for label, conn in sources:
+        found, has_more = search_sessions(conn, limit=limit - len(sessions), **criteria)
+        for session in found:
+            session['source'] = label
+        sessions.extend(found)
+        if has_more or len(sessions) >= limit:
+            return sessions, True
+    return sessions, False
+
+
+def _attach_comments(cursor, match, sessions):
+    # Matching survey answers of the emails on this page, as highlighted snippets
+    by_email = {}
+    for session in sessions:
+        by_email.setdefault(session['email'], []).append(session)
+    rows = cursor.execute(f'''
+        SELECT r.email, r.question, snippet(survey_search, 0, ?, ?, '…', {SNIPPET_WORDS})
+        FROM survey_search
+        JOIN survey_results r ON r.id = survey_search.rowid
+        WHERE survey_search MATCH ? AND r.email IN ({', '.join('?' * len(by_email))})
+        ORDER BY r.id
+    ''', [_MARK_START, _MARK_END, match, *by_email]).fetchall()
+    for email, question, snippet in rows:
+        for session in by_email[email]:
+            session['comments'].append({'question': question, 'snippet': highlight(snippet)})
@@ -0,0 +1,162 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+# Where session data lives: 'sqlite' (default) or 'redis' (any Redis-protocol server)
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+SESSION_DB_FILE = os.environ.get('SESSION_DB_FILE', 'sessions.db')
+SESSION_REDIS_URL = os.environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+# Seconds a session survives without being written to
+SESSION_TTL = int(os.environ.get('SESSION_TTL', str(24 * 3600)))
+# Seconds between sweeps of expired sessions (SQLite only; Redis expires keys itself)
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', '600'))
+
+SID_BYTES = 32
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Set by regenerate(): the stored record to delete once the new id is saved
+        self.previous_sid = None
+
+    def regenerate(self):
+        # Moves the data to a fresh id, on a privilege change, so an id planted in the
+        # client before the change (session fixation) is worthless after it
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(SID_BYTES)
+        self.modified = True
+
+
+class SQLiteSessionStore:
+    def __init__(self, path=SESSION_DB_FILE):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute('''
+            CREATE TABLE IF NOT EXISTS web_sessions (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        self._connect().execute('CREATE INDEX IF NOT EXISTS idx_web_sessions_expires_at ON web_sessions (expires_at)')
+
+    def _connect(self):
+        # One autocommit connection per thread; every operation is a single statement
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def load(self, sid):
+        row = self._connect().execute('SELECT data FROM web_sessions WHERE id = ? AND expires_at > ?',
+                                      (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, data, ttl):
+        self._connect().execute('INSERT OR REPLACE INTO web_sessions (id, data, expires_at) VALUES (?, ?, ?)',
+                                (sid, data, time.time() + ttl))
+
+    def delete(self, sid):
+        self._connect().execute('DELETE FROM web_sessions WHERE id = ?', (sid,))
+
+    def sweep(self):
+        return self._connect().execute('DELETE FROM web_sessions WHERE expires_at <= ?', (time.time(),)).rowcount
+
+
+class RedisSessionStore:
+    prefix = 'session:'
+
+    def __init__(self, url=SESSION_REDIS_URL):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def load(self, sid):
+        data = self.client.get(self.prefix + sid)
+        return data.decode('utf-8') if data is not None else None
+
+    def save(self, sid, data, ttl):
+        self.client.set(self.prefix + sid, data, ex=ttl)
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+    def sweep(self):
+        # Keys carry their own TTL
+        return 0
+
+
+class ServerSideSessionInterface(SessionInterface):
+    # The cookie carries only a random session id; the data stays in the store
+    serializer = session_json_serializer
+
+    def __init__(self, store, ttl=SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and len(sid) <= 2 * SID_BYTES:
+            data = self.store.load(sid)
+            if data is not None:
+                try:
+                    return ServerSideSession(self.serializer.loads(data), sid=sid)
+                except ValueError:
+                    pass
+        return ServerSideSession(sid=secrets.token_urlsafe(SID_BYTES), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+        if not session:
+            if session.modified and (not session.new or session.previous_sid is not None):
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), self.ttl)
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+
+def create_store(backend=SESSION_BACKEND):
+    if backend == 'sqlite':
+        return SQLiteSessionStore()
+    if backend == 'redis':
+        return RedisSessionStore()
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+
+
+def start_sweeper(store, interval=SESSION_SWEEP_INTERVAL):
+    # Deletes expired sessions in the background; expired rows are already ignored on load
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                store.sweep()
+            except Exception as e:
+                print(f"Session sweep failed: {e}")
+    thread = threading.Thread(target=run, name='session-sweeper', daemon=True)
+    thread.start()
+    return thread
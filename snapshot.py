@@ -0,0 +1,180 @@
+import datetime
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+
+import db
+import storage
+
+# Admin pages and exports read a copy of DB_FILE taken with SQLite's online backup API
+# instead of the live database, so their long scans never compete with submissions.
+# SNAPSHOT_INTERVAL=0 turns this off and reads the live database.
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE', 'responses.snapshot.db')
+# Seconds between refreshes; the copy the admin sees is at most about this old
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', '60'))
+# Pages copied per backup step, and the pause between steps, so the copy's own I/O is
+# spread out on a large database
+SNAPSHOT_STEP_PAGES = int(os.environ.get('SNAPSHOT_STEP_PAGES', '4096'))
+SNAPSHOT_STEP_SLEEP = float(os.environ.get('SNAPSHOT_STEP_SLEEP_MS', '5')) / 1000
+
+_local = threading.local()
+
+
+def enabled():
+    # Only the SQLite backend has a file to copy; PostgreSQL readers do not block writers
+    return SNAPSHOT_INTERVAL > 0 and storage.STORAGE_BACKEND == 'sqlite'
+
+
+def taken_at(path=None):
+    # When the current snapshot was taken (the file's mtime is set to the backup's start)
+    try:
+        return os.stat(path or SNAPSHOT_FILE).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def refresh(source=None, target=None):
+    # Copies the database to a temporary file next to the target and renames it into
+    # place. Connections already open keep reading the copy they opened.
+    target = target or SNAPSHOT_FILE
+    started = time.time()
+    temporary = f"{target}.{os.getpid()}.tmp"
+    src = db.connect(source)
+    try:
+        dst = sqlite3.connect(temporary)
+        try:
+            # One read transaction across all the steps keeps the copy consistent; other
+            # connections' commits would otherwise restart it. In WAL mode it does not
+            # hold them up.
+            src.execute('BEGIN')
+            src.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+            src.backup(dst, pages=SNAPSHOT_STEP_PAGES, sleep=SNAPSHOT_STEP_SLEEP)
+            src.execute('COMMIT')
+            # The copy is opened immutable, which a WAL-mode file cannot be
+            dst.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            dst.close()
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    finally:
+        src.close()
+    os.utime(temporary, (started, started))
+    os.replace(temporary, target)
+    return time.time() - started
+
+
+def refresh_if_stale(interval=None, source=None, target=None):
+    # At most one process refreshes at a time; the others see the fresh copy when done.
+    # Returns the refresh's duration, or None if nothing was done.
+    target = target or SNAPSHOT_FILE
+    interval = SNAPSHOT_INTERVAL if interval is None else interval
+    taken = taken_at(target)
+    if taken is not None and time.time() - taken < interval:
+        return None
+    with open(f"{target}.lock", 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        # Another process may have refreshed while this one was checking
+        taken = taken_at(target)
+        if taken is not None and time.time() - taken < interval:
+            return None
+        return refresh(source, target)
+
+
+def _schema_version(conn):
+    # Newest migration applied (see migrate.py); None before the first one
+    try:
+        return conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def outdated(source=None, target=None):
+    # A snapshot from before a migration has the old schema whatever its age
+    if taken_at(target) is None:
+        return True
+    live, copy = db.connect(source), connect(target)
+    try:
+        return _schema_version(live) != _schema_version(copy)
+    finally:
+        live.close()
+        copy.close()
+
+
+def connect(path=None):
+    # A dedicated read-only connection; immutable skips locking, which is safe because
+    # the snapshot file is only ever replaced, never written in place
+    conn = sqlite3.connect(f"file:{path or SNAPSHOT_FILE}?mode=ro&immutable=1", uri=True,
+                           check_same_thread=False, cached_statements=64, factory=db.Connection)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def get_connection():
+    # One connection per thread to the newest snapshot, reopened after a refresh; the
+    # live database until the first snapshot exists
+    if not enabled():
+        return db.get_connection()
+    taken = taken_at()
+    if taken is None:
+        return db.get_connection()
+    if getattr(_local, 'taken', None) != taken or _local.pid != os.getpid():
+        if getattr(_local, 'conn', None) is not None and _local.pid == os.getpid():
+            _local.conn.close()
+        _local.conn = connect()
+        _local.taken = taken
+        _local.pid = os.getpid()
+    return _local.conn
+
+
+def open_reader():
+    # A connection of the caller's own, e.g. for a response that outlives the request
+    if enabled() and taken_at() is not None:
+        return connect()
+    return db.connect()
+
+
+class SnapshotStorage(storage.SQLiteStorage):
+    # The storage read API over the snapshot; there is nothing to set up or write
+    def _connect(self):
+        return get_connection()
+
+
+reader = SnapshotStorage()
+
+
+def freshness():
+    # For the admin pages: None when reading the live database
+    taken = taken_at() if enabled() else None
+    if taken is None:
+        return None
+    age = max(0, round(time.time() - taken))
+    return {
+        'taken_at': datetime.datetime.fromtimestamp(taken).isoformat(sep=' ', timespec='seconds'),
+        'age_seconds': age,
+        'age': f"{age} s" if age < 120 else f"{age // 60} min",
+    }
+
+
+def start_refresher(interval=SNAPSHOT_INTERVAL):
+    # Each worker checks on the interval; the file lock lets only one of them copy
+    def run():
+        first = True
+        while True:
+            try:
+                duration = refresh_if_stale(0 if first and outdated() else interval)
+                first = False
+                if duration is not None:
+                    print(f"Snapshot refreshed in {duration:.2f}s")
+            except Exception as e:
+                print(f"Snapshot refresh failed: {e}")
+            time.sleep(interval)
+    thread = threading.Thread(target=run, name='snapshot-refresher', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,517 @@
+import collections
+import contextlib
+import os
+import threading
+import time
+
+import db
+import metrics
+import scoring
+from question_bank import STYLE_NUM_TO_NAME
+
+# Where assessment data lives: 'sqlite' (default, the DB_FILE database) or 'postgres'.
+# Both implement the operations the participant flow and the results dashboard perform;
+# search, analytics, exports and the legacy backfill read the SQLite database directly.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+STORAGE_DSN = os.environ.get('STORAGE_DSN', 'postgresql://localhost/assessments')
+# PostgreSQL connections per worker process; callers beyond that wait for a free one
+STORAGE_POOL_SIZE = int(os.environ.get('STORAGE_POOL_SIZE', '8'))
+STORAGE_POOL_TIMEOUT = float(os.environ.get('STORAGE_POOL_TIMEOUT', '10'))
+
+
+class SQLiteStorage:
+    name = 'sqlite'
+
+    def __init__(self, path=None):
+        # None follows db.DB_FILE through db.get_connection()
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        if self.path is None:
+            return db.get_connection()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = db.connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def setup(self):
+        import migrate
+        conn = self._connect()
+        migrate.upgrade(conn)
+        # Marks the database as served, so a bulk import keeps its indexes; then recreates
+        # indexes a bulk import dropped and did not live to recreate
+        import bulk_import
+        bulk_import.hold_serving_lock(self.path)
+        bulk_import.recover(conn, self.path)
+        if migrate.backfill_pending(conn):
+            migrate.start_backfill_thread()
+
+    @contextlib.contextmanager
+    def batch(self):
+        # One transaction; everything written through the batch commits together
+        with db.transaction(self._connect()) as conn:
+            yield _SQLiteBatch(conn)
+
+    def save_assessment(self, email, timestamp, answers, cohort=''):
+        with self.batch() as batch:
+            return batch.insert_assessment(email, timestamp, answers, cohort)
+
+    def save_summary(self, email, timestamp, style_results):
+        with self.batch() as batch:
+            batch.insert_summary(email, timestamp, style_results)
+
+    def save_survey(self, email, survey_responses):
+        with self.batch() as batch:
+            batch.insert_survey(email, survey_responses)
+
+    def find_session(self, email, timestamp):
+        row = self._connect().execute(db.SELECT_SESSION, (email, timestamp)).fetchone()
+        return row[0] if row is not None else None
+
+    def session_scores(self, session_id):
+        return db.session_scores(self._connect(), session_id)
+
+    def session_page(self, limit, **filters):
+        return db.session_page(self._connect(), limit, **filters)
+
+    def dashboard_stats(self):
+        return db.dashboard_stats(self._connect())
+
+    def session_details(self, session_id):
+        return db.session_details(self._connect(), session_id)
+
+    def participant_details(self, email):
+        return db.participant_details(self._connect(), email)
+
+    def journal_offset(self, segment):
+        row = self._connect().execute('SELECT offset FROM journal_progress WHERE segment = ?', (segment,)).fetchone()
+        return row[0] if row else 0
+
+    def forget_segment(self, segment):
+        with db.transaction(self._connect()) as conn:
+            conn.execute('DELETE FROM journal_progress WHERE segment = ?', (segment,))
+
+
+class _SQLiteBatch:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def insert_assessment(self, email, timestamp, answers, cohort=''):
+        return db.insert_assessment(self.conn, email, timestamp, answers, cohort)
+
+    def insert_summary(self, email, timestamp, style_results):
+        # style_results: iterable of (style, score, tendency, description)
+        self.conn.executemany(db.INSERT_SUMMARY, [(email, timestamp, *row) for row in style_results])
+
+    def insert_survey(self, email, survey_responses):
+        # survey_responses: iterable of (question, answer)
+        self.conn.executemany(db.INSERT_SURVEY, [(email, question, answer) for question, answer in survey_responses])
+
+    def set_journal_offset(self, segment, offset):
+        self.conn.execute('INSERT OR REPLACE INTO journal_progress (segment, offset) VALUES (?, ?)', (segment, offset))
+
+
+# PostgreSQL. The schema mirrors the normalized SQLite one (migrations 3-5 and 8); it is
+# created on first start. Needs the psycopg (3) package.
+
+POSTGRES_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS styles (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+    '''CREATE TABLE IF NOT EXISTS questions (
+        id SERIAL PRIMARY KEY,
+        text TEXT NOT NULL,
+        style_id INTEGER REFERENCES styles(id),
+        UNIQUE (text, style_id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS assessment_sessions (
+        id BIGSERIAL PRIMARY KEY,
+        email TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        cohort TEXT NOT NULL DEFAULT '',
+        UNIQUE (email, timestamp)
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_assessment_sessions_timestamp ON assessment_sessions (timestamp, id)',
+    'CREATE INDEX IF NOT EXISTS idx_assessment_sessions_cohort_timestamp ON assessment_sessions (cohort, timestamp, id)',
+    '''CREATE TABLE IF NOT EXISTS assessment_answers (
+        session_id BIGINT NOT NULL REFERENCES assessment_sessions(id),
+        position INTEGER NOT NULL,
+        question_id INTEGER NOT NULL REFERENCES questions(id),
+        answer SMALLINT,
+        PRIMARY KEY (session_id, position)
+    )''',
+    f'''CREATE TABLE IF NOT EXISTS session_summary (
+        session_id BIGINT PRIMARY KEY REFERENCES assessment_sessions(id),
+        {', '.join(f'{column} INTEGER NOT NULL DEFAULT 0' for column in db.SUMMARY_SCORE_COLUMNS)},
+        {', '.join(f'{column} TEXT' for column in db.SUMMARY_TENDENCY_COLUMNS)}
+    )''',
+    '''CREATE TABLE IF NOT EXISTS summary_results (
+        id BIGSERIAL PRIMARY KEY,
+        email TEXT,
+        timestamp TEXT,
+        style TEXT,
+        score INTEGER,
+        tendency TEXT,
+        description TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_summary_results_email_timestamp ON summary_results (email, timestamp)',
+    '''CREATE TABLE IF NOT EXISTS survey_results (
+        id BIGSERIAL PRIMARY KEY,
+        email TEXT,
+        question TEXT,
+        answer TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_survey_results_email ON survey_results (email, id)',
+    'CREATE TABLE IF NOT EXISTS journal_progress (segment TEXT PRIMARY KEY, "offset" BIGINT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value BIGINT NOT NULL)',
+    '''CREATE OR REPLACE VIEW session_answers AS
+        SELECT s.id AS session_id, s.email, s.timestamp, a.position,
+               q.text AS question, st.name AS style, a.answer
+        FROM assessment_answers a
+        JOIN assessment_sessions s ON s.id = a.session_id
+        JOIN questions q ON q.id = a.question_id
+        LEFT JOIN styles st ON st.id = q.style_id''',
+]
+
+PG_REFRESH_SESSION_SUMMARY = f'''
+    INSERT INTO session_summary (session_id, {db.SUMMARY_COLUMNS})
+    SELECT %(session_id)s, {', '.join(db.SUMMARY_SCORE_COLUMNS)}, {', '.join(scoring.sql_tendency(column) for column in db.SUMMARY_SCORE_COLUMNS)}
+    FROM (
+        SELECT {', '.join(f'COALESCE(SUM(CASE q.style_id WHEN {style_id} THEN {db.SCORE_CASE} END), 0) AS score_{style_id}'
+                          for style_id in STYLE_NUM_TO_NAME)}
+        FROM assessment_answers a
+        JOIN questions q ON q.id = a.question_id
+        WHERE a.session_id = %(session_id)s
+    ) scores
+    ON CONFLICT (session_id) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in db.SUMMARY_SCORE_COLUMNS + db.SUMMARY_TENDENCY_COLUMNS)}
+'''
+
+
+def _timed(cursor, sql, params=None, many=False):
+    # Same query metrics as db.Cursor records for SQLite
+    start = time.perf_counter()
+    if many:
+        cursor.executemany(sql, params)
+    else:
+        cursor.execute(sql, params)
+    if metrics.METRICS_ENABLED:
+        label = metrics.statement_label(sql)
+        metrics.QUERY_DURATION.observe(time.perf_counter() - start, label)
+        if cursor.rowcount > 0:
+            metrics.QUERY_ROWS.inc(cursor.rowcount, label)
+    return cursor
+
+
+class ConnectionPool:
+    # At most size open connections per process, handed out one caller at a time. Idle
+    # connections are reused; a broken one is dropped and replaced on the next checkout.
+    def __init__(self, connect, size=STORAGE_POOL_SIZE, timeout=STORAGE_POOL_TIMEOUT):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Connections inherited across fork() belong to the parent and are never reused
+        self.pid = os.getpid()
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.idle = collections.deque()
+        self.opened = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._reset()
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No database connection free within {self.timeout}s (pool size {self.size})")
+        conn = None
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self.connect()
+                with self.lock:
+                    self.opened += 1
+            yield conn
+        finally:
+            if conn is not None:
+                if conn.closed or conn.broken:
+                    with self.lock:
+                        self.opened -= 1
+                else:
+                    with self.lock:
+                        self.idle.append(conn)
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {'size': self.size, 'open': self.opened, 'idle': len(self.idle)}
+
+
+class PostgresStorage:
+    name = 'postgres'
+
+    def __init__(self, dsn=STORAGE_DSN, pool_size=STORAGE_POOL_SIZE, pool_timeout=STORAGE_POOL_TIMEOUT):
+        import psycopg
+        self.psycopg = psycopg
+        self.dsn = dsn
+        self.pool = ConnectionPool(self._open, pool_size, pool_timeout)
+        # (question text, style id) -> questions.id, filled from committed batches only
+        self.question_ids = {}
+        self.question_ids_lock = threading.Lock()
+
+    def _open(self):
+        # Autocommit: reads are single statements, writes run in explicit transactions
+        return self.psycopg.connect(self.dsn, autocommit=True)
+
+    def setup(self):
+        with self.pool.connection() as conn, conn.transaction(), conn.cursor() as cursor:
+            # Workers starting together would otherwise race on CREATE IF NOT EXISTS
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('assessment_schema'))")
+            for statement in POSTGRES_SCHEMA:
+                cursor.execute(statement)
+            cursor.executemany('INSERT INTO styles (id, name) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+                               list(STYLE_NUM_TO_NAME.items()))
+            # Dashboard totals are counted once, then kept current by every batch
+            if cursor.execute('SELECT COUNT(*) FROM counters').fetchone()[0] == 0:
+                row = cursor.execute(db.COUNT_DASHBOARD_STATS).fetchone()
+                cursor.executemany('INSERT INTO counters (name, value) VALUES (%s, %s)',
+                                   list(zip(db.DASHBOARD_COUNTERS.values(), row)))
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self.pool.connection() as conn:
+            with conn.transaction(), conn.cursor() as cursor:
+                batch = _PostgresBatch(self, cursor)
+                yield batch
+            # Committed: the new question ids are safe to share
+            with self.question_ids_lock:
+                self.question_ids.update(batch.new_question_ids)
+
+    def save_assessment(self, email, timestamp, answers, cohort=''):
+        with self.batch() as batch:
+            return batch.insert_assessment(email, timestamp, answers, cohort)
+
+    def save_summary(self, email, timestamp, style_results):
+        with self.batch() as batch:
+            batch.insert_summary(email, timestamp, style_results)
+
+    def save_survey(self, email, survey_responses):
+        with self.batch() as batch:
+            batch.insert_survey(email, survey_responses)
+
+    @contextlib.contextmanager
+    def _cursor(self, dict_rows=False):
+        from psycopg.rows import dict_row
+        with self.pool.connection() as conn, conn.cursor(row_factory=dict_row if dict_rows else None) as cursor:
+            yield cursor
+
+    def find_session(self, email, timestamp):
+        with self._cursor() as cursor:
+            row = _timed(cursor, 'SELECT id FROM assessment_sessions WHERE email = %s AND timestamp = %s',
+                         (email, timestamp)).fetchone()
+        return row[0] if row is not None else None
+
+    def session_scores(self, session_id):
+        with self._cursor() as cursor:
+            row = _timed(cursor, f'''
+                SELECT {db.SUMMARY_COLUMNS}
+                FROM assessment_sessions s
+                LEFT JOIN session_summary ss ON ss.session_id = s.id
+                WHERE s.id = %s
+            ''', (session_id,)).fetchone()
+        return db.summary_dicts(row) if row else None
+
+    def session_page(self, limit, email=None, start=None, end=None, before=None, after=None, cohort=None):
+        # Same keyset paging as db.session_page()
+        where, params = [], []
+        if cohort is not None:
+            where.append('s.cohort = %s')
+            params.append(cohort)
+        if email:
+            where.append('s.email = %s')
+            params.append(email)
+        if start:
+            where.append('s.timestamp >= %s')
+            params.append(start)
+        if end:
+            where.append('s.timestamp < %s')
+            params.append(end)
+        if before:
+            where.append('(s.timestamp, s.id) < (%s, %s)')
+            params.extend(before)
+        elif after:
+            where.append('(s.timestamp, s.id) > (%s, %s)')
+            params.extend(after)
+        order = 'ASC' if after else 'DESC'
+        with self._cursor() as cursor:
+            rows = _timed(cursor, f'''
+                SELECT s.id, s.email, s.timestamp, s.cohort, {', '.join('ss.' + column for column in db.SUMMARY_SCORE_COLUMNS + db.SUMMARY_TENDENCY_COLUMNS)}
+                FROM assessment_sessions s
+                LEFT JOIN session_summary ss ON ss.session_id = s.id
+                {'WHERE ' + ' AND '.join(where) if where else ''}
+                ORDER BY s.timestamp {order}, s.id {order}
+                LIMIT %s
+            ''', params + [limit + 1]).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after:
+            rows.reverse()
+        sessions = []
+        for row in rows:
+            scores, tendencies = db.summary_dicts(row[4:])
+            sessions.append({'id': row[0], 'email': row[1], 'timestamp': row[2], 'cohort': row[3],
+                             'scores': scores, 'tendencies': tendencies})
+        return sessions, has_more
+
+    def dashboard_stats(self):
+        with self._cursor() as cursor:
+            values = dict(_timed(cursor, 'SELECT name, value FROM counters WHERE name = ANY(%s)',
+                                 (list(db.DASHBOARD_COUNTERS.values()),)).fetchall())
+        return {total: values.get(name, 0) for total, name in db.DASHBOARD_COUNTERS.items()}
+
+    def session_details(self, session_id):
+        with self._cursor(dict_rows=True) as cursor:
+            session = _timed(cursor, 'SELECT id, email, timestamp FROM assessment_sessions WHERE id = %s',
+                             (session_id,)).fetchone()
+            if session is None:
+                return None, [], []
+            answers = _timed(cursor, '''
+                SELECT question, style, answer
+                FROM session_answers
+                WHERE session_id = %s
+                ORDER BY position
+            ''', (session_id,)).fetchall()
+            surveys = _timed(cursor, '''
+                SELECT question, answer
+                FROM survey_results
+                WHERE id IN (SELECT MIN(id) FROM survey_results WHERE email = %s GROUP BY question)
+                ORDER BY id
+            ''', (session['email'],)).fetchall()
+        return session, answers, surveys
+
+    def participant_details(self, email):
+        with self._cursor(dict_rows=True) as cursor:
+            summary = _timed(cursor, 'SELECT * FROM summary_results WHERE email = %s ORDER BY style, id', (email,)).fetchall()
+            assessment = _timed(cursor, '''
+                SELECT email, timestamp, style, question, answer
+                FROM session_answers
+                WHERE email = %s
+                ORDER BY question, timestamp, position
+            ''', (email,)).fetchall()
+            survey = _timed(cursor, 'SELECT * FROM survey_results WHERE email = %s ORDER BY question, id', (email,)).fetchall()
+        return summary, assessment, survey
+
+    def journal_offset(self, segment):
+        with self._cursor() as cursor:
+            row = _timed(cursor, 'SELECT "offset" FROM journal_progress WHERE segment = %s', (segment,)).fetchone()
+        return row[0] if row else 0
+
+    def forget_segment(self, segment):
+        with self._cursor() as cursor:
+            _timed(cursor, 'DELETE FROM journal_progress WHERE segment = %s', (segment,))
+
+
+class _PostgresBatch:
+    def __init__(self, storage, cursor):
+        self.storage = storage
+        self.cursor = cursor
+        self.new_question_ids = {}
+
+    def _question_id(self, question, style):
+        # As db.question_id(); ids created here are only shared once the batch commits
+        style_id = db.STYLE_IDS.get(style)
+        key = (question, style_id)
+        qid = self.storage.question_ids.get(key) or self.new_question_ids.get(key)
+        if qid is None:
+            select = 'SELECT id FROM questions WHERE text = %s AND style_id IS NOT DISTINCT FROM %s'
+            row = _timed(self.cursor, select, key).fetchone()
+            if row is None:
+                row = _timed(self.cursor, 'INSERT INTO questions (text, style_id) VALUES (%s, %s) '
+                                          'ON CONFLICT DO NOTHING RETURNING id', key).fetchone()
+                if row is None:
+                    # Inserted by a concurrent transaction that has since committed
+                    row = _timed(self.cursor, select, key).fetchone()
+            qid = self.new_question_ids[key] = row[0]
+        return qid
+
+    def _lock_participant(self, email):
+        # Serializes the "first session / first survey answer of this email" checks below
+        # with other transactions writing for the same participant
+        _timed(self.cursor, 'SELECT pg_advisory_xact_lock(hashtext(%s))', (email or '',))
+
+    def _bump(self, name, delta):
+        if delta:
+            _timed(self.cursor, 'UPDATE counters SET value = value + %s WHERE name = %s', (delta, name))
+
+    def insert_assessment(self, email, timestamp, answers, cohort=''):
+        cursor = self.cursor
+        self._lock_participant(email)
+        new_session = _timed(cursor, 'INSERT INTO assessment_sessions (email, timestamp, cohort) VALUES (%s, %s, %s) '
+                                     'ON CONFLICT (email, timestamp) DO NOTHING', (email, timestamp, cohort)).rowcount == 1
+        if new_session:
+            # The same running totals the SQLite triggers of migration 11 keep
+            sessions, surveyed = _timed(cursor, '''
+                SELECT (SELECT COUNT(*) FROM assessment_sessions WHERE email = %(email)s),
+                       EXISTS (SELECT 1 FROM survey_results WHERE email = %(email)s)
+            ''', {'email': email}).fetchone()
+            self._bump('sessions', 1)
+            self._bump('participants', int(sessions == 1))
+            self._bump('surveyed_sessions', int(surveyed))
+        session_id = _timed(cursor, 'SELECT id FROM assessment_sessions WHERE email = %s AND timestamp = %s',
+                            (email, timestamp)).fetchone()[0]
+        start = _timed(cursor, 'SELECT COALESCE(MAX(position), 0) FROM assessment_answers WHERE session_id = %s',
+                       (session_id,)).fetchone()[0]
+        rows = [(session_id, start + position, self._question_id(question, style), db._answer_value(answer))
+                for position, (style, question, answer) in enumerate(answers, 1)]
+        _timed(cursor, 'INSERT INTO assessment_answers (session_id, position, question_id, answer) VALUES (%s, %s, %s, %s)',
+               rows, many=True)
+        _timed(cursor, PG_REFRESH_SESSION_SUMMARY, {'session_id': session_id})
+        return session_id
+
+    def insert_summary(self, email, timestamp, style_results):
+        _timed(self.cursor, 'INSERT INTO summary_results (email, timestamp, style, score, tendency, description) '
+                            'VALUES (%s, %s, %s, %s, %s, %s)',
+               [(email, timestamp, *row) for row in style_results], many=True)
+
+    def insert_survey(self, email, survey_responses):
+        rows = [(email, question, answer) for question, answer in survey_responses]
+        if not rows:
+            return
+        self._lock_participant(email)
+        first_survey = _timed(self.cursor, 'SELECT NOT EXISTS (SELECT 1 FROM survey_results WHERE email = %s)',
+                              (email,)).fetchone()[0]
+        _timed(self.cursor, 'INSERT INTO survey_results (email, question, answer) VALUES (%s, %s, %s)', rows, many=True)
+        if first_survey:
+            sessions = _timed(self.cursor, 'SELECT COUNT(*) FROM assessment_sessions WHERE email = %s', (email,)).fetchone()[0]
+            self._bump('surveyed_sessions', sessions)
+
+    def set_journal_offset(self, segment, offset):
+        _timed(self.cursor, 'INSERT INTO journal_progress (segment, "offset") VALUES (%s, %s) '
+                            'ON CONFLICT (segment) DO UPDATE SET "offset" = excluded."offset"', (segment, offset))
+
+
+def create_storage(backend=STORAGE_BACKEND):
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'postgres':
+        return PostgresStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    # The process-wide storage backend, created on first use
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
@@ -0,0 +1,310 @@
+import collections
+import fcntl
+import itertools
+import json
+import os
+import threading
+import time
+
+import metrics
+import storage
+
+# Submissions are appended to a journal file and acknowledged right away; a background
+# thread applies them to storage in batched transactions. WRITE_BEHIND=0 writes inline.
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '1') != '0'
+JOURNAL_DIR = os.environ.get('WRITE_BEHIND_DIR', 'journal')
+# Records applied per transaction, and how long the writer lets a batch fill up
+BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', '500'))
+BATCH_DELAY = float(os.environ.get('WRITE_BEHIND_BATCH_DELAY_MS', '20')) / 1000
+# fsync every append; off by default, matching synchronous=NORMAL (survives a crashed
+# process, not a power cut)
+FSYNC = os.environ.get('WRITE_BEHIND_FSYNC', '0') == '1'
+# A fully applied segment larger than this is replaced by a fresh one
+SEGMENT_BYTES = int(os.environ.get('WRITE_BEHIND_SEGMENT_BYTES', str(4 * 1024 * 1024)))
+# How long results() waits for its own submission to be applied
+READ_TIMEOUT = float(os.environ.get('WRITE_BEHIND_READ_TIMEOUT', '5'))
+# Attempts at a failing batch before its records are applied one at a time, and those
+# that still fail are set aside in the dead-letter file in the journal directory
+MAX_ATTEMPTS = int(os.environ.get('WRITE_BEHIND_MAX_ATTEMPTS', '3'))
+DEAD_LETTER_FILE = 'dead-letter.log'
+
+DEAD_LETTERS = metrics.counter('write_behind_dead_letters_total',
+                               'Journaled records set aside after failing to apply', ('op',))
+
+
+def _apply_assessment(batch, record):
+    # Records journaled before cohorts existed have no cohort
+    batch.insert_assessment(record['email'], record['timestamp'], record['answers'], record.get('cohort', ''))
+
+
+def _apply_summary(batch, record):
+    batch.insert_summary(record['email'], record['timestamp'], record['rows'])
+
+
+def _apply_survey(batch, record):
+    batch.insert_survey(record['email'], record['answers'])
+
+
+APPLY = {'assessment': _apply_assessment, 'summary': _apply_summary, 'survey': _apply_survey}
+
+
+def _apply_batch(store, segment, records, end_offset):
+    # Records and the segment's new offset commit together, so each record is applied
+    # exactly once even if the process dies between batches
+    with metrics.span('write_behind.batch'), store.batch() as batch:
+        for record in records:
+            APPLY[record['op']](batch, record)
+        batch.set_journal_offset(segment, end_offset)
+
+
+def _dead_letter(directory, segment, record, error):
+    line = json.dumps({'segment': segment, 'failed_at': time.time(), 'error': f"{type(error).__name__}: {error}",
+                       'record': record}, separators=(',', ':')) + '\n'
+    with open(os.path.join(directory, DEAD_LETTER_FILE), 'a', encoding='utf-8') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    DEAD_LETTERS.inc(1, record.get('op', ''))
+    print(f"Write-behind record set aside in {DEAD_LETTER_FILE}: {type(error).__name__}: {error}")
+
+
+def _apply_singly(store, directory, segment, entries):
+    # Applies (record, end offset) entries one per transaction; a record that fails is
+    # written to the dead-letter file and the offset moved past it. Stops at a record
+    # whose offset cannot be committed either, since then the storage is failing rather
+    # than the record. -> (entries settled, records set aside)
+    settled = set_aside = 0
+    for record, end_offset in entries:
+        try:
+            _apply_batch(store, segment, [record], end_offset)
+        except Exception as e:
+            _dead_letter(directory, segment, record, e)
+            try:
+                _apply_batch(store, segment, [], end_offset)
+            except Exception:
+                break
+            set_aside += 1
+        settled += 1
+    return settled, set_aside
+
+
+def _read_records(path, offset):
+    # (record, end offset) for each complete line after offset; a torn last line from a
+    # crash mid-append was never acknowledged and is ignored
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            yield json.loads(line), offset
+
+
+class Journal:
+    def __init__(self, directory=JOURNAL_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        # (record, end offset, enqueued at) waiting to be applied
+        self.queue = collections.deque()
+        self.pid = None
+        self.fd = None
+        self.segment = None
+        self.offset = 0
+        self.applied_offset = 0
+        self.applied = 0
+        self.batches = 0
+        self.dead_letters = 0
+        self.last_error = None
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.segment = f"{os.getpid()}-{time.time_ns()}.jsonl"
+        path = os.path.join(self.directory, self.segment)
+        # Created and locked under a name recover() ignores, then renamed, so recover()
+        # never finds a live segment unlocked. The lock is held for the life of the
+        # process; recover() only replays segments whose owner is gone.
+        self.fd = os.open(path + '.new', os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(path + '.new', path)
+        self.offset = self.applied_offset = 0
+
+    def _start(self):
+        # Lazily per process, so forked workers each get their own segment and writer
+        self.pid = os.getpid()
+        self.queue.clear()
+        self._open_segment()
+        threading.Thread(target=self._run, name='write-behind', daemon=True).start()
+
+    def append(self, op, **record):
+        record['op'] = op
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self.lock:
+            if self.pid != os.getpid():
+                self._start()
+            os.write(self.fd, line)
+            if FSYNC:
+                os.fsync(self.fd)
+            self.offset += len(line)
+            self.queue.append((record, self.offset, time.monotonic()))
+            self.ready.notify()
+
+    def _run(self):
+        store = storage.get_storage()
+        attempts = 0
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.ready.wait()
+            # Let concurrent submissions join the batch
+            time.sleep(BATCH_DELAY)
+            with self.lock:
+                batch = list(itertools.islice(self.queue, BATCH_SIZE))
+                segment = self.segment
+            set_aside = 0
+            try:
+                _apply_batch(store, segment, [record for record, _, _ in batch], batch[-1][1])
+            except Exception as e:
+                # Left queued and retried; the journal still has them if the process dies
+                self.last_error = f"{type(e).__name__}: {e}"
+                attempts += 1
+                if attempts < MAX_ATTEMPTS:
+                    print(f"Write-behind batch failed, retrying: {self.last_error}")
+                    time.sleep(1)
+                    continue
+                # One bad record must not hold up every submission queued behind it
+                settled, set_aside = _apply_singly(store, self.directory, segment,
+                                                   [(record, end_offset) for record, end_offset, _ in batch])
+                if not settled:
+                    print(f"Write-behind batch failed, retrying: {self.last_error}")
+                    time.sleep(1)
+                    continue
+                batch = batch[:settled]
+            attempts = 0
+            with self.lock:
+                for _ in batch:
+                    self.queue.popleft()
+                self.applied += len(batch) - set_aside
+                self.dead_letters += set_aside
+                self.batches += 1
+                self.applied_offset = batch[-1][1]
+                self.last_error = None
+                if not self.queue and self.offset >= SEGMENT_BYTES:
+                    self._rotate(store)
+
+    def _rotate(self, store):
+        # Called with the lock held once everything in the segment has been applied
+        old_fd, old_segment = self.fd, self.segment
+        self._open_segment()
+        os.remove(os.path.join(self.directory, old_segment))
+        os.close(old_fd)
+        store.forget_segment(old_segment)
+
+    def stats(self):
+        with self.lock:
+            oldest = self.queue[0][2] if self.queue else None
+            return {
+                'enabled': WRITE_BEHIND,
+                'depth': len(self.queue),
+                'lag_seconds': round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+                'pending_bytes': self.offset - self.applied_offset,
+                'applied': self.applied,
+                'batches': self.batches,
+                'dead_letters': self.dead_letters,
+                'last_error': self.last_error,
+            }
+
+
+_journal = Journal()
+
+
+def submit_assessment(email, timestamp, answers, cohort=''):
+    # answers: iterable of (style, question, answer)
+    answers = [list(answer) for answer in answers]
+    if not WRITE_BEHIND:
+        storage.get_storage().save_assessment(email, timestamp, answers, cohort)
+        return
+    _journal.append('assessment', email=email, timestamp=timestamp, answers=answers, cohort=cohort)
+
+
+def submit_summary(email, timestamp, style_results):
+    # style_results: iterable of (style, score, tendency, description)
+    if not WRITE_BEHIND:
+        storage.get_storage().save_summary(email, timestamp, style_results)
+        return
+    _journal.append('summary', email=email, timestamp=timestamp, rows=[list(row) for row in style_results])
+
+
+def submit_survey(email, survey_responses):
+    # survey_responses: iterable of (question, answer)
+    if not WRITE_BEHIND:
+        storage.get_storage().save_survey(email, survey_responses)
+        return
+    _journal.append('survey', email=email, answers=[list(row) for row in survey_responses])
+
+
+def stats():
+    return _journal.stats()
+
+
+def wait_for_assessment(email, timestamp, timeout=READ_TIMEOUT):
+    # Id of the stored (email, timestamp) session, polling while the writer (possibly in
+    # another worker process) catches up; None if it does not appear in time
+    store = storage.get_storage()
+    deadline = time.monotonic() + timeout
+    while True:
+        session_id = store.find_session(email, timestamp)
+        if session_id is not None or time.monotonic() >= deadline:
+            return session_id
+        time.sleep(0.01)
+
+
+def _replay(store, directory, segment, entries):
+    # -> records applied; a batch that fails is retried a record at a time, as in _run
+    try:
+        _apply_batch(store, segment, [record for record, _ in entries], entries[-1][1])
+        return len(entries)
+    except Exception:
+        settled, set_aside = _apply_singly(store, directory, segment, entries)
+        if settled < len(entries):
+            raise
+        return settled - set_aside
+
+
+def recover(directory=JOURNAL_DIR):
+    # Replays journal segments left behind by processes that exited or crashed, from the
+    # last offset each one committed, then deletes them. Segments of live processes are
+    # locked and skipped.
+    if not os.path.isdir(directory):
+        return 0
+    store = storage.get_storage()
+    replayed = 0
+    for segment in sorted(os.listdir(directory)):
+        if not segment.endswith('.jsonl'):
+            continue
+        path = os.path.join(directory, segment)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            if not os.path.exists(path):
+                # Another process finished replaying it while we waited for the lock
+                continue
+            batch = []
+            for entry in _read_records(path, store.journal_offset(segment)):
+                batch.append(entry)
+                if len(batch) >= BATCH_SIZE:
+                    replayed += _replay(store, directory, segment, batch)
+                    batch = []
+            if batch:
+                replayed += _replay(store, directory, segment, batch)
+            os.remove(path)
+            store.forget_segment(segment)
+        finally:
+            os.close(fd)
+    return replayed